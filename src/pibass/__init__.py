@@ -1,4 +1,21 @@
+import sys
+
 from .polly_utils import *
+from .metrics import metrics, Metrics
 from .audio_utils import *
-from .pibass_motors import PiBassMotors, MotorEvent, PiBassAsyncMotors
-from .pibass_audio import PiBassAudio
+from .pibass_motors import PiBassMotors, MotorEvent, PiBassAsyncMotors, MotorScheduler
+from .simulated_hat import SimulatedMotorHAT, MotorTrace
+from .motor_timeline import MotorTimeline
+from .audio_output import BlockingPlayback, CallbackAudioOutput, NullAudioDevice
+from .pibass_audio import PiBassAudio, PreparedSpeech, ChunkedSpeech
+from .speech_queue import SpeechQueue, SpeechItem, PRIORITY_LEVELS, priority_level
+from .multi_fish import MultiFishController
+from .speech_server import SpeechServer, SpeechClient
+from .replay_bench import read_trace, append_trace, run_benchmark
+from .tts_cache import TTSCacheStore, tts_cache_key
+from .polly_client import PollySynthesisClient, get_default_polly_client
+from .local_tts import LocalTTSEngine, ESpeakEngine, PicoEngine, get_local_tts
+from .language_detect import LanguageDetector, NGramLanguageDetector, GoogleTransDetector, CachedLanguageDetector
+
+if sys.version_info >= (3, 5):  # async/await syntax
+    from .async_audio import AsyncPiBassAudio
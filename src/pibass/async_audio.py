@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""asyncio facade over PiBassAudio; requires Python 3.7+."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+try:
+    from .pibass_audio import PiBassAudio
+    from .pibass_motors import monotonic_time
+except (ImportError, ValueError) as err:
+    from pibass_audio import PiBassAudio
+    from pibass_motors import monotonic_time
+
+
+class AsyncPiBassAudio(object):
+    """Awaitable synthesize, play and speak, so that one event loop can
+    serve chat traffic while the fish talks.
+
+    Polly requests, decoding and onset detection run on a pool of
+    num_synth_workers threads. Playback runs on a single thread, so
+    utterances play one at a time in the order they were awaited.
+    Cancelling a task awaiting play or speak stops its utterance within
+    one audio block and releases the motors; a synthesis that is already
+    running completes in the background and is still cached.
+
+    bass: PiBassAudio to wrap; created from kwargs if None
+    """
+
+    def __init__(self, bass=None, num_synth_workers=2, **kwargs):
+        self.bass = bass if bass is not None else PiBassAudio(**kwargs)
+        self.synth_executor = concurrent.futures.ThreadPoolExecutor(num_synth_workers)
+        self.play_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.terminate()
+
+    def _run(self, executor, func, *args):
+        """ Future of func(*args) on executor; called from coroutines only. """
+        return asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(func, *args))
+
+    async def synthesize(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        """ Returns a PreparedSpeech; see PiBassAudio.synthesize. """
+        return await self._run(self.synth_executor, self.bass.synthesize,
+                               text, polly_voice_id, aws_region)
+
+    async def play(self, speech):
+        """ Plays a PreparedSpeech, returning when playback is done. """
+        stop_event = threading.Event()
+        future = self._run(self.play_executor, self.bass.play, speech, stop_event)
+        try:
+            # Shielded, so that on cancellation the playback thread is told to
+            # stop rather than being abandoned mid-write
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            stop_event.set()
+            raise
+
+    async def speak(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        speech = await self.synthesize(text, polly_voice_id, aws_region)
+        await self.play(speech)
+
+    def stop(self):
+        """ Stops whatever is playing now; see PiBassAudio.stop. """
+        self.bass.stop()
+
+    async def wait_for_motors(self):
+        """ Returns once all scheduled motor events have fired. """
+        while True:
+            t = self.bass.last_event_time()
+            now = monotonic_time()
+            if t is None or t <= now:
+                return
+            await asyncio.sleep(t - now)
+
+    async def _move(self, move, **kwargs):
+        t = move(**kwargs)
+        await asyncio.sleep(max(0., t - monotonic_time()))
+        return t
+
+    async def move_head(self, **kwargs):
+        return await self._move(self.bass.move_head, **kwargs)
+
+    async def move_mouth(self, **kwargs):
+        return await self._move(self.bass.move_mouth, **kwargs)
+
+    async def move_tail(self, **kwargs):
+        return await self._move(self.bass.move_tail, **kwargs)
+
+    async def terminate(self):
+        self.bass.stop()
+        await self._run(self.play_executor, self.bass.terminate)
+        self.synth_executor.shutdown(wait=False)
+        self.play_executor.shutdown(wait=False)
+
+
+def test_async_pibass_audio():
+    """ Speaks each line while printing a heartbeat, to show the loop stays responsive. """
+    parser = argparse.ArgumentParser(description='Test asyncio pibass audio')
+    parser.add_argument('text', help='Lines to be spoken', type=str, nargs='+')
+    parser.add_argument('--cancel_after_sec', help='Cancel each line after this long [none]',
+                        type=float, default=None)
+    args = parser.parse_args()
+
+    async def heartbeat():
+        start_t = monotonic_time()
+        while True:
+            await asyncio.sleep(0.5)
+            print('heartbeat> %.1f sec' % (monotonic_time() - start_t))
+
+    async def main():
+        async with AsyncPiBassAudio() as bass:
+            heartbeat_task = asyncio.ensure_future(heartbeat())
+            for text in args.text:
+                try:
+                    await asyncio.wait_for(bass.speak(text), args.cancel_after_sec)
+                except asyncio.TimeoutError:
+                    print('cancelled> %s' % text)
+            heartbeat_task.cancel()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    test_async_pibass_audio()
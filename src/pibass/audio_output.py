@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+import collections
+import threading
+import time
+
+try:
+    from .pibass_motors import monotonic_time
+except (ImportError, ValueError) as err:
+    from pibass_motors import monotonic_time
+
+# pyaudio.paContinue, which stream callbacks return to keep the stream
+# running; defined here so the callback never touches the pyaudio module
+PA_CONTINUE = 0
+
+
+class BlockingPlayback(object):
+    """Opens an output stream per utterance and writes to it synchronously.
+
+    start_t is when write is first called, so that audio_start_t, when the
+    first frame reaches the DAC, is later by the output latency.
+    """
+
+    def __init__(self, audio_dev, sample_width, channels, frame_rate, output_device_index=None):
+        self.stream = audio_dev.open(
+            format=audio_dev.get_format_from_width(sample_width),
+            channels=channels,
+            rate=frame_rate,
+            output=True,
+            output_device_index=output_device_index)
+        self.start_t = None
+        self.audio_start_t = None
+        self.cancelled = False
+
+    def earliest_start_t(self):
+        """ Earliest time to schedule onsets of audio written from now on. """
+        return monotonic_time()
+
+    def start(self, head_t):
+        """ Waits till head movement is done; returns time to schedule onsets from. """
+        if head_t > monotonic_time():
+            time.sleep(head_t - monotonic_time())
+        self.start_t = monotonic_time()
+        self.audio_start_t = self.start_t + self.stream.get_output_latency()
+        return self.start_t
+
+    def write(self, pcm):
+        self.stream.write(pcm)
+
+    def drain(self, stop_requested=None):
+        """ Returns False if playback was stopped before the end. """
+        return True
+
+    def cancel(self):
+        """ Makes close discard buffered audio instead of playing it out. """
+        self.cancelled = True
+
+    def close(self):
+        if not self.cancelled:
+            self.stream.stop_stream()  # plays out what is buffered
+        self.stream.close()  # aborts an active stream
+
+
+class CallbackPlayback(object):
+    """Utterance queued on a CallbackAudioOutput.
+
+    Its first frame is played at start_t (in monotonic_time), as measured
+    by the DAC time PortAudio passes to each callback; audio_start_t and
+    end_t record when the first and last frames were actually played.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.start_t = None
+        self.audio_start_t = None
+        self.end_t = None
+        self.chunks = collections.deque()
+        self.offset = 0  # bytes of chunks[0] already played
+        self.remainder = b''  # trailing partial frame
+        self.finished = False  # no more writes
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def earliest_start_t(self):
+        """ Earliest time audio written from now on can be heard. """
+        return monotonic_time() + self.output.output_latency_sec + self.output.buffer_sec
+
+    def start(self, head_t):
+        """ Plays from head_t, or as soon as the output buffer allows. """
+        start_t = max(head_t, self.earliest_start_t())
+        with self.output.mutex:
+            self.start_t = start_t
+        return start_t
+
+    def write(self, pcm):
+        """ Queues PCM without blocking. """
+        frame_bytes = self.output.frame_bytes
+        pcm = self.remainder + pcm
+        num_bytes = len(pcm) - len(pcm) % frame_bytes
+        self.remainder = pcm[num_bytes:]
+        if num_bytes > 0:
+            with self.output.mutex:
+                self.chunks.append(pcm[:num_bytes])
+
+    def drain(self, stop_requested=None, margin_sec=1.):
+        """Blocks until the last frame has been played, checking
+        stop_requested() once per buffer; returns False if stopped, or if
+        the stream stops calling back (e.g. the device went away) and the
+        queued audio is not played within margin_sec of when it should be.
+        """
+        with self.output.mutex:
+            self.finished = True
+            queued_bytes = sum(len(chunk) for chunk in self.chunks) - self.offset
+            start_t = self.start_t
+        output = self.output
+        deadline_t = (max(start_t or 0., monotonic_time()) + output.output_latency_sec + output.buffer_sec +
+                      float(queued_bytes // output.frame_bytes) / output.frame_rate + margin_sec)
+        while not self.done.wait(output.buffer_sec):
+            if stop_requested is not None and stop_requested():
+                self.cancel()
+                return False
+            stream = output.stream
+            if monotonic_time() > deadline_t or stream is None or not stream.is_active():
+                self.cancel()
+                return False
+        if self.cancelled:
+            return False
+        if self.end_t is not None and self.end_t > monotonic_time():
+            time.sleep(self.end_t - monotonic_time())
+        return True
+
+    def cancel(self):
+        """ Stops playback at the next buffer. """
+        with self.output.mutex:
+            self.cancelled = True
+
+    def close(self):
+        if not self.done.is_set():
+            self.cancel()
+
+    def _read(self, num_bytes):
+        """ Returns up to num_bytes of queued PCM; caller holds output.mutex. """
+        data = []
+        while num_bytes > 0 and len(self.chunks) > 0:
+            chunk = self.chunks[0]
+            piece = chunk[self.offset:self.offset+num_bytes]
+            data.append(piece)
+            num_bytes -= len(piece)
+            self.offset += len(piece)
+            if self.offset >= len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+        return b''.join(data)
+
+
+class CallbackAudioOutput(object):
+    """Keeps one PyAudio output stream open across utterances, in callback
+    mode, and plays queued CallbackPlaybacks back to back on it. Silence is
+    played while idle. The stream is only reopened if the sample format
+    changes.
+
+    Since each callback knows when its buffer will reach the DAC
+    (outputBufferDacTime, or the stream's output latency if the host API
+    does not report it), playback starts at a requested time to within a
+    frame, and motor events can be scheduled against the real sound.
+    """
+
+    def __init__(self, audio_dev, frames_per_buffer=1024, output_device_index=None):
+        self.audio_dev = audio_dev
+        self.frames_per_buffer = frames_per_buffer
+        self.output_device_index = output_device_index
+        self.stream = None
+        self.format = None  # (sample_width, channels, frame_rate)
+        self.frame_bytes = 0
+        self.frame_rate = 0
+        self.output_latency_sec = 0.
+        self.mutex = threading.Lock()
+        self.playbacks = collections.deque()
+        self.num_underruns = 0
+
+    @property
+    def buffer_sec(self):
+        return float(self.frames_per_buffer) / self.frame_rate
+
+    def open(self, sample_width, channels, frame_rate):
+        """ Returns a new CallbackPlayback, (re)opening the stream if needed. """
+        if self.format != (sample_width, channels, frame_rate):
+            self.close()
+            self.format = (sample_width, channels, frame_rate)
+            self.frame_bytes = sample_width * channels
+            self.frame_rate = frame_rate
+            self.stream = self.audio_dev.open(
+                format=self.audio_dev.get_format_from_width(sample_width),
+                channels=channels,
+                rate=frame_rate,
+                output=True,
+                output_device_index=self.output_device_index,
+                frames_per_buffer=self.frames_per_buffer,
+                stream_callback=self._callback)
+            self.output_latency_sec = self.stream.get_output_latency()
+
+        playback = CallbackPlayback(self)
+        with self.mutex:
+            self.playbacks.append(playback)
+        return playback
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        self.format = None
+        with self.mutex:
+            for playback in self.playbacks:
+                playback.cancelled = True
+                playback.done.set()
+            self.playbacks.clear()
+
+    def _dac_time(self, now, time_info):
+        """ monotonic_time() at which the buffer being filled will be heard. """
+        dac_t = time_info.get('output_buffer_dac_time', 0.) if time_info else 0.
+        current_t = time_info.get('current_time', 0.) if time_info else 0.
+        if dac_t > 0 and current_t > 0:
+            return now + (dac_t - current_t)
+        return now + self.output_latency_sec
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        dac_t = self._dac_time(monotonic_time(), time_info)
+        num_bytes = frame_count * self.frame_bytes
+        data = []
+        filled = 0
+        with self.mutex:
+            while filled < num_bytes and len(self.playbacks) > 0:
+                playback = self.playbacks[0]
+                frame_t = dac_t + float(filled // self.frame_bytes) / self.frame_rate
+                if playback.cancelled or (playback.finished and len(playback.chunks) <= 0):
+                    self.playbacks.popleft()
+                    playback.end_t = frame_t
+                    playback.done.set()
+                    continue
+                if playback.start_t is None:
+                    break
+                if playback.audio_start_t is None:
+                    # Silence until the requested start time
+                    lead_frames = int(round((playback.start_t - frame_t) * self.frame_rate))
+                    if lead_frames > 0:
+                        lead_bytes = min(num_bytes - filled, lead_frames * self.frame_bytes)
+                        data.append(b'\0' * lead_bytes)
+                        filled += lead_bytes
+                        continue
+                    if len(playback.chunks) <= 0:
+                        break
+                    playback.audio_start_t = frame_t
+                pcm = playback._read(num_bytes - filled)
+                if len(pcm) <= 0:  # still being written
+                    self.num_underruns += 1
+                    break
+                data.append(pcm)
+                filled += len(pcm)
+        if filled < num_bytes:
+            data.append(b'\0' * (num_bytes - filled))
+        return b''.join(data), PA_CONTINUE
+
+
+class NullAudioStream(object):
+    """ PyAudio output stream that discards audio, at speed times real time. """
+
+    def __init__(self, device, sample_width, channels, rate, frames_per_buffer, stream_callback):
+        self.device = device
+        self.frame_bytes = sample_width * channels
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer or 1024
+        self.stream_callback = stream_callback
+        self.play_t = None  # when audio written so far will have played
+        self.active = True
+        self.thread = None
+        if stream_callback is not None:
+            self.thread = threading.Thread(target=self._callback_loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get_output_latency(self):
+        return 0.
+
+    def write(self, pcm):
+        """ Blocks like a full output buffer would, pacing writes in real time. """
+        now = monotonic_time()
+        if self.play_t is None or self.play_t < now:
+            self.play_t = now
+        self.play_t += float(len(pcm)) / (self.frame_bytes * self.rate) / self.device.speed
+        self.device.num_bytes += len(pcm)
+        if self.play_t > monotonic_time():
+            time.sleep(self.play_t - monotonic_time())
+
+    def _callback_loop(self):
+        buffer_sec = float(self.frames_per_buffer) / self.rate / self.device.speed
+        next_t = monotonic_time()
+        while self.active:
+            now = monotonic_time()
+            time_info = {'current_time': now, 'output_buffer_dac_time': now}
+            data, flag = self.stream_callback(None, self.frames_per_buffer, time_info, 0)
+            self.device.num_bytes += len(data)
+            if flag != PA_CONTINUE:
+                break
+            next_t += buffer_sec
+            if next_t > monotonic_time():
+                time.sleep(next_t - monotonic_time())
+
+    def is_active(self):
+        return self.active and (self.thread is None or self.thread.is_alive())
+
+    def stop_stream(self):
+        self.active = False
+
+    def close(self):
+        self.active = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class NullAudioDevice(object):
+    """Stands in for pyaudio.PyAudio (e.g. as PiBassAudio's audio_dev), with
+    output streams that consume audio at speed times real time without
+    playing it, in blocking or callback mode, for benchmarks.
+    """
+
+    def __init__(self, speed=1.):
+        self.speed = speed
+        self.num_bytes = 0  # consumed, including silence in callback mode
+
+    def get_format_from_width(self, width):
+        return width
+
+    def open(self, format, channels, rate, output=True, output_device_index=None,
+             frames_per_buffer=None, stream_callback=None):
+        return NullAudioStream(self, format, channels, rate, frames_per_buffer, stream_callback)
+
+    def terminate(self):
+        pass
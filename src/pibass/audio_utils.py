@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 
 import argparse
-import aubio
-import boto3
 import collections
 import io
-import pyaudio
-import pydub
-import pydub.playback
+import re
+import subprocess
+import sys
+import threading
+
+try:
+    from .polly_client import get_default_polly_client
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from polly_client import get_default_polly_client
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+aubio = LazyImport('aubio')
+numpy = LazyImport('numpy')
+pyaudio = LazyImport('pyaudio')
+pydub = LazyImport('pydub')
 
 
 class LimitedSizeDict(collections.OrderedDict):
@@ -26,25 +38,128 @@ class LimitedSizeDict(collections.OrderedDict):
         self.popitem(last=False)
 
 
+# Polly only supports these sample rates for OutputFormat='pcm'
+POLLY_PCM_SAMPLE_RATES = (8000, 16000)
+
+# Polly visemes during which the mouth is open (vowels)
+# See: http://docs.aws.amazon.com/polly/latest/dg/ph-table-english-us.html
+OPEN_MOUTH_VISEMES = ('a', '@', 'e', 'E', 'i', 'o', 'O', 'u')
+
+# Sentences and clauses end at punctuation followed by a space, or at CJK
+# punctuation, which is not
+SENTENCE_RE = re.compile(u'.+?(?:[.!?]+(?=\\s|$)|[\u3002\uff01\uff1f]+|$)', re.DOTALL)
+CLAUSE_RE = re.compile(u'.+?(?:[,;:]+(?=\\s|$)|[\u3001\uff0c]+|$)', re.DOTALL)
+
+
+def split_text_chunks(text, max_chunk_chars=200, min_chunk_chars=20):
+    """Splits text into sentences, and sentences longer than max_chunk_chars
+    into clauses, to be synthesized and cached separately. Chunks shorter
+    than min_chunk_chars are joined to the next one, so that short words
+    ("Hi.") do not cost a Polly request of their own.
+    """
+    pieces = []
+    for sentence in SENTENCE_RE.findall(text):
+        sentence = sentence.strip()
+        if len(sentence) > max_chunk_chars:
+            pieces.extend(clause.strip() for clause in CLAUSE_RE.findall(sentence) if clause.strip())
+        elif len(sentence) > 0:
+            pieces.append(sentence)
+
+    chunks = []
+    pending = ''
+    for piece in pieces:
+        pending = '%s %s' % (pending, piece) if pending else piece
+        if len(pending) >= min_chunk_chars:
+            chunks.append(pending)
+            pending = ''
+    if pending:
+        if len(chunks) > 0 and len(chunks[-1]) + len(pending) < max_chunk_chars:
+            chunks[-1] = '%s %s' % (chunks[-1], pending)
+        else:
+            chunks.append(pending)
+    return chunks
+
+
+def text_to_audio_chunks(
+        text='This is a test.',
+        aws_region='us-east-1',
+        polly_voice_id='Kimberly',
+        output_format='mp3',
+        sample_rate=22050,
+        chunk_size=4096,
+        client=None):
+    """Generator yielding Polly audio bytes ('mp3' or 'pcm') as they are downloaded."""
+    client = client or get_default_polly_client()
+    return client.audio_chunks(
+        text, aws_region=aws_region, polly_voice_id=polly_voice_id,
+        output_format=output_format, sample_rate=sample_rate, chunk_size=chunk_size)
+
+
+def text_to_mp3_chunks(
+        text='This is a test.',
+        aws_region='us-east-1',
+        polly_voice_id='Kimberly',
+        mp3_sample_rate=22050,
+        chunk_size=4096,
+        client=None):
+    return text_to_audio_chunks(
+        text=text, aws_region=aws_region, polly_voice_id=polly_voice_id,
+        output_format='mp3', sample_rate=mp3_sample_rate, chunk_size=chunk_size,
+        client=client)
+
+
 def text_to_mp3_stream(
         text='This is a test.',
         aws_region='us-east-1',
         polly_voice_id='Kimberly',
-        mp3_sample_rate=22050):
-    polly = boto3.client('polly', aws_region)
-    response = polly.synthesize_speech(
-        Text=text,
-        OutputFormat='mp3',
-        SampleRate=str(mp3_sample_rate),
-        TextType='text',
-        VoiceId=polly_voice_id)
-    # For more voices, see: http://boto3.readthedocs.io/en/latest/reference/services/polly.html#Polly.Client.synthesize_speech
-    # or http://docs.aws.amazon.com/polly/latest/dg/API_Voice.html
-
-    stream = response["AudioStream"]
-    mp3_bytes = stream.read()
-    stream.close()
-    return mp3_bytes
+        mp3_sample_rate=22050,
+        client=None):
+    return b''.join(text_to_mp3_chunks(
+        text=text, aws_region=aws_region,
+        polly_voice_id=polly_voice_id, mp3_sample_rate=mp3_sample_rate,
+        client=client))
+
+
+def text_to_pcm_stream(
+        text='This is a test.',
+        aws_region='us-east-1',
+        polly_voice_id='Kimberly',
+        pcm_sample_rate=16000,
+        client=None):
+    """ Returns signed 16-bit little-endian mono PCM bytes. """
+    return b''.join(text_to_audio_chunks(
+        text=text, aws_region=aws_region, polly_voice_id=polly_voice_id,
+        output_format='pcm', sample_rate=pcm_sample_rate, client=client))
+
+
+def text_to_speech_marks(
+        text='This is a test.',
+        aws_region='us-east-1',
+        polly_voice_id='Kimberly',
+        speech_mark_types=('viseme', 'word'),
+        client=None):
+    """ Returns list of Polly speech mark dicts, e.g. {'time': 125, 'type': 'viseme', 'value': 'a'}. """
+    client = client or get_default_polly_client()
+    return client.speech_marks(
+        text, aws_region=aws_region, polly_voice_id=polly_voice_id,
+        speech_mark_types=speech_mark_types)
+
+
+def speech_marks_to_onsets(marks, audio_total_s=None):
+    """Returns onsets in the same form as OnsetDetector.detect, i.e. sorted
+    times in seconds followed by the end-of-audio time (if given).
+
+    Uses open-mouth visemes, or word starts for voices without visemes.
+    """
+    onsets = [m['time'] / 1000. for m in marks
+              if m['type'] == 'viseme' and m['value'] in OPEN_MOUTH_VISEMES]
+    if len(onsets) <= 0:
+        onsets = [m['time'] / 1000. for m in marks if m['type'] == 'word']
+    onsets.sort()
+    if audio_total_s is not None:
+        onsets = [t for t in onsets if t < audio_total_s]
+        onsets.append(audio_total_s)  # Insert end-of-file time
+    return onsets
 
 
 def save_mp3_stream(mp3_bytes, output_file):
@@ -84,6 +199,168 @@ def play_mp3_stream_pyaudio(mp3_bytes, cb_on_start=None):
     p.terminate()
 
 
+def pcm16_to_float32(pcm_bytes):
+    """ Converts signed 16-bit little-endian PCM to float32 samples in [-1, 1). """
+    return numpy.frombuffer(pcm_bytes, dtype='<i2').astype(numpy.float32) / 32768.
+
+
+def resample_pcm16(pcm_bytes, channels, frame_rate, target_rate):
+    """ Resamples signed 16-bit little-endian PCM to target_rate by linear interpolation. """
+    if frame_rate == target_rate:
+        return pcm_bytes
+    samples = numpy.frombuffer(pcm_bytes, dtype='<i2').reshape(-1, channels).astype(numpy.float32)
+    num_frames = int(round(len(samples) * float(target_rate) / frame_rate))
+    t = numpy.arange(num_frames) * (float(frame_rate) / target_rate)
+    resampled = numpy.empty((num_frames, channels), dtype=numpy.float32)
+    for c in range(channels):
+        resampled[:, c] = numpy.interp(t, numpy.arange(len(samples)), samples[:, c])
+    return numpy.round(resampled).astype('<i2').tobytes()
+
+
+def audio_segment_to_float32(sound):
+    """ Returns mono float32 samples in [-1, 1) of a pydub.AudioSegment. """
+    samples = numpy.array(sound.get_array_of_samples(), dtype=numpy.float32)
+    samples /= float(1 << (8*sound.sample_width - 1))
+    if sound.channels > 1:
+        samples = samples.reshape(-1, sound.channels).mean(axis=1)
+    return samples
+
+
+class MP3StreamDecoder(object):
+    """Decodes MP3 chunks to 16-bit mono PCM through an ffmpeg pipe, so that
+    samples can be played before the whole MP3 has been downloaded.
+
+    mp3_chunks is consumed on a background thread; read() blocks until the
+    requested number of PCM bytes has been decoded, and returns b'' at EOF.
+    """
+
+    def __init__(self, mp3_chunks, sample_rate=22050, converter=None):
+        self.sample_rate = sample_rate
+        self.source_chunks = []
+        self.feed_error = None
+        self.eof = False  # read to the end
+        self.proc = subprocess.Popen(
+            [converter or pydub.AudioSegment.converter, '-loglevel', 'quiet',
+             '-f', 'mp3', '-i', 'pipe:0',
+             '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1',
+             '-ar', str(sample_rate), 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.feed_thread = threading.Thread(
+            target=self._feed, args=(mp3_chunks,))
+        self.feed_thread.daemon = True
+        self.feed_thread.start()
+
+    def _feed(self, mp3_chunks):
+        try:
+            for chunk in mp3_chunks:
+                self.source_chunks.append(chunk)
+                self.proc.stdin.write(chunk)
+        except:
+            self.feed_error = sys.exc_info()
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    @property
+    def source_bytes(self):
+        return b''.join(self.source_chunks)
+
+    def read(self, num_bytes):
+        pcm = self.proc.stdout.read(num_bytes)
+        if len(pcm) < num_bytes:
+            self.eof = True
+        return pcm
+
+    def close(self, join_timeout_sec=5.):
+        """Waits for ffmpeg to exit, killing it if the PCM was not read to
+        the end (e.g. playback was stopped); re-raises any error from the MP3
+        source, unless reading stopped early.
+        """
+        self.proc.stdout.close()
+        if not self.eof:
+            # Unblocks the feed thread if it is writing to a full pipe
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+        self.proc.wait()
+        self.feed_thread.join(join_timeout_sec)  # may still wait on the download
+        if self.feed_error is not None and self.eof:
+            exc_type, exc_value, exc_tb = self.feed_error
+            raise exc_value
+
+
+class PCMStreamReader(object):
+    """Same interface as MP3StreamDecoder for audio that is already 16-bit
+    PCM: re-blocks arbitrary-sized chunks without splitting samples.
+    """
+
+    def __init__(self, pcm_chunks):
+        self.pcm_chunks = iter(pcm_chunks)
+        self.source_chunks = []
+        self.buf = b''
+
+    @property
+    def source_bytes(self):
+        return b''.join(self.source_chunks)
+
+    def read(self, num_bytes):
+        for chunk in self.pcm_chunks:
+            self.source_chunks.append(chunk)
+            self.buf += chunk
+            if len(self.buf) >= num_bytes:
+                break
+        num_bytes = min(num_bytes, len(self.buf) - len(self.buf) % 2)
+        pcm, self.buf = self.buf[:num_bytes], self.buf[num_bytes:]
+        return pcm
+
+    def close(self):
+        pass
+
+
+class StreamingOnsetDetector(object):
+    """Incremental counterpart of OnsetDetector.detect: feed() accepts blocks
+    of any size and returns the onsets found in the hops completed so far.
+    """
+
+    def __init__(self, samplerate, buf_size, hop_size, method):
+        self.samplerate = samplerate
+        self.hop_size = hop_size
+        self.onset_detector = aubio.onset(method, buf_size, hop_size, samplerate)
+        self.pending = numpy.zeros(0, dtype=numpy.float32)
+        self.total_frames = 0
+
+    def feed(self, samples):
+        if len(self.pending) > 0:
+            samples = numpy.concatenate((self.pending, samples))
+        onsets = []
+        num_hops = len(samples) // self.hop_size
+        for i in range(num_hops):
+            if self.onset_detector(samples[i*self.hop_size:(i+1)*self.hop_size]):
+                onsets.append(self.onset_detector.get_last_s())
+        self.pending = samples[num_hops*self.hop_size:]
+        self.total_frames += num_hops*self.hop_size
+        return onsets
+
+    def feed_pcm16(self, pcm_bytes):
+        return self.feed(pcm16_to_float32(pcm_bytes))
+
+    def finish(self):
+        """ Flushes the zero-padded last hop; returns its onsets plus end-of-audio time. """
+        onsets = []
+        if len(self.pending) > 0:
+            samples = numpy.zeros(self.hop_size, dtype=numpy.float32)
+            samples[:len(self.pending)] = self.pending
+            if self.onset_detector(samples):
+                onsets.append(self.onset_detector.get_last_s())
+            self.total_frames += len(self.pending)
+            self.pending = self.pending[:0]
+        onsets.append(float(self.total_frames)/self.samplerate)
+        return onsets
+
+
 class OnsetDetector:
     def __init__(self,
                  audio_sample_rate=22050,
@@ -120,6 +397,20 @@ class OnsetDetector:
 
         return onsets
 
+    def detect_samples(self, samples, samplerate=None):
+        """ Same as detect, but for an in-memory buffer of mono float32 samples. """
+        onset_stream = self.stream(samplerate)
+        onsets = onset_stream.feed(
+            numpy.ascontiguousarray(samples, dtype=numpy.float32))
+        return onsets + onset_stream.finish()
+
+    def stream(self, samplerate=None):
+        """ Returns a StreamingOnsetDetector with the same settings. """
+        return StreamingOnsetDetector(samplerate or self.audio_sample_rate,
+                                      self.onset_buf_size,
+                                      self.onset_hop_size,
+                                      self.onset_method)
+
 
 def test_polly_text_to_speech():
     parser = argparse.ArgumentParser(
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import json
+import math
+import re
+import threading
+import unicodedata
+
+try:
+    from .polly_utils import voice_db
+    from .metrics import metrics
+except (ImportError, ValueError) as err:
+    from polly_utils import voice_db
+    from metrics import metrics
+
+
+# Parallel sample text per voice_db base language code, used to build the
+# built-in character n-gram profiles. Train richer ones with
+# NGramLanguageDetector.train and save_profiles.
+SAMPLE_TEXTS = {
+    'en': "Good morning everyone, I think that we should start the meeting now. Have you seen the "
+          "new project of the team? It is a very good idea, but we still have to work on the details. "
+          "Thank you very much for your help, see you tomorrow. What time is it right now? The quick "
+          "brown fox jumps over the lazy dog while this is a test of the speech system. Can someone please "
+          "review my pull request? The build is broken again, so I will deploy the fix after lunch.",
+    'fr': "Bonjour à tous, je pense que nous devons commencer la réunion maintenant. Est-ce que vous "
+          "avez vu le nouveau projet de l'équipe ? C'est une très bonne idée, mais il faut encore "
+          "travailler sur les détails. Merci beaucoup pour votre aide, à demain. Quelle heure est-il "
+          "maintenant ? Ceci est un test du système de parole.",
+    'de': "Guten Morgen zusammen, ich glaube, wir sollten jetzt mit dem Treffen beginnen. Habt ihr "
+          "das neue Projekt des Teams gesehen? Das ist eine sehr gute Idee, aber wir müssen noch an "
+          "den Details arbeiten. Vielen Dank für eure Hilfe, bis morgen. Wie spät ist es jetzt? Dies "
+          "ist ein Test des Sprachsystems.",
+    'es': "Buenos días a todos, creo que debemos empezar la reunión ahora. ¿Habéis visto el nuevo "
+          "proyecto del equipo? Es una muy buena idea, pero todavía hay que trabajar en los detalles. "
+          "Muchas gracias por vuestra ayuda, hasta mañana. ¿Qué hora es ahora? Esto es una prueba "
+          "del sistema de voz.",
+    'it': "Buongiorno a tutti, penso che dobbiamo cominciare la riunione adesso. Avete visto il nuovo "
+          "progetto della squadra? È un'ottima idea, ma bisogna ancora lavorare sui dettagli. Grazie "
+          "mille per il vostro aiuto, a domani. Che ore sono adesso? Questa è una prova del sistema "
+          "vocale.",
+    'pt': "Bom dia a todos, acho que devemos começar a reunião agora. Vocês viram o novo projeto da "
+          "equipe? É uma ideia muito boa, mas ainda é preciso trabalhar nos detalhes. Muito obrigado "
+          "pela vossa ajuda, até amanhã. Que horas são agora? Isto é um teste do sistema de voz, "
+          "não sei se ele já chegou.",
+    'nl': "Goedemorgen allemaal, ik denk dat we nu met de vergadering moeten beginnen. Hebben jullie "
+          "het nieuwe project van het team gezien? Het is een heel goed idee, maar we moeten nog aan "
+          "de details werken. Hartelijk dank voor jullie hulp, tot morgen. Hoe laat is het nu? Dit "
+          "is een test van het spraaksysteem.",
+    'sv': "God morgon allihopa, jag tror att vi borde börja mötet nu. Har ni sett lagets nya projekt? "
+          "Det är en mycket bra idé, men vi måste fortfarande arbeta med detaljerna. Tack så mycket "
+          "för er hjälp, vi ses i morgon. Vad är klockan nu? Det här är ett test av talsystemet.",
+    'no': "God morgen alle sammen, jeg tror at vi bør begynne møtet nå. Har dere sett det nye "
+          "prosjektet til laget? Det er en veldig god idé, men vi må fortsatt jobbe med detaljene. "
+          "Tusen takk for hjelpen, vi ses i morgen. Hva er klokka nå? Dette er en test av "
+          "talesystemet.",
+    'dv': "Godmorgen allesammen, jeg tror at vi skal begynde mødet nu. Har I set holdets nye projekt? "
+          "Det er en rigtig god idé, men vi skal stadig arbejde med detaljerne. Mange tak for jeres "
+          "hjælp, vi ses i morgen. Hvad er klokken nu? Dette er en test af talesystemet.",
+    'is': "Góðan daginn öll sömul, ég held að við ættum að byrja fundinn núna. Hafið þið séð nýja "
+          "verkefni liðsins? Þetta er mjög góð hugmynd, en við þurfum enn að vinna í smáatriðunum. "
+          "Takk kærlega fyrir hjálpina, sjáumst á morgun. Hvað er klukkan núna? Þetta er prófun á "
+          "talkerfinu.",
+    'pl': "Dzień dobry wszystkim, myślę, że powinniśmy teraz zacząć spotkanie. Czy widzieliście nowy "
+          "projekt zespołu? To bardzo dobry pomysł, ale wciąż trzeba popracować nad szczegółami. "
+          "Dziękuję bardzo za waszą pomoc, do jutra. Która jest teraz godzina? To jest test systemu "
+          "mowy.",
+    'ro': "Bună dimineața tuturor, cred că ar trebui să începem ședința acum. Ați văzut noul proiect "
+          "al echipei? Este o idee foarte bună, dar mai trebuie să lucrăm la detalii. Vă mulțumesc "
+          "foarte mult pentru ajutor, ne vedem mâine. Cât este ora acum? Acesta este un test al "
+          "sistemului de vorbire.",
+    'tr': "Herkese günaydın, bence toplantıya şimdi başlamalıyız. Ekibin yeni projesini gördünüz mü? "
+          "Bu çok iyi bir fikir, ama hâlâ ayrıntılar üzerinde çalışmamız gerekiyor. Yardımınız için "
+          "çok teşekkür ederim, yarın görüşürüz. Saat şu an kaç? Bu, konuşma sisteminin bir testidir.",
+    'cy': "Bore da i bawb, rwy'n credu y dylen ni ddechrau'r cyfarfod nawr. Ydych chi wedi gweld "
+          "prosiect newydd y tîm? Mae'n syniad da iawn, ond mae angen gweithio ar y manylion o hyd. "
+          "Diolch yn fawr am eich help, wela i chi yfory. Faint o'r gloch yw hi nawr? Prawf o'r "
+          "system lleferydd yw hwn.",
+}
+
+# Frequent short words per language; a match is strong evidence even in
+# texts too short for n-gram statistics
+COMMON_WORDS = {
+    'en': "the be to of and a in that have i it for not on with he as you do at this but his by from "
+          "they we what is are was were my your can please hello thanks yes no how who".split(),
+    'fr': "le la les de des du un une et est en que qui dans pour pas sur au avec ce il elle je vous "
+          "nous ne se plus par mais ou où bonjour merci oui suis".split(),
+    'de': "der die das und ist nicht ich du sie er es wir ihr ein eine zu mit auf für von den dem im "
+          "ja nein danke bitte wo wie was auch aber".split(),
+    'es': "el la los las de del y que en un una es por para con no se lo su al como más pero sí "
+          "gracias hola dónde está qué muy".split(),
+    'it': "il lo la gli le di del della e che è un una per non con sono ho ma come anche si sì "
+          "grazie ciao dove sei stato questo".split(),
+    'pt': "o a os as de do da e que em um uma é não para com por mais mas se sim obrigado obrigada "
+          "olá você tudo bem muito está".split(),
+    'nl': "de het een en van ik je is dat niet op te met voor zijn we maar ja nee dank hallo heb "
+          "geen wat hoe er ook".split(),
+    'sv': "och att det är som en på jag du inte med för av har vi han hon den till om ja nej tack "
+          "hej mycket var dig".split(),
+    'no': "og det er som en på jeg du ikke med for av har vi han hun den til om ja nei takk hei "
+          "veldig hva deg meg".split(),
+    'dv': "og det er som en på jeg du ikke med for af har vi han hun den til om ja nej tak hej "
+          "meget hvad dig mig".split(),
+    'is': "og að er sem ekki ég þú við hann hún það til á í með fyrir já nei takk halló hvað mjög".split(),
+    'pl': "i w na nie to jest że się z do co jak ja ty on ona my tak dziękuję cześć dzień dobry "
+          "bardzo".split(),
+    'ro': "și în de la nu este că o un pe cu se ce mai sunt da mulțumesc bună ziua foarte eu tu".split(),
+    'tr': "ve bir bu da de için ne mi mu çok ben sen o biz evet hayır teşekkür merhaba nasıl var "
+          "yok".split(),
+    'cy': "a y yr yn i o ar mae ac ei fi ti ni chi nhw ydw ie na diolch bore da sut ble beth".split(),
+}
+
+# Languages identified by their script alone: (language code, unicodedata name prefixes)
+SCRIPT_LANGUAGES = (
+    ('ja', ('HIRAGANA', 'KATAKANA')),
+    ('ko', ('HANGUL',)),
+    ('ru', ('CYRILLIC',)),
+)
+
+
+def normalize_text(text):
+    """ Lowercase letters only, with single spaces; used for n-grams and as cache key. """
+    text = re.sub(r'[\W\d_]+', ' ', text.lower(), flags=re.UNICODE)
+    return text.strip()
+
+
+def voice_db_languages():
+    """ Base language codes that have a Polly voice, e.g. 'en' for 'en-us'. """
+    return set(l.split('-')[0] for v, g, l in voice_db)
+
+
+class LanguageDetector(object):
+    """ Interface: detect(text) returns (language_code, confidence in [0, 1]). """
+
+    def detect(self, text):
+        raise NotImplementedError
+
+
+class NGramLanguageDetector(LanguageDetector):
+    """Offline detector scoring character 1..ngram_max-grams of the text
+    against per-language frequency profiles, restricted to languages that
+    have a voice. Scripts unique to one language (kana, hangul, cyrillic)
+    are recognized directly.
+
+    Each word of the text found in a language's common_words adds
+    common_word_weight to its log-likelihood. Confidence grows with the
+    average per-n-gram score margin between the best and second-best
+    language. Text with fewer than min_letters letters (e.g. 'ok', ':+1:')
+    is too short to tell, and detected as None.
+    """
+
+    def __init__(self, profiles=None, common_words=None, languages=None, ngram_max=3,
+                 common_word_weight=3., confidence_scale=4., min_letters=4):
+        self.ngram_max = ngram_max
+        self.min_letters = min_letters
+        self.common_word_weight = common_word_weight
+        self.confidence_scale = confidence_scale
+        self.languages = set(languages) if languages is not None else voice_db_languages()
+        if profiles is None:
+            profiles = dict((lang, self.train(text)) for lang, text in SAMPLE_TEXTS.items())
+        self.set_profiles(profiles)
+        self.common_words = dict((lang, set(words)) for lang, words in
+                                 (common_words or COMMON_WORDS).items())
+
+    def ngrams(self, text):
+        padded = ' %s ' % normalize_text(text)
+        for n in range(1, self.ngram_max + 1):
+            for i in range(len(padded) - n + 1):
+                ngram = padded[i:i+n]
+                if ngram.strip():
+                    yield ngram
+
+    def train(self, text):
+        """ Returns n-gram count profile of a training text. """
+        return dict(collections.Counter(self.ngrams(text)))
+
+    def set_profiles(self, profiles):
+        self.profiles = {}
+        for lang, counts in profiles.items():
+            if lang not in self.languages:
+                continue
+            total = float(sum(counts.values()))
+            vocab = len(counts) + 1
+            # Add-one smoothed log-probabilities, with the unseen n-gram fallback
+            self.profiles[lang] = (
+                dict((ngram, math.log((count + 1.) / (total + vocab))) for ngram, count in counts.items()),
+                math.log(1. / (total + vocab)))
+
+    def save_profiles(self, path, profiles):
+        with open(path, 'w') as fh:
+            json.dump(profiles, fh)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, 'r') as fh:
+            return cls(profiles=json.load(fh), **kwargs)
+
+    def detect_script(self, text):
+        for c in text:
+            if c.isalpha():
+                name = unicodedata.name(c, '')
+                for lang, prefixes in SCRIPT_LANGUAGES:
+                    if lang in self.languages and name.startswith(prefixes):
+                        return lang
+        return None
+
+    def detect(self, text):
+        lang = self.detect_script(text)
+        if lang is not None:
+            return lang, 1.
+
+        if sum(1 for c in text if c.isalpha()) < self.min_letters or len(self.profiles) <= 0:
+            return None, 0.
+        ngrams = list(self.ngrams(text))
+        words = normalize_text(text).split()
+        scores = []
+        for lang, (log_probs, unseen_log_prob) in self.profiles.items():
+            common_words = self.common_words.get(lang, ())
+            score = sum(log_probs.get(ngram, unseen_log_prob) for ngram in ngrams)
+            score += self.common_word_weight * sum(1 for word in words if word in common_words)
+            scores.append((score, lang))
+        scores.sort(reverse=True)
+        if len(scores) == 1:
+            return scores[0][1], 1.
+        margin = (scores[0][0] - scores[1][0]) / len(ngrams)
+        return scores[0][1], 1. - math.exp(-self.confidence_scale * margin)
+
+
+class GoogleTransDetector(LanguageDetector):
+    """ Unofficial Google Translate API; needs network and the googletrans package. """
+
+    def __init__(self):
+        import googletrans
+        self.trans = googletrans.Translator()
+
+    def detect(self, text):
+        result = self.trans.detect(text)
+        return result.lang.lower(), result.confidence
+
+
+class CachedLanguageDetector(LanguageDetector):
+    """Runs detector, and only asks fallback if confidence is below
+    min_confidence. Results are kept in an LRU keyed by normalized text.
+
+    Text still undetected, or below default_min_confidence, is taken to be
+    in default_language: short chat messages ('deploy done', 'lol') are
+    otherwise spoken in whichever language they happen to resemble.
+    """
+
+    def __init__(self, detector=None, fallback=None, min_confidence=0.5, cache_size=1024,
+                 default_language='en', default_min_confidence=0.3):
+        self.detector = detector or NGramLanguageDetector()
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.default_language = default_language
+        self.default_min_confidence = default_min_confidence
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.mutex = threading.Lock()
+        self.num_hits = 0
+        self.num_fallbacks = 0
+
+    def detect(self, text):
+        key = normalize_text(text)
+        with self.mutex:
+            if key in self.cache:
+                self.num_hits += 1
+                result = self.cache.pop(key)
+                self.cache[key] = result
+                metrics.count('pibass_cache_requests_total', cache='language', result='hit')
+                return result
+        metrics.count('pibass_cache_requests_total', cache='language', result='miss')
+
+        with metrics.span('detect_language_local'):
+            result = self.detector.detect(text)
+        if self.fallback is not None and (result[0] is None or result[1] < self.min_confidence):
+            self.num_fallbacks += 1
+            try:
+                with metrics.span('detect_language_fallback'):
+                    result = self.fallback.detect(text)
+            except Exception:
+                pass  # e.g. rate-limited; keep the local result
+        # googletrans may not report a confidence
+        if result[0] is None or (result[1] is not None and result[1] < self.default_min_confidence):
+            result = (self.default_language, result[1] or 0.)
+
+        with self.mutex:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import importlib
+import threading
+
+
+class LazyImport(object):
+    """Stands in for a module (or an attribute of one, e.g. a class) until
+    it is first used, so that `import pibass` does not pay for boto3,
+    numpy, aubio, pyaudio, pydub or Adafruit_MotorHAT.
+
+    module_name: imported on first attribute access or call
+    attr: name of the object in the module to stand in for, if not the module
+    fallback: used instead if the import fails, e.g. SimulatedMotorHAT off
+        a Pi; see fallback_error
+
+    Attributes are copied onto the proxy as they are first looked up, so
+    later lookups (e.g. numpy.float32 in a loop) cost no more than usual.
+    Submodules are imported on first access too, as in pydub.playback.
+    """
+
+    def __init__(self, module_name, attr=None, fallback=None):
+        self.__dict__['_lazy_spec'] = (module_name, attr, fallback)
+        self.__dict__['_lazy_target'] = None
+        self.__dict__['_lazy_error'] = None  # ImportError, if the fallback is used
+        self.__dict__['_lazy_mutex'] = threading.Lock()
+
+    def _load(self):
+        target = self.__dict__['_lazy_target']
+        if target is not None:
+            return target
+        module_name, attr, fallback = self.__dict__['_lazy_spec']
+        with self.__dict__['_lazy_mutex']:
+            if self.__dict__['_lazy_target'] is None:
+                try:
+                    target = importlib.import_module(module_name)
+                    if attr is not None:
+                        target = getattr(target, attr)
+                except ImportError as err:
+                    if fallback is None:
+                        raise
+                    self.__dict__['_lazy_error'] = err
+                    target = fallback
+                self.__dict__['_lazy_target'] = target
+        return self.__dict__['_lazy_target']
+
+    def __getattr__(self, name):
+        if name.startswith('__'):  # e.g. copy or pickle probing the proxy
+            raise AttributeError(name)
+        target = self._load()
+        try:
+            value = getattr(target, name)
+        except AttributeError:
+            if self.__dict__['_lazy_spec'][1] is not None:
+                raise
+            # Submodule not imported by its package
+            value = importlib.import_module('%s.%s' % (target.__name__, name))
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+        self.__dict__[name] = value
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        module_name, attr, fallback = self.__dict__['_lazy_spec']
+        return '<LazyImport %s%s>' % (module_name, '.' + attr if attr else '')
+
+
+def fallback_error(lazy):
+    """ ImportError that made LazyImport lazy use its fallback, or None (imports it). """
+    lazy._load()
+    return lazy.__dict__['_lazy_error']
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import argparse
+import io
+import os
+import subprocess
+import tempfile
+import threading
+import wave
+
+try:
+    from .pibass_motors import monotonic_time
+except (ImportError, ValueError) as err:
+    from pibass_motors import monotonic_time
+
+
+def read_wav(wav_bytes):
+    """ Returns (pcm_data, sample_width, channels, frame_rate) of WAV file bytes. """
+    wav = wave.open(io.BytesIO(wav_bytes), 'rb')
+    try:
+        # Engines writing to a pipe leave the header's frame count unset
+        pcm_data = wav.readframes(wav.getnframes())
+        return pcm_data, wav.getsampwidth(), wav.getnchannels(), wav.getframerate()
+    finally:
+        wav.close()
+
+
+def run_command(command, timeout_sec=None):
+    """ Returns the stdout of command; raises IOError if it fails or times out. """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = None
+    if timeout_sec is not None:
+        timer = threading.Timer(timeout_sec, process.kill)
+        timer.start()
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if process.returncode != 0:
+        raise IOError('%s failed (%s): %s' % (command[0], process.returncode,
+                                              stderr.decode('utf-8', 'replace').strip()))
+    return stdout
+
+
+class LocalTTSEngine(object):
+    """Offline speech synthesis, e.g. PiBassAudio's fallback when Polly is
+    slow or unreachable (see its local_tts and hedge_deadline_sec).
+
+    Engines return 16-bit PCM; PiBassAudio computes its onsets as for
+    Polly audio, so both play with the same mouth movements.
+    """
+    name = None
+
+    def synthesize(self, text, language_code='en-us'):
+        """ Returns (pcm_data, sample_width, channels, frame_rate) of text. """
+        raise NotImplementedError
+
+
+class ESpeakEngine(LocalTTSEngine):
+    """ espeak-ng (or espeak) command line; robotic, but fast and in many languages. """
+    name = 'espeak-ng'
+
+    def __init__(self, command='espeak-ng', words_per_min=160, timeout_sec=5.):
+        self.command = command
+        self.words_per_min = words_per_min
+        self.timeout_sec = timeout_sec
+        self.languages = None  # supported language codes, listed on first use
+
+    def voice(self, language_code):
+        """ Closest supported espeak voice to a voice_db language code, e.g. pt-br or fr-ca. """
+        if self.languages is None:
+            output = run_command([self.command, '--voices'], self.timeout_sec).decode('utf-8', 'replace')
+            # Columns: Pty Language Age/Gender VoiceName File Other Languages
+            self.languages = set(line.split()[1].lower() for line in output.splitlines()[1:]
+                                 if len(line.split()) > 1)
+        language_code = (language_code or 'en').lower()
+        base = language_code.split('-')[0]
+        for candidate in (language_code, base):
+            if candidate in self.languages:
+                return candidate
+        regional = sorted(language for language in self.languages if language.startswith(base + '-'))
+        return regional[0] if len(regional) > 0 else 'en'
+
+    def synthesize(self, text, language_code='en-us'):
+        wav_bytes = run_command([self.command, '--stdout', '-v', self.voice(language_code),
+                                 '-s', str(self.words_per_min), '--', text], self.timeout_sec)
+        return read_wav(wav_bytes)
+
+
+class PicoEngine(LocalTTSEngine):
+    """ SVOX Pico's pico2wave; more natural than espeak, in six languages only. """
+    name = 'pico'
+    LANGUAGES = ('en-US', 'en-GB', 'de-DE', 'es-ES', 'fr-FR', 'it-IT')
+
+    def __init__(self, command='pico2wave', timeout_sec=5.):
+        self.command = command
+        self.timeout_sec = timeout_sec
+
+    def language(self, language_code):
+        """ Closest pico language to a voice_db language code, or en-US. """
+        base = (language_code or 'en').lower().split('-')[0]
+        for language in self.LANGUAGES:
+            if language.lower() == (language_code or '').lower():
+                return language
+        for language in self.LANGUAGES:
+            if language.lower().startswith(base + '-'):
+                return language
+        return 'en-US'
+
+    def synthesize(self, text, language_code='en-us'):
+        # pico2wave only writes to files with a .wav name
+        fd, wav_path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        try:
+            run_command([self.command, '-l', self.language(language_code), '-w', wav_path, '--', text],
+                        self.timeout_sec)
+            with open(wav_path, 'rb') as fh:
+                return read_wav(fh.read())
+        finally:
+            os.remove(wav_path)
+
+
+LOCAL_TTS_ENGINES = {
+    'espeak-ng': ESpeakEngine,
+    'espeak': lambda: ESpeakEngine(command='espeak'),
+    'pico': PicoEngine,
+}
+
+
+def get_local_tts(name):
+    """ LocalTTSEngine by name, one of LOCAL_TTS_ENGINES. """
+    if name not in LOCAL_TTS_ENGINES:
+        raise ValueError('local TTS engine must be one of %s' % (sorted(LOCAL_TTS_ENGINES),))
+    return LOCAL_TTS_ENGINES[name]()
+
+
+def test_local_tts():
+    parser = argparse.ArgumentParser(description='Time a local TTS engine')
+    parser.add_argument('text', help='Text to synthesize', type=str)
+    parser.add_argument('--engine', help='Local engine [espeak-ng]', type=str, default='espeak-ng',
+                        choices=sorted(LOCAL_TTS_ENGINES))
+    parser.add_argument('--language_code', help='Language code [en-us]', type=str, default='en-us')
+    parser.add_argument('--output', help='Write the audio to this WAV file', type=str, default='')
+    args = parser.parse_args()
+
+    engine = get_local_tts(args.engine)
+    start_t = monotonic_time()
+    pcm_data, sample_width, channels, frame_rate = engine.synthesize(args.text, args.language_code)
+    print('%s: %.2f sec of audio in %.3f sec' % (
+        engine.name, len(pcm_data) / float(sample_width * channels * frame_rate), monotonic_time() - start_t))
+    if args.output:
+        wav = wave.open(args.output, 'wb')
+        wav.setsampwidth(sample_width)
+        wav.setnchannels(channels)
+        wav.setframerate(frame_rate)
+        wav.writeframes(pcm_data)
+        wav.close()
+
+
+if __name__ == '__main__':
+    test_local_tts()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# Same clock as pibass_motors.monotonic_time, which imports this module
+try:
+    monotonic_time = time.monotonic
+except AttributeError:  # Python 2
+    monotonic_time = time.time
+
+
+# Seconds; fine enough for motor lateness, wide enough for Polly requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+class Histogram(object):
+    """ Prometheus-style histogram; counts[i] is the number of values <= buckets[i]. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last is +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _NullSpan(object):
+    """ Returned by Metrics.span when disabled, so that timing costs one call. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    def __init__(self, metrics, name, args):
+        self.metrics = metrics
+        self.name = name
+        self.args = args
+        self.start_t = None
+
+    def __enter__(self):
+        self.start_t = monotonic_time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.record_span(self.name, self.start_t, monotonic_time(), self.args)
+        return False
+
+
+class Metrics(object):
+    """Timing spans, counters, gauges and histograms for the speak pipeline.
+
+    Disabled by default; instrumented code then only pays for a call per
+    span and an attribute check per counter. Once enabled, each span is
+    added to the pibass_stage_seconds histogram, labelled by stage, and
+    the last max_spans are kept for export as a Chrome trace
+    (chrome://tracing or https://ui.perfetto.dev).
+
+    Names and labels follow Prometheus conventions; labels are keyword
+    arguments, e.g. count('pibass_cache_requests_total', cache='tts', result='hit').
+    """
+
+    def __init__(self, enabled=False, max_spans=10000):
+        self.enabled = enabled
+        self.mutex = threading.Lock()
+        self.counters = collections.OrderedDict()  # (name, labels) -> value
+        self.gauges = collections.OrderedDict()  # (name, labels) -> last value
+        self.histograms = collections.OrderedDict()  # (name, labels) -> Histogram
+        self.spans = collections.deque(maxlen=max_spans)  # (name, start_t, end_t, thread id, args)
+        self.thread_names = {}
+        self.server = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.mutex:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.spans.clear()
+
+    def span(self, name, **args):
+        """ Context manager timing a pipeline stage; args are shown in the trace. """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def record_span(self, name, start_t, end_t, args=None):
+        thread = threading.current_thread()
+        with self.mutex:
+            self.spans.append((name, start_t, end_t, thread.ident, args))
+            self.thread_names[thread.ident] = thread.name
+            self._histogram('pibass_stage_seconds', (('stage', name),)).observe(end_t - start_t)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.mutex:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.mutex:
+            self._histogram(name, tuple(sorted(labels.items()))).observe(value)
+
+    def observe_many(self, name, values, **labels):
+        """ Same as observe for each value, under one lock. """
+        if not self.enabled:
+            return
+        with self.mutex:
+            histogram = self._histogram(name, tuple(sorted(labels.items())))
+            for value in values:
+                histogram.observe(value)
+
+    def _histogram(self, name, labels):
+        """ Caller holds mutex. """
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        return histogram
+
+    def last_span(self, name):
+        """ (start_t, end_t) of the latest recorded span called name, or None. """
+        with self.mutex:
+            for span in reversed(self.spans):
+                if span[0] == name:
+                    return span[1], span[2]
+        return None
+
+    def to_prometheus(self):
+        """ Counters and histograms in the Prometheus text exposition format. """
+        def format_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if len(labels) <= 0:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+        def by_name(values):
+            """ Samples of a metric must be consecutive; sorting by name is stable. """
+            return sorted(values.items(), key=lambda item: item[0][0])
+
+        lines = []
+        with self.mutex:
+            typed = set()
+            for (name, labels), value in by_name(self.counters):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (name, labels), value in by_name(self.gauges):
+                if name not in typed:
+                    lines.append('# TYPE %s gauge' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (name, labels), histogram in by_name(self.histograms):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, (('le', bucket),)), cumulative))
+                lines.append('%s_sum%s %.9f' % (name, format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """ Writes to_prometheus atomically, e.g. for node_exporter's textfile collector. """
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as fh:
+            fh.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+    def chrome_trace(self, start_t=None, end_t=None):
+        """Spans overlapping [start_t, end_t] (all by default), in the Chrome
+        trace event format; pass last_span('play') for a single utterance.
+        """
+        with self.mutex:
+            spans = [span for span in self.spans
+                     if (start_t is None or span[2] >= start_t) and (end_t is None or span[1] <= end_t)]
+            thread_names = dict(self.thread_names)
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in thread_names.items()]
+        for name, span_start_t, span_end_t, tid, args in spans:
+            event = {'name': name, 'ph': 'X', 'pid': 0, 'tid': tid,
+                     'ts': 1e6 * span_start_t, 'dur': 1e6 * (span_end_t - span_start_t)}
+            if args:
+                event['args'] = args
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path, start_t=None, end_t=None):
+        with open(path, 'w') as fh:
+            json.dump(self.chrome_trace(start_t, end_t), fh)
+
+    def serve_prometheus(self, port=9105, host=''):
+        """ Serves to_prometheus at /metrics from a background thread. """
+        self.server = MetricsServer(self, host, port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics, host='', port=9105):
+        HTTPServer.__init__(self, (host, port), MetricsRequestHandler)
+        self.metrics = metrics
+
+
+# Shared by all pibass modules; call metrics.enable() to start recording
+metrics = Metrics()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import array
+
+try:
+    from .pibass_motors import Adafruit_MotorHAT, MotorEvent
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from pibass_motors import Adafruit_MotorHAT, MotorEvent
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+numpy = LazyImport('numpy')
+
+
+class MotorTimeline(object):
+    """Precompiled motor choreography, as parallel columns sorted by time:
+
+    t: seconds relative to the start of the audio
+    motor: motor number on the HAT (see PiBassMotors.HEAD/MOUTH/TAIL)
+    run_arg: Adafruit_MotorHAT command, or NO_RUN_ARG
+    speed: 0-255, or NO_SPEED
+
+    i.e. the same integer coding as MotorEvent.
+
+    PiBassAsyncMotors.add_timeline plays it through a single cursor, so
+    scheduling an utterance costs one call instead of a heap push per event.
+    Timelines pickle as plain tuples (see to_tuple), and can be cached next
+    to the audio they were built for.
+    """
+    NO_RUN_ARG = MotorEvent.NO_RUN_ARG
+    NO_SPEED = MotorEvent.NO_SPEED
+
+    def __init__(self, t=(), motor=(), run_arg=(), speed=(), end_t=0.):
+        self.t = array.array('d', t)
+        self.motor = array.array('B', motor)
+        self.run_arg = array.array('b', run_arg)
+        self.speed = array.array('h', speed)
+        self.end_t = end_t  # time of the last onset covered
+
+    def __len__(self):
+        return len(self.t)
+
+    def event(self, i):
+        """ Returns (t, motor, run_arg, speed) of the i-th event. """
+        return self.t[i], self.motor[i], self.run_arg[i], self.speed[i]
+
+    def to_tuple(self):
+        return (self.t.tolist(), self.motor.tolist(), self.run_arg.tolist(),
+                self.speed.tolist(), self.end_t)
+
+    @classmethod
+    def from_tuple(cls, value):
+        return cls(*value)
+
+    @classmethod
+    def from_onsets(cls, onsets, motor=2, speed=255,
+                    mouth_open_sec_min=0.05, mouth_open_sec_max=0.1, mouth_move_sec=0.1,
+                    min_event_gap_sec=0.1, dt_offset=0., prev_t=0.):
+        """Builds the mouth movements PiBassAudio.insert_onset_motor_events
+        schedules: open-pause-close between consecutive onsets at least
+        min_event_gap_sec apart, starting from prev_t.
+
+        Returns a timeline whose end_t is the last onset used, to be passed
+        back in as prev_t when onsets arrive incrementally.
+        """
+        # Onsets too close to the previous movement are skipped; this depends
+        # on the previous choice, so it is the only per-onset Python loop
+        move_t = []
+        for onset_t in onsets:
+            t = dt_offset + onset_t
+            if t - prev_t < min_event_gap_sec:
+                continue
+            move_t.append(prev_t)
+            prev_t = t
+        num_moves = len(move_t)
+        if num_moves <= 0:
+            return cls(end_t=prev_t)
+
+        # Each movement is 4 events: open, stop, close, stop
+        open_sec = numpy.random.uniform(mouth_open_sec_min, mouth_open_sec_max, num_moves)
+        t0 = numpy.asarray(move_t, dtype=numpy.float64)
+        t = numpy.empty((num_moves, 4))
+        t[:, 0] = t0
+        t[:, 1] = t0 + mouth_move_sec
+        t[:, 2] = t[:, 1] + open_sec
+        t[:, 3] = t[:, 2] + mouth_move_sec
+        run_arg = numpy.tile(numpy.array(
+            [Adafruit_MotorHAT.FORWARD, cls.NO_RUN_ARG, Adafruit_MotorHAT.BACKWARD, cls.NO_RUN_ARG],
+            dtype=numpy.int8), num_moves)
+        speeds = numpy.tile(numpy.array([speed, 0, speed, 0], dtype=numpy.int16), num_moves)
+
+        # Movements can overlap; a stable sort keeps scheduling order among equal times
+        t = t.ravel()
+        order = numpy.argsort(t, kind='mergesort')
+        timeline = cls(end_t=prev_t)
+        timeline.t = array.array('d', t[order].tolist())
+        timeline.motor = array.array('B', [motor]) * (4 * num_moves)
+        timeline.run_arg = array.array('b', run_arg[order].tolist())
+        timeline.speed = array.array('h', speeds[order].tolist())
+        return timeline
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import argparse
+import threading
+
+try:
+    from .pibass_audio import PiBassAudio
+    from .pibass_motors import MotorScheduler, monotonic_time, motor_hat
+    from .polly_client import PollySynthesisClient
+    from .speech_queue import SpeechQueue
+    from .tts_cache import TTSCacheStore, DecodedAudioCache
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from pibass_audio import PiBassAudio
+    from pibass_motors import MotorScheduler, monotonic_time, motor_hat
+    from polly_client import PollySynthesisClient
+    from speech_queue import SpeechQueue
+    from tts_cache import TTSCacheStore, DecodedAudioCache
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+pyaudio = LazyImport('pyaudio')
+
+
+class MultiFishController(object):
+    """Drives several fish from one process: one PiBassAudio per motor HAT
+    and audio output device, each with its own SpeechQueue, so that a fish
+    that is slow to synthesize or play does not hold up the others.
+
+    All fish share one motor scheduler thread, one PyAudio instance, one
+    Polly client and one TTS (and decoded audio) cache, so a phrase
+    synthesized for one fish is a cache hit for the next.
+
+    hat_addrs: I2C address of each fish's motor HAT
+    output_device_indices: PyAudio output device of each fish; None entries
+                           (or None) for the default device
+    hats: HAT objects to use instead of hat_addrs, e.g. SimulatedMotorHATs
+    queue_kwargs: SpeechQueue arguments, used for every fish
+    kwargs: PiBassAudio arguments, used for every fish
+    """
+
+    def __init__(self,
+                 hat_addrs=(0x60,),
+                 output_device_indices=None,
+                 hats=None,
+                 audio_cache_path='/home/pi/pibass_cache',
+                 audio_cache_bytes=512*1024*1024,
+                 decoded_cache_bytes=32*1024*1024,
+                 polly_client=None,
+                 queue_kwargs=None,
+                 **kwargs):
+        if hats is None:
+            hats = [motor_hat(addr) for addr in hat_addrs]
+        if output_device_indices is None:
+            output_device_indices = [None] * len(hats)
+        if len(output_device_indices) != len(hats):
+            raise ValueError('need one output device per HAT, got %d for %d' % (
+                len(output_device_indices), len(hats)))
+
+        self.scheduler = MotorScheduler()
+        self.audio_dev = pyaudio.PyAudio()
+        self.polly = polly_client if polly_client is not None else PollySynthesisClient(
+            max_pool_connections=max(10, 2 * len(hats)))
+        self.audio_cache = TTSCacheStore(audio_cache_path, size_limit=5000, byte_limit=audio_cache_bytes)
+        self.decoded_cache = DecodedAudioCache(byte_limit=decoded_cache_bytes)
+
+        self.fish = [
+            PiBassAudio(audio_cache_path=audio_cache_path,
+                        hat=hat,
+                        polly_client=self.polly,
+                        audio_dev=self.audio_dev,
+                        output_device_index=output_device_index,
+                        scheduler=self.scheduler,
+                        audio_cache=self.audio_cache,
+                        decoded_cache=self.decoded_cache,
+                        **kwargs)
+            for hat, output_device_index in zip(hats, output_device_indices)]
+        self.queues = [SpeechQueue(bass, **(queue_kwargs or {})) for bass in self.fish]
+        self.mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self.fish)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.terminate()
+
+    def least_loaded(self):
+        """ Index of the fish with the fewest queued utterances. """
+        loads = [len(queue) for queue in self.queues]
+        return loads.index(min(loads))
+
+    def submit(self, text, polly_voice_id=None, aws_region='us-east-1', fish=None):
+        """Queues text on fish (an index), or on the least loaded fish if
+        None; returns its SpeechItem, or None if dropped or merged.
+        """
+        with self.mutex:  # so that concurrent submits spread out
+            if fish is None:
+                fish = self.least_loaded()
+            return self.queues[fish].submit(text, polly_voice_id, aws_region)
+
+    def broadcast(self, text, polly_voice_ids=None, aws_region='us-east-1'):
+        """Queues text on every fish, optionally each in its own voice;
+        returns the SpeechItems.
+        """
+        if polly_voice_ids is None:
+            polly_voice_ids = [None] * len(self.fish)
+        return [queue.submit(text, polly_voice_id, aws_region)
+                for queue, polly_voice_id in zip(self.queues, polly_voice_ids)]
+
+    def stop(self, fish=None):
+        """ Stops what fish (or every fish, if None) is saying now. """
+        for bass in (self.fish if fish is None else [self.fish[fish]]):
+            bass.stop()
+
+    def join(self):
+        """ Blocks until every fish is done talking. """
+        for queue in self.queues:
+            queue.join()
+
+    def terminate(self):
+        for queue in self.queues:
+            queue.terminate()
+        for bass in self.fish:
+            bass.terminate()
+        self.scheduler.terminate()
+        self.audio_dev.terminate()
+        self.audio_cache.flush(forced=True)
+
+
+def test_multi_fish():
+    parser = argparse.ArgumentParser(description='Test several fish on one process')
+    parser.add_argument('text', help='Lines to be spoken, spread over the fish', type=str, nargs='+')
+    parser.add_argument('--hat_addrs', help='Motor HAT I2C addresses, comma separated [0x60]',
+                        type=str, default='0x60')
+    parser.add_argument('--output_device_indices',
+                        help='PyAudio output device per HAT, comma separated [default device]',
+                        type=str, default='')
+    parser.add_argument('--polly_voice_ids', help='Voice per fish, comma separated [Kimberly]',
+                        type=str, default='Kimberly')
+    parser.add_argument('--broadcast', help='Have every fish say every line', action='store_true')
+    args = parser.parse_args()
+
+    hat_addrs = [int(addr, 0) for addr in args.hat_addrs.split(',')]
+    output_device_indices = None
+    if args.output_device_indices:
+        output_device_indices = [int(index) for index in args.output_device_indices.split(',')]
+    voices = args.polly_voice_ids.split(',')
+    voices = [voices[i % len(voices)] for i in range(len(hat_addrs))]
+
+    start_t = monotonic_time()
+    with MultiFishController(hat_addrs, output_device_indices) as fish:
+        for i, text in enumerate(args.text):
+            if args.broadcast:
+                fish.broadcast(text, voices)
+            else:
+                fish.submit(text, voices[i % len(fish)], fish=i % len(fish))
+        fish.join()
+    print('done in %.1f sec' % (monotonic_time() - start_t))
+
+
+if __name__ == '__main__':
+    test_multi_fish()
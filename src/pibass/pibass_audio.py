@@ -1,143 +1,843 @@
 #!/usr/bin/env python
 
 import argparse
-import pyaudio
-import pydub
+import multiprocessing.pool
 import io
-import pickle as pkl
 import random
 import time
 import threading
 import traceback
 
 try:
-    from .audio_utils import LimitedSizeDict, OnsetDetector, text_to_mp3_stream, save_mp3_stream
-    from .pibass_motors import PiBassAsyncMotors
+    from .audio_utils import OnsetDetector, MP3StreamDecoder, PCMStreamReader, text_to_audio_chunks, text_to_mp3_stream, text_to_pcm_stream, text_to_speech_marks, speech_marks_to_onsets, audio_segment_to_float32, pcm16_to_float32, resample_pcm16, split_text_chunks
+    from .pibass_motors import PiBassAsyncMotors, MotorEvent, monotonic_time, percentile
+    from .simulated_hat import SimulatedMotorHAT
+    from .polly_client import PollySynthesisClient
+    from .tts_cache import TTSCacheStore, DecodedAudioCache, DecodedAudioPolicy, tts_cache_key
+    from .audio_output import BlockingPlayback, CallbackAudioOutput
+    from .local_tts import get_local_tts
+    from .motor_timeline import MotorTimeline
+    from .polly_utils import get_voice
+    from .metrics import metrics
+    from .lazy_import import LazyImport
 except (ImportError, ValueError) as err:
-    from audio_utils import LimitedSizeDict, OnsetDetector, text_to_mp3_stream, save_mp3_stream
-    from pibass_motors import PiBassAsyncMotors
+    from audio_utils import OnsetDetector, MP3StreamDecoder, PCMStreamReader, text_to_audio_chunks, text_to_mp3_stream, text_to_pcm_stream, text_to_speech_marks, speech_marks_to_onsets, audio_segment_to_float32, pcm16_to_float32, resample_pcm16, split_text_chunks
+    from pibass_motors import PiBassAsyncMotors, MotorEvent, monotonic_time, percentile
+    from simulated_hat import SimulatedMotorHAT
+    from polly_client import PollySynthesisClient
+    from tts_cache import TTSCacheStore, DecodedAudioCache, DecodedAudioPolicy, tts_cache_key
+    from audio_output import BlockingPlayback, CallbackAudioOutput
+    from local_tts import get_local_tts
+    from motor_timeline import MotorTimeline
+    from polly_utils import get_voice
+    from metrics import metrics
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+pyaudio = LazyImport('pyaudio')
+pydub = LazyImport('pydub')
+
+
+class PreparedSpeech(object):
+    """Decoded utterance, ready to be played by PiBassAudio.play, with the
+    MotorTimeline of its mouth movements if precompiled.
+    """
+
+    def __init__(self, text, polly_voice_id, pcm_data, sample_width, channels, frame_rate, onsets,
+                 timeline=None):
+        self.text = text
+        self.polly_voice_id = polly_voice_id
+        self.pcm_data = pcm_data
+        self.sample_width = sample_width
+        self.channels = channels
+        self.frame_rate = frame_rate
+        self.onsets = onsets
+        self.timeline = timeline
+
+    @property
+    def duration_sec(self):
+        return float(len(self.pcm_data)) / (self.sample_width * self.channels * self.frame_rate)
+
+
+class ChunkedSpeech(object):
+    """Utterance split into sentence or clause chunks (see split_text_chunks),
+    each a PreparedSpeech synthesized and cached on its own, in order, in the
+    background. PiBassAudio.play plays them back to back as they are ready.
+    """
+
+    def __init__(self, text, polly_voice_id, chunks, results, num_cached):
+        self.text = text
+        self.polly_voice_id = polly_voice_id
+        self.chunks = chunks  # texts
+        self.results = results  # AsyncResult of each chunk's PreparedSpeech
+        self.num_cached = num_cached  # chunks that were cache hits
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get(self, i, stop_requested=None, poll_sec=0.05):
+        """Waits for the PreparedSpeech of chunk i; raises if its synthesis
+        failed. Returns None if stop_requested(), checked every poll_sec,
+        becomes true first.
+        """
+        result = self.results[i]
+        if stop_requested is not None:
+            while not result.ready():
+                if stop_requested():
+                    return None
+                result.wait(poll_sec)
+        return result.get()
 
 
 class PiBassAudio(PiBassAsyncMotors):
     def __init__(self,
                  args=None,
-                 audio_temp_filepath='/tmp/pibass_audio.mp3',
-                 audio_cache_path='/home/pi/pibass_cache.pkl'):
-        super(PiBassAudio, self).__init__()
+                 audio_cache_path='/home/pi/pibass_cache',
+                 legacy_audio_cache_path='/home/pi/pibass_cache.pkl',
+                 audio_cache_bytes=512*1024*1024,
+                 streaming=False,
+                 stream_block_size=4096,
+                 synthesis_mode='mp3',
+                 pcm_sample_rate=16000,
+                 hat=None,
+                 polly_client=None,
+                 polly_warm_up=True,
+                 decoded_cache_bytes=32*1024*1024,
+                 decoded_policy=None,
+                 playback_mode='blocking',
+                 audio_dev=None,
+                 output_device_index=None,
+                 scheduler=None,
+                 audio_cache=None,
+                 decoded_cache=None,
+                 chunked=False,
+                 max_chunk_chars=200,
+                 num_chunk_workers=2,
+                 post_speech_pause_sec=0.5,
+                 local_tts=None,
+                 hedge_deadline_sec=None,
+                 num_hedge_workers=4):
+        """audio_dev, scheduler, polly_client, audio_cache and decoded_cache
+        may be shared between several fish (see MultiFishController); the
+        ones passed in are not terminated or flushed by terminate().
+
+        audio_cache_bytes bounds the TTS cache on disk, which also holds the
+        decoded PCM of popular phrases (see DecodedAudioPolicy).
+
+        With chunked, messages are synthesized and cached per sentence (see
+        ChunkedSpeech), on a pool of num_chunk_workers threads; this takes
+        precedence over streaming.
+
+        local_tts is a LocalTTSEngine, or its name (e.g. 'espeak-ng'). With
+        hedge_deadline_sec, utterances not cached are synthesized by it if
+        Polly has not returned by then, or has failed; Polly's result is
+        still cached for next time; up to num_hedge_workers Polly requests
+        run at once. Hedging also takes precedence over
+        streaming, which cannot fall back once audio has started.
+        """
+        super(PiBassAudio, self).__init__(hat, scheduler)
         self.args = args
         self.audio_sample_rate = args.mp3_sample_rate if args else 22050
-        self.audio_temp_filepath = audio_temp_filepath
+        self.streaming = getattr(args, 'streaming', streaming)
+        # 'mp3': decode with ffmpeg, onsets from aubio
+        # 'pcm': raw Polly PCM, onsets from Polly viseme speech marks
+        self.synthesis_mode = getattr(args, 'synthesis_mode', synthesis_mode)
+        self.pcm_sample_rate = getattr(args, 'pcm_sample_rate', pcm_sample_rate)
+        self.stream_block_size = stream_block_size
+        # 'blocking': open the device per utterance and write to it
+        # 'callback': keep the device open, and sync motors to DAC time
+        self.playback_mode = getattr(args, 'playback_mode', playback_mode)
+        self.chunked = getattr(args, 'chunked', chunked)
+        self.max_chunk_chars = max_chunk_chars
+        self.num_chunk_workers = num_chunk_workers
+        self.chunk_pool = None  # ThreadPool, started on first use
+        self.num_chunks = 0
+        self.num_chunk_cache_hits = 0
+        self.num_chunk_gaps = 0  # chunks not synthesized in time to play gaplessly
+        local_tts = getattr(args, 'local_tts', None) or local_tts
+        if local_tts is not None and not hasattr(local_tts, 'synthesize'):
+            local_tts = get_local_tts(local_tts)
+        self.local_tts = local_tts
+        self.hedge_deadline_sec = getattr(args, 'hedge_deadline_sec', None) or hedge_deadline_sec
+        self.num_hedge_workers = num_hedge_workers
+        self.hedge_pool = None  # ThreadPool for Polly requests, started on first use
+        self.hedge_pending = {}  # cache key -> AsyncResult of a Polly request
+        self.hedge_mutex = threading.Lock()
+        self.num_hedged = 0  # utterances synthesized by local_tts instead of Polly
+        self.post_speech_pause_sec = post_speech_pause_sec
+        self.time_to_first_sound = None
+        self.first_sound_t = None  # monotonic_time of the last first sound
+        self.audio_motor_skew = None
         self.audio_mutex = threading.Lock()
+        self.stop_event = threading.Event()  # set by stop() to cut playback short
         self.onset_detector = OnsetDetector(
             audio_sample_rate=self.audio_sample_rate)
-        self.audio_dev = pyaudio.PyAudio()
+        # PyAudio() probes every ALSA device, so it is created on first use
+        self.owns_audio_dev = audio_dev is None
+        self._audio_dev = audio_dev
+        self.audio_dev_mutex = threading.Lock()
+        self.output_device_index = output_device_index  # None for the default device
+        self.audio_output = None  # CallbackAudioOutput, opened on first use
 
+        # Shared Polly client; connect to the default region in the background
+        if polly_client is None:
+            polly_client = PollySynthesisClient(
+                read_timeout_sec=getattr(args, 'polly_timeout_sec', 10),
+                max_attempts=getattr(args, 'polly_max_attempts', 3))
+        self.polly = polly_client
+        if polly_warm_up:
+            self.polly.warm_up((getattr(args, 'aws_region', None) or 'us-east-1',))
+
+        # Entries and index are loaded on first lookup, not here
         self.audio_cache_path = audio_cache_path
-        self.audio_cache_time = time.time()
-        try:
-            with open(self.audio_cache_path, 'rb') as fh:
-                self.audio_cache = pkl.load(fh)
-        except:
-            self.audio_cache = LimitedSizeDict(size_limit=5000)
+        self.owns_audio_cache = audio_cache is None
+        if audio_cache is None:
+            audio_cache = TTSCacheStore(
+                audio_cache_path,
+                size_limit=5000,
+                byte_limit=audio_cache_bytes,
+                legacy_path=legacy_audio_cache_path,
+                legacy_sample_rate=self.audio_sample_rate)
+        self.audio_cache = audio_cache
+
+        # Playback-ready PCM of recent utterances, and when to persist it
+        if decoded_cache is None:
+            decoded_cache = DecodedAudioCache(byte_limit=decoded_cache_bytes)
+        self.decoded_cache = decoded_cache
+        self.decoded_policy = decoded_policy or DecodedAudioPolicy()
 
     def terminate(self):
         super(PiBassAudio, self).terminate()
-        self.audio_dev.terminate()
-        self.save_cache(force=True)
+        if self.chunk_pool is not None:
+            self.chunk_pool.terminate()
+        if self.hedge_pool is not None:
+            self.hedge_pool.terminate()
+        if self.audio_output is not None:
+            self.audio_output.close()
+        if self.owns_audio_dev and self._audio_dev is not None:
+            self._audio_dev.terminate()
+        if self.owns_audio_cache:
+            self.save_cache(forced=True)
+
+    @property
+    def audio_dev(self):
+        """ PyAudio instance, created on first use unless one was passed in. """
+        if self._audio_dev is None:
+            with self.audio_dev_mutex:
+                if self._audio_dev is None:
+                    with metrics.span('open_audio_dev'):
+                        self._audio_dev = pyaudio.PyAudio()
+        return self._audio_dev
+
+    def warm_up(self, background=True):
+        """Opens the audio device and loads the cache index now, instead of
+        on the first utterance; returns the thread if background.
+        """
+        def _warm_up():
+            try:
+                self.audio_dev
+                len(self.audio_cache)
+            except Exception:
+                traceback.print_exc()
+
+        if not background:
+            _warm_up()
+            return None
+        thread = threading.Thread(target=_warm_up)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stops the utterance being played, within one stream_block_size
+        block, and releases the motors. Has no effect on later utterances.
+        """
+        self.stop_event.set()
 
     def save_cache(self, forced=False):
-        if not forced:
-            now = time.time()
-            if now - self.audio_cache_time < 120:
-                return
-            self.audio_cache_time = now
         try:
-            with open(self.audio_cache_path, 'wb') as fh:
-                pkl.dump(self.audio_cache, fh)
+            self.audio_cache.flush(forced=forced)
         except:
             traceback.print_exc()
 
-    def insert_onset_motor_events(self, onsets, mouth_open_sec_min=0.05, mouth_open_sec_max=0.1, mouth_move_sec=0.1, dt_offset=0.):
+    def onset_timeline(self, onsets, mouth_open_sec_min=0.05, mouth_open_sec_max=0.1, mouth_move_sec=0.1, dt_offset=0., prev_t=0.):
+        """ MotorTimeline of a mouth movement between consecutive onsets, relative to audio start. """
         # min_event_gap_sec = 2*mouth_move_sec+mouth_open_sec_min # disabled
         min_event_gap_sec = 0.1
-        prev_t = time.time()
-        mouth_start_t = prev_t
-        for onset_t in onsets:
-            t = mouth_start_t + dt_offset + onset_t
-            dt_max = t - prev_t
-            if dt_max < min_event_gap_sec:  # skip
-                continue
-            mouth_open_sec = random.uniform(
-                mouth_open_sec_min, mouth_open_sec_max)
-            self.move_mouth(delay_move=mouth_move_sec,
-                            delay_open=mouth_open_sec,
-                            release=False,
-                            t=prev_t)
-            # print('move_mouth(%.2f, %.2f, %.2f), o=%.2f po=%.2f dt=%.2f' % (mouth_move_sec, mouth_open_sec, prev_t, onset_t, prev_t-now, dt_max))
-            prev_t = t
+        return MotorTimeline.from_onsets(
+            onsets, motor=self.MOUTH,
+            mouth_open_sec_min=mouth_open_sec_min,
+            mouth_open_sec_max=mouth_open_sec_max,
+            mouth_move_sec=mouth_move_sec,
+            min_event_gap_sec=min_event_gap_sec,
+            dt_offset=dt_offset,
+            prev_t=prev_t)
+
+    def insert_onset_motor_events(self, onsets, mouth_open_sec_min=0.05, mouth_open_sec_max=0.1, mouth_move_sec=0.1, dt_offset=0., start_t=None, prev_t=None):
+        """Schedules a mouth movement between consecutive onsets.
+
+        start_t is the time at which audio playback starts (defaults to now).
+        To schedule onsets incrementally, pass the returned time back in as
+        prev_t along with the same start_t.
+        """
+        mouth_start_t = monotonic_time() if start_t is None else start_t
+        if prev_t is None:
+            prev_t = mouth_start_t
+        timeline = self.onset_timeline(
+            onsets, mouth_open_sec_min, mouth_open_sec_max, mouth_move_sec,
+            dt_offset, prev_t - mouth_start_t)
+        self.add_timeline(timeline, mouth_start_t)
 
         # TODO: randomly insert tail motor events (mouth_start_t to prev_t)
+        return mouth_start_t + timeline.end_t
+
+    def report_time_to_first_sound(self, request_t, sound_t=None):
+        if sound_t is None:
+            sound_t = monotonic_time()
+        self.first_sound_t = sound_t
+        self.time_to_first_sound = sound_t - request_t
+        metrics.observe('pibass_time_to_first_sound_seconds', self.time_to_first_sound)
+        print('speak> time-to-first-sound: %.3f sec' % self.time_to_first_sound)
+
+    def report_audio_motor_skew(self, playback):
+        """ Motor timeline start minus the time its audio started at the DAC. """
+        if playback.audio_start_t is None:
+            return
+        self.audio_motor_skew = playback.start_t - playback.audio_start_t
+        metrics.set_gauge('pibass_audio_motor_skew_seconds', self.audio_motor_skew)
+        print('speak> audio-to-motor skew: %+.1f ms' % (1000. * self.audio_motor_skew))
+
+    def _open_playback(self, sample_width, channels, frame_rate):
+        """ Returns a BlockingPlayback or CallbackPlayback, per playback_mode. """
+        if self.playback_mode == 'callback':
+            if self.audio_output is None:
+                self.audio_output = CallbackAudioOutput(
+                    self.audio_dev, output_device_index=self.output_device_index)
+            return self.audio_output.open(sample_width, channels, frame_rate)
+        return BlockingPlayback(self.audio_dev, sample_width, channels, frame_rate,
+                                output_device_index=self.output_device_index)
+
+    def _cache_key(self, text, polly_voice_id):
+        sample_rate = self.pcm_sample_rate if self.synthesis_mode == 'pcm' else self.audio_sample_rate
+        return tts_cache_key(text, polly_voice_id, self.synthesis_mode, sample_rate)
+
+    def _pcm_onsets(self, pcm_bytes, speech_marks):
+        """ Onsets from speech marks, falling back to aubio if there are none. """
+        audio_total_s = len(pcm_bytes) / 2. / self.pcm_sample_rate
+        onsets = speech_marks_to_onsets(speech_marks, audio_total_s)
+        if len(onsets) <= 1:
+            onsets = self.onset_detector.detect_samples(
+                pcm16_to_float32(pcm_bytes), self.pcm_sample_rate)
+        return onsets
+
+    def _decode(self, audio_stream):
+        """ Returns (pcm_data, sample_width, channels, frame_rate, sound) for playback. """
+        if self.synthesis_mode == 'pcm':
+            return audio_stream, 2, 1, self.pcm_sample_rate, None
+        sound = pydub.AudioSegment.from_file(
+            io.BytesIO(audio_stream), format="mp3")
+        return sound._data, sound.sample_width, sound.channels, sound.frame_rate, sound
 
     def _tts(self, text, polly_voice_id, aws_region):
-        key = (text, polly_voice_id)
-        if key in self.audio_cache:
-            mp3_stream, onsets = self.audio_cache[key]
+        """Returns (audio_stream, onsets, timeline, decoded), where timeline
+        is the mouth movement MotorTimeline of the onsets, and decoded is the
+        result of _decode if it was needed to compute onsets, else None.
+
+        Entries are cached as (audio_stream, onsets, timeline tuple); the
+        timeline is computed on a hit if it is missing, e.g. from prewarm.
+        """
+        key = self._cache_key(text, polly_voice_id)
+        with metrics.span('tts_cache_get'):
+            cached = self.audio_cache.get(key)
+        metrics.count('pibass_cache_requests_total', cache='tts',
+                      result='miss' if cached is None else 'hit')
+        decoded = None
+        timeline = None
+        if cached is not None:
+            audio_stream, onsets = cached[:2]
+            if len(cached) > 2:
+                timeline = MotorTimeline.from_tuple(cached[2])
+        elif self.synthesis_mode == 'pcm':
+            # Obtain viseme timings and raw PCM; no decoding needed
+            with metrics.span('polly_speech_marks'):
+                speech_marks = text_to_speech_marks(
+                    text=text, aws_region=aws_region,
+                    polly_voice_id=polly_voice_id,
+                    client=self.polly)
+            with metrics.span('polly_audio', format='pcm'):
+                audio_stream = text_to_pcm_stream(
+                    text=text, aws_region=aws_region,
+                    polly_voice_id=polly_voice_id,
+                    pcm_sample_rate=self.pcm_sample_rate,
+                    client=self.polly)
+            with metrics.span('onsets'):
+                onsets = self._pcm_onsets(audio_stream, speech_marks)
+            timeline = self.onset_timeline(onsets)
+
+            with metrics.span('tts_cache_put'):
+                self.audio_cache.put(key, (audio_stream, onsets, timeline.to_tuple()))
+                self.save_cache()
         else:
             # Obtain MP3 stream
-            mp3_stream = text_to_mp3_stream(
-                text=text, aws_region=aws_region,
-                polly_voice_id=polly_voice_id,
-                mp3_sample_rate=self.audio_sample_rate)
+            with metrics.span('polly_audio', format='mp3'):
+                audio_stream = text_to_mp3_stream(
+                    text=text, aws_region=aws_region,
+                    polly_voice_id=polly_voice_id,
+                    mp3_sample_rate=self.audio_sample_rate,
+                    client=self.polly)
+
+            # Decode once, and compute onsets on the in-memory samples
+            with metrics.span('decode'):
+                decoded = self._decode(audio_stream)
+            with metrics.span('onsets'):
+                sound = decoded[-1]
+                onsets = self.onset_detector.detect_samples(
+                    audio_segment_to_float32(sound), sound.frame_rate)
+            timeline = self.onset_timeline(onsets)
+
+            with metrics.span('tts_cache_put'):
+                self.audio_cache.put(key, (audio_stream, onsets, timeline.to_tuple()))
+                self.save_cache()
+        if timeline is None:
+            timeline = self.onset_timeline(onsets)
+        return audio_stream, onsets, timeline, decoded
+
+    def _resolve_voice(self, polly_voice_id, aws_region):
+        if self.args is not None:
+            aws_region = getattr(self.args, 'aws_region', None) or aws_region
+            polly_voice_id = polly_voice_id or getattr(self.args, 'polly_voice_id', None)
+        return polly_voice_id, aws_region
+
+    def _is_cached(self, text, polly_voice_id):
+        key = self._cache_key(text, polly_voice_id)
+        return key in self.decoded_cache or key in self.audio_cache
+
+    def synthesize_chunked(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        """Returns a ChunkedSpeech once its first chunk is synthesized, with
+        later chunks still being synthesized in the background.
+        """
+        polly_voice_id, aws_region = self._resolve_voice(polly_voice_id, aws_region)
+        chunks = split_text_chunks(text, self.max_chunk_chars)
+        num_cached = sum(1 for chunk in chunks if self._is_cached(chunk, polly_voice_id))
+        self.num_chunks += len(chunks)
+        self.num_chunk_cache_hits += num_cached
+        print('synthesize> %d/%d chunks cached' % (num_cached, len(chunks)))
+
+        if self.chunk_pool is None:
+            self.chunk_pool = multiprocessing.pool.ThreadPool(self.num_chunk_workers)
+        results = [self.chunk_pool.apply_async(self._synthesize, (chunk, polly_voice_id, aws_region))
+                   for chunk in chunks]
+        speech = ChunkedSpeech(text, polly_voice_id, chunks, results, num_cached)
+        speech.get(0)
+        return speech
 
-            # Compute onsets
-            save_mp3_stream(mp3_stream, self.audio_temp_filepath)
-            onsets = self.onset_detector.detect(self.audio_temp_filepath)
+    def synthesize(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        """Returns a playback-ready PreparedSpeech, from cache or from Polly,
+        or in chunked mode a ChunkedSpeech if text has several sentences.
 
-            self.audio_cache[key] = (mp3_stream, onsets)
-            self.save_cache()
-        return mp3_stream, onsets
+        Does not touch the audio device or motors, so it can run on other
+        threads while something else is playing.
+        """
+        if self.chunked and len(split_text_chunks(text, self.max_chunk_chars)) > 1:
+            return self.synthesize_chunked(text, polly_voice_id, aws_region)
+        return self._synthesize(text, polly_voice_id, aws_region)
+
+    def _synthesize(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        """ Returns a PreparedSpeech of all of text. """
+        with metrics.span('synthesize', chars=len(text)):
+            polly_voice_id, aws_region = self._resolve_voice(polly_voice_id, aws_region)
+
+            # Hot entries are already decoded in memory
+            key = self._cache_key(text, polly_voice_id)
+            speech = self.decoded_cache.get(key)
+            metrics.count('pibass_cache_requests_total', cache='decoded_memory',
+                          result='miss' if speech is None else 'hit')
+            if speech is not None:
+                return speech
+
+            # Polly, or a local engine if it is too slow
+            if self.hedging and key not in self.audio_cache:
+                return self._synthesize_hedged(text, polly_voice_id, aws_region, key)
+            return self._synthesize_polly(text, polly_voice_id, aws_region, key)
+
+    def _synthesize_polly(self, text, polly_voice_id, aws_region, key):
+        """ PreparedSpeech from the TTS cache or Polly; also puts it in decoded_cache. """
+        # Decoded PCM persisted on disk for popular phrases (mp3 mode)
+        decoded_key = key + ('decoded',)
+        cached = None
+        if self.synthesis_mode != 'pcm':
+            cached = self.audio_cache.get(decoded_key)
+            metrics.count('pibass_cache_requests_total', cache='decoded_disk',
+                          result='miss' if cached is None else 'hit')
+        timeline = None
+        if cached is not None:
+            pcm_data, sample_width, channels, frame_rate, onsets = cached[:5]
+            if len(cached) > 5:
+                timeline = MotorTimeline.from_tuple(cached[5])
+        else:
+            # Obtain audio stream, onsets and mouth movements, or load from cache
+            audio_stream, onsets, timeline, decoded = self._tts(
+                text, polly_voice_id, aws_region)
+
+            # Decode to PCM, unless already done to compute onsets
+            if decoded is None:
+                decode_start_t = monotonic_time()
+                with metrics.span('decode'):
+                    decoded = self._decode(audio_stream)
+                decode_sec = monotonic_time() - decode_start_t
+                if self.synthesis_mode != 'pcm' and self.decoded_policy.record_decode(
+                        key, decode_sec, len(decoded[0])):
+                    self.audio_cache.put(decoded_key, decoded[:4] + (onsets, timeline.to_tuple()))
+            pcm_data, sample_width, channels, frame_rate, _ = decoded
+        if timeline is None:
+            timeline = self.onset_timeline(onsets)
+
+        speech = PreparedSpeech(text, polly_voice_id, pcm_data,
+                                sample_width, channels, frame_rate, onsets, timeline)
+        self.decoded_cache.put(key, speech, len(pcm_data))
+        return speech
+
+    @property
+    def hedging(self):
+        return self.local_tts is not None and self.hedge_deadline_sec is not None
+
+    def _synthesize_hedged(self, text, polly_voice_id, aws_region, key):
+        """Waits up to hedge_deadline_sec for Polly, then synthesizes with
+        local_tts instead. The Polly request carries on in the background,
+        and is shared by later requests for the same text until it is done.
+        """
+        with self.hedge_mutex:
+            if self.hedge_pool is None:
+                self.hedge_pool = multiprocessing.pool.ThreadPool(self.num_hedge_workers)
+            result = self.hedge_pending.get(key)
+            if result is None:
+                result = self.hedge_pending[key] = self.hedge_pool.apply_async(
+                    self._synthesize_pending, (text, polly_voice_id, aws_region, key))
+        try:
+            with metrics.span('hedge_wait'):
+                return result.get(self.hedge_deadline_sec)
+        except multiprocessing.TimeoutError:
+            reason = 'deadline'
+        except Exception:
+            traceback.print_exc()
+            reason = 'error'
+
+        print('synthesize> Polly %s, using %s' % (
+            'too slow' if reason == 'deadline' else 'failed', self.local_tts.name))
+        self.num_hedged += 1
+        metrics.count('pibass_hedged_total', engine=self.local_tts.name, reason=reason)
+        try:
+            return self._synthesize_local(text, polly_voice_id)
+        except Exception:
+            if reason == 'error':
+                raise
+            traceback.print_exc()
+            return result.get()  # Polly after all, however long it takes
+
+    def _synthesize_pending(self, text, polly_voice_id, aws_region, key):
+        try:
+            return self._synthesize_polly(text, polly_voice_id, aws_region, key)
+        finally:
+            with self.hedge_mutex:
+                self.hedge_pending.pop(key, None)
+
+    def _synthesize_local(self, text, polly_voice_id):
+        """PreparedSpeech from local_tts in the language of polly_voice_id; not
+        cached. Resampled to Polly's rate, so that in chunked mode it plays on
+        the same stream as the Polly chunks around it.
+        """
+        language_code = get_voice(polly_voice_id)[2] if polly_voice_id else None
+        with metrics.span('local_tts', engine=self.local_tts.name):
+            pcm_data, sample_width, channels, frame_rate = self.local_tts.synthesize(
+                text, language_code or 'en-us')
+        polly_rate = self.pcm_sample_rate if self.synthesis_mode == 'pcm' else self.audio_sample_rate
+        if sample_width == 2 and frame_rate != polly_rate:
+            with metrics.span('resample'):
+                pcm_data = resample_pcm16(pcm_data, channels, frame_rate, polly_rate)
+            frame_rate = polly_rate
+        with metrics.span('onsets'):
+            onsets = self.onset_detector.detect_samples(pcm16_to_float32(pcm_data), frame_rate)
+        return PreparedSpeech(text, polly_voice_id, pcm_data, sample_width, channels, frame_rate,
+                              onsets, self.onset_timeline(onsets))
+
+    def play(self, speech, stop_event=None):
+        """Plays a PreparedSpeech from synthesize, with head and mouth movements.
+
+        stop_event is an optional threading.Event that, like stop(), cuts
+        this utterance short when set, even before it starts playing.
+        """
+        print('speak> %s' % speech.text)
+        with self.audio_mutex, metrics.span('play', text=speech.text):
+            self.stop_event.clear()
+            if stop_event is not None and stop_event.is_set():
+                return
+            request_t = monotonic_time()
+            self.clear_all_events()
+            t = self.move_head(open=True, release=False)
+            self._play(speech, t, request_t, stop_event)
+
+    def _stop_requested(self, stop_event=None):
+        return self.stop_event.is_set() or (stop_event is not None and stop_event.is_set())
+
+    def _play(self, speech, head_t, request_t, stop_event=None):
+        if isinstance(speech, ChunkedSpeech):
+            return self._play_chunks(speech, head_t, request_t, stop_event)
+
+        # Start stream on physical audio device
+        with metrics.span('open_playback'):
+            playback = self._open_playback(
+                speech.sample_width, speech.channels, speech.frame_rate)
+
+        # Start after head movement, and insert onsets from then
+        with metrics.span('wait_for_head'):
+            start_t = playback.start(head_t)
+        with metrics.span('schedule_motors'):
+            if speech.timeline is not None:
+                self.add_timeline(speech.timeline, start_t)
+            else:
+                self.insert_onset_motor_events(speech.onsets, start_t=start_t)
+        self.report_time_to_first_sound(request_t, start_t)
+
+        # Play audio a block at a time, so that stop() can interrupt it
+        stop_requested = lambda: self._stop_requested(stop_event)
+        frame_bytes = speech.sample_width * speech.channels
+        block_bytes = max(1, self.stream_block_size // frame_bytes) * frame_bytes
+        stopped = False
+        with metrics.span('write_audio'):
+            for i in range(0, len(speech.pcm_data), block_bytes):
+                if stop_requested():
+                    stopped = True
+                    break
+                playback.write(speech.pcm_data[i:i+block_bytes])
+        if not stopped:
+            with metrics.span('drain'):
+                stopped = not playback.drain(stop_requested)
+
+        # Stop stream on physical audio device, dropping buffered audio if stopped
+        if stopped:
+            playback.cancel()
+        playback.close()
+        self.report_audio_motor_skew(playback)
+
+        if stopped:
+            self._stop_motors()
+            return
+
+        # Pause for a bit after playback
+        self._pause(self.post_speech_pause_sec, stop_event)
+
+    def _pause(self, sec, stop_event=None):
+        """ Sleeps for sec, unless stopped by stop_event (or stop() if None). """
+        (stop_event if stop_event is not None else self.stop_event).wait(sec)
+
+    def _play_chunks(self, speech, head_t, request_t, stop_event=None):
+        """Plays the chunks of a ChunkedSpeech on one playback, so that there
+        is no gap between them as long as each is synthesized before the
+        previous one has played out, and schedules each chunk's mouth
+        movements from the time its first frame is played.
+        """
+        stop_requested = lambda: self._stop_requested(stop_event)
+        playback = None
+        playback_format = None
+        block_sec = 0.05
+        stopped = False
+        try:
+            for i in range(len(speech)):
+                # In callback mode the previous chunk is still playing: keep checking for stop
+                chunk = speech.get(i, stop_requested, block_sec)
+                if chunk is None:
+                    stopped = True
+                    break
+                chunk_format = (chunk.sample_width, chunk.channels, chunk.frame_rate)
+                frame_bytes = chunk.sample_width * chunk.channels
+                block_bytes = max(1, self.stream_block_size // frame_bytes) * frame_bytes
+                block_sec = float(block_bytes) / (frame_bytes * chunk.frame_rate)
+                if chunk_format != playback_format:
+                    # First chunk, or one in another format (e.g. a local engine's channels):
+                    # play out the previous chunks, then reopen, leaving a short gap
+                    if playback is not None:
+                        stopped = not playback.drain(stop_requested)
+                        playback.close()
+                        if stopped:
+                            break
+                        self.num_chunk_gaps += 1
+                        print('speak> gap before chunk %d (format change)' % i)
+                    playback = self._open_playback(*chunk_format)
+                    playback_format = chunk_format
+                    chunk_t = playback.start(head_t)
+                    if i == 0:
+                        self.report_time_to_first_sound(request_t, chunk_t)
+                elif chunk_t + block_sec < playback.earliest_start_t():
+                    # Previous chunk has played out; this one starts late
+                    chunk_t = playback.earliest_start_t()
+                    self.num_chunk_gaps += 1
+                    print('speak> gap before chunk %d' % i)
+
+                self.add_timeline(chunk.timeline, chunk_t)
+                for j in range(0, len(chunk.pcm_data), block_bytes):
+                    if stop_requested():
+                        stopped = True
+                        break
+                    playback.write(chunk.pcm_data[j:j+block_bytes])
+                if stopped:
+                    break
+                chunk_t += chunk.duration_sec
+            if playback is not None and not stopped:
+                stopped = not playback.drain(stop_requested)
+        finally:
+            if playback is not None:
+                if stopped:
+                    playback.cancel()
+                playback.close()
+        if playback is not None:
+            self.report_audio_motor_skew(playback)
+
+        if stopped:
+            self._stop_motors()
+            return
+
+        # Pause for a bit after playback
+        self._pause(self.post_speech_pause_sec, stop_event)
+
+    def _stop_motors(self):
+        print('speak> stopped')
+        self.clear_all_events()
+        self.release_motors()
 
     def speak(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        if self.streaming and not self.chunked and not self.hedging and self.decoded_cache.get(self._cache_key(
+                text, self._resolve_voice(polly_voice_id, aws_region)[0])) is None:
+            return self.speak_streaming(text, polly_voice_id, aws_region)
+
         print('speak> %s' % text)
 
-        if self.args is not None:
-            aws_region = self.args.aws_region or aws_region
-            polly_voice_id = polly_voice_id or self.args.polly_voice_id
+        with self.audio_mutex, metrics.span('speak', text=text):
+            self.stop_event.clear()
+            request_t = monotonic_time()
 
-        with self.audio_mutex:
             # Notify initialization by moving head
             self.clear_all_events()
             t = self.move_head(open=True, release=False)
 
-            # Obtain MP3 stream and compute onsets, or load from cache
-            mp3_stream, onsets = self._tts(text, polly_voice_id, aws_region)
+            speech = self.synthesize(text, polly_voice_id, aws_region)
+            self._play(speech, t, request_t)
 
-            # Load as pydub audio segment
-            sound = pydub.AudioSegment.from_file(
-                io.BytesIO(mp3_stream), format="mp3")
+    def speak_streaming(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        """Variant of speak that plays audio while Polly is still sending it.
+
+        MP3 chunks are decoded by ffmpeg as they arrive, and each PCM block is
+        run through onset detection and has its mouth events scheduled right
+        before it is written to the audio device. In 'pcm' synthesis mode,
+        the speech marks are fetched first and PCM chunks are played as is.
+        """
+        print('speak> %s' % text)
+        polly_voice_id, aws_region = self._resolve_voice(polly_voice_id, aws_region)
+
+        with self.audio_mutex, metrics.span('speak', text=text, streaming=True):
+            self.stop_event.clear()
+            request_t = monotonic_time()
+
+            # Notify initialization by moving head
+            self.clear_all_events()
+            t = self.move_head(open=True, release=False)
+
+            # Start audio download, or load audio stream and onsets from cache
+            is_pcm = self.synthesis_mode == 'pcm'
+            frame_rate = self.pcm_sample_rate if is_pcm else self.audio_sample_rate
+            key = self._cache_key(text, polly_voice_id)
+            cached = self.audio_cache.get(key)
+            metrics.count('pibass_cache_requests_total', cache='tts',
+                          result='miss' if cached is None else 'hit')
+            onset_stream = None
+            timeline = None
+            if cached is not None:
+                audio_stream, onsets = cached[:2]
+                if len(cached) > 2:
+                    timeline = MotorTimeline.from_tuple(cached[2])
+                audio_chunks = [audio_stream]
+            else:
+                onsets = []
+                if is_pcm:
+                    speech_marks = text_to_speech_marks(
+                        text=text, aws_region=aws_region,
+                        polly_voice_id=polly_voice_id,
+                        client=self.polly)
+                    onsets = speech_marks_to_onsets(speech_marks)
+                if len(onsets) <= 0:
+                    onset_stream = self.onset_detector.stream(frame_rate)
+                audio_chunks = text_to_audio_chunks(
+                    text=text, aws_region=aws_region,
+                    polly_voice_id=polly_voice_id,
+                    output_format='pcm' if is_pcm else 'mp3',
+                    sample_rate=frame_rate,
+                    client=self.polly)
+            if is_pcm:
+                decoder = PCMStreamReader(audio_chunks)
+            else:
+                decoder = MP3StreamDecoder(audio_chunks, frame_rate)
 
             # Start stream on physical audio device
-            stream = self.audio_dev.open(
-                format=self.audio_dev.get_format_from_width(
-                    sound.sample_width),
-                channels=sound.channels,
-                rate=sound.frame_rate,
-                output=True)
+            playback = self._open_playback(2, 1, frame_rate)
+
+            stopped = False
+            try:
+                # Wait for first decoded block, then start after head movement
+                pcm = decoder.read(self.stream_block_size)
+                start_t = playback.start(t)
+
+                prev_t = None
+                if timeline is not None:
+                    self.add_timeline(timeline, start_t)
+                    prev_t = start_t + timeline.end_t
+                elif onset_stream is None:
+                    prev_t = self.insert_onset_motor_events(onsets, start_t=start_t)
+                self.report_time_to_first_sound(request_t, start_t)
 
-            # Wait till head movement is done
-            if t > time.time():
-                time.sleep(t - time.time())
+                # Schedule onsets of each block just before playing it
+                while len(pcm) > 0:
+                    if self._stop_requested():
+                        stopped = True
+                        break
+                    if onset_stream is not None:
+                        block_onsets = onset_stream.feed_pcm16(pcm)
+                        onsets.extend(block_onsets)
+                        prev_t = self.insert_onset_motor_events(
+                            block_onsets, start_t=start_t, prev_t=prev_t)
+                    playback.write(pcm)
+                    pcm = decoder.read(self.stream_block_size)
 
-            # Insert onsets and immediately play audio
-            self.insert_onset_motor_events(onsets)
-            stream.write(sound._data)
+                if onset_stream is not None and not stopped:
+                    block_onsets = onset_stream.finish()
+                    onsets.extend(block_onsets)
+                    self.insert_onset_motor_events(
+                        block_onsets, start_t=start_t, prev_t=prev_t)
+                elif cached is None and not stopped:  # speech marks lack end-of-file time
+                    block_onsets = [len(decoder.source_bytes) / 2. / frame_rate]
+                    onsets.extend(block_onsets)
+                    self.insert_onset_motor_events(
+                        block_onsets, start_t=start_t, prev_t=prev_t)
+                if not stopped:
+                    stopped = not playback.drain(self._stop_requested)
 
-            # Stop stream on physical audio device
-            stream.stop_stream()
-            stream.close()
+            finally:
+                # Stop stream on physical audio device, dropping buffered audio if stopped
+                if stopped:
+                    playback.cancel()
+                playback.close()
+                decoder.close()
+            self.report_audio_motor_skew(playback)
+
+            # Audio of an interrupted download is incomplete, so not cached
+            if stopped:
+                self._stop_motors()
+                return
+            if cached is None:
+                self.audio_cache.put(key, (decoder.source_bytes, onsets,
+                                           self.onset_timeline(onsets).to_tuple()))
+                self.save_cache()
 
             # Pause for a bit after playback
-            time.sleep(0.5)
+            self._pause(self.post_speech_pause_sec)
 
 
 def test_pibass_audio():
@@ -149,8 +849,33 @@ def test_pibass_audio():
         '--polly_voice_id', help='AWS Polly Voice ID [Kimberly]', type=str, default='Kimberly')
     parser.add_argument('--mp3_sample_rate',
                         help='MP3 Sample Rate [22050]', type=int, default=22050)
+    parser.add_argument('--streaming', help='Play audio while it is being downloaded',
+                        action='store_true')
+    parser.add_argument('--chunked', help='Synthesize and cache per sentence, playing the first while the rest download',
+                        action='store_true')
+    parser.add_argument('--synthesis_mode', help='Polly output: mp3 (aubio onsets) or pcm (viseme onsets) [mp3]',
+                        type=str, default='mp3', choices=('mp3', 'pcm'))
+    parser.add_argument('--pcm_sample_rate',
+                        help='PCM Sample Rate, 8000 or 16000 [16000]', type=int, default=16000)
+    parser.add_argument('--polly_timeout_sec',
+                        help='Polly read timeout [10]', type=float, default=10.)
+    parser.add_argument('--playback_mode',
+                        help='blocking (device opened per utterance) or callback (kept open, DAC-timed motors) [blocking]',
+                        type=str, default='blocking', choices=('blocking', 'callback'))
+    parser.add_argument('--polly_max_attempts',
+                        help='Polly attempts per request, including retries [3]', type=int, default=3)
+    parser.add_argument('--local_tts', help='Local engine to use when Polly is slow: espeak-ng, espeak or pico',
+                        type=str, default=None)
+    parser.add_argument('--hedge_deadline_sec',
+                        help='Seconds to wait for Polly before using --local_tts', type=float, default=None)
+    parser.add_argument('--metrics_path', help='Write Prometheus metrics to this file on exit',
+                        type=str, default='')
+    parser.add_argument('--trace_path', help='Write a Chrome trace of the last utterance to this file',
+                        type=str, default='')
     args = parser.parse_args()
 
+    if args.metrics_path or args.trace_path:
+        metrics.enable()
     bass = PiBassAudio(args)
     if len(args.text) <= 0:
         try:
@@ -169,6 +894,58 @@ def test_pibass_audio():
         bass.speak(args.text)
         bass.terminate()
 
+    if args.trace_path:
+        metrics.write_chrome_trace(args.trace_path, *(metrics.last_span('speak') or (None, None)))
+    if args.metrics_path:
+        metrics.write_prometheus(args.metrics_path)
+
+
+def bench_onset_motor_events():
+    """ Profiles insert_onset_motor_events and its playback on a SimulatedMotorHAT. """
+    parser = argparse.ArgumentParser(description='Benchmark onset motor event scheduling')
+    parser.add_argument('--duration_sec', help='Simulated utterance duration [10]', type=float, default=10.)
+    parser.add_argument('--onsets_per_sec', help='Onsets per second of audio [6]', type=float, default=6.)
+    parser.add_argument('--trace', help='Export motor trace to .csv or .json', type=str, default='')
+    parser.add_argument('--per_event', help='Push each timeline event onto the heap, for comparison',
+                        action='store_true')
+    args = parser.parse_args()
+
+    hat = SimulatedMotorHAT()
+    bass = PiBassAudio(hat=hat, polly_warm_up=False)
+    bass.lateness_log = []
+    num_onsets = int(args.duration_sec * args.onsets_per_sec)
+    onsets = sorted(random.uniform(0, args.duration_sec) for i in range(num_onsets))
+    onsets.append(args.duration_sec)
+
+    # Warm up, so that importing numpy (see LazyImport) is not timed
+    bass.onset_timeline(onsets)
+
+    insert_start_t = monotonic_time()
+    if args.per_event:
+        start_t = monotonic_time()
+        timeline = bass.onset_timeline(onsets)
+        for i in range(len(timeline)):
+            t, motor, run_arg, speed = timeline.event(i)
+            bass.add_event(MotorEvent(motor, run_arg, speed), start_t + t)
+        end_t = start_t + timeline.end_t
+    else:
+        end_t = bass.insert_onset_motor_events(onsets)
+    insert_sec = monotonic_time() - insert_start_t
+    num_events = len(bass.dump_events())
+    print('inserted %d onsets as %d events in %.3f ms' % (
+        len(onsets), num_events, 1000. * insert_sec))
+
+    time.sleep(max(0., end_t - monotonic_time()) + 0.5)
+    bass.terminate()
+    lateness_ms = [1000. * dt for dt in bass.lateness_log]
+    print('lateness: p50=%.3f ms, p99=%.3f ms' % (
+        percentile(lateness_ms, 50), percentile(lateness_ms, 99)))
+    if args.trace:
+        if args.trace.endswith('.json'):
+            hat.trace.export_json(args.trace)
+        else:
+            hat.trace.export_csv(args.trace)
+
 
 if __name__ == '__main__':
     test_pibass_audio()
@@ -1,22 +1,72 @@
 #!/usr/bin/env python
 
+import argparse
 import atexit
+import collections
 import heapq
+import itertools
+import json
+import os
 import random
 import threading
 import time
 
-from Adafruit_MotorHAT import Adafruit_MotorHAT, Adafruit_DCMotor
+try:
+    from .simulated_hat import SimulatedMotorHAT
+    from .metrics import metrics
+    from .lazy_import import LazyImport, fallback_error
+except (ImportError, ValueError) as err:
+    from simulated_hat import SimulatedMotorHAT
+    from metrics import metrics
+    from lazy_import import LazyImport, fallback_error
+
+# Imported on first use (it initializes I2C/GPIO libraries); not on a Pi:
+# same command constants, simulated HAT instead (see motor_hat)
+Adafruit_MotorHAT = LazyImport('Adafruit_MotorHAT', 'Adafruit_MotorHAT', fallback=SimulatedMotorHAT)
+
+# Clock for all motor event times; immune to wall-clock (NTP) adjustments
+try:
+    monotonic_time = time.monotonic
+except AttributeError:  # Python 2
+    monotonic_time = time.time
+
+
+def motor_hat(addr=0x60):
+    """Adafruit_MotorHAT at I2C address addr; a SimulatedMotorHAT, with a
+    warning, if Adafruit_MotorHAT cannot be imported.
+    """
+    err = fallback_error(Adafruit_MotorHAT)
+    if err is not None:
+        # On a Pi this means a missing driver, and motors that never move
+        print('WARNING: cannot import Adafruit_MotorHAT (%s); simulating the motor HAT' % err)
+    return Adafruit_MotorHAT(addr=addr)
+
+
+def percentile(values, p):
+    """ Returns the p-th percentile (0-100) of values, by nearest rank. """
+    if len(values) <= 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100. * (len(values) - 1))))]
 
 
 class PiBassMotors(object):
-    def __init__(self):
-        self.hat = Adafruit_MotorHAT(addr=0x60)
+    """Head, mouth and tail on motors 1-3 of a motor HAT.
+
+    hat can be any object with Adafruit_MotorHAT's getMotor(num) API, whose
+    motors have setSpeed(speed) and run(command), e.g. SimulatedMotorHAT.
+    """
+    HEAD = 1
+    MOUTH = 2
+    TAIL = 3
+
+    def __init__(self, hat=None):
+        self.hat = hat if hat is not None else motor_hat(0x60)
         self.hat_mutex = threading.Lock()
         with self.hat_mutex:
-            self.head = self.hat.getMotor(1)
-            self.mouth = self.hat.getMotor(2)
-            self.tail = self.hat.getMotor(3)
+            self.head = self.hat.getMotor(self.HEAD)
+            self.mouth = self.hat.getMotor(self.MOUTH)
+            self.tail = self.hat.getMotor(self.TAIL)
 
         atexit.register(self.terminate)
 
@@ -97,150 +147,486 @@ class PiBassMotors(object):
                 motor.run(Adafruit_MotorHAT.RELEASE)
 
 
-class MotorEvent:
+class MotorEvent(object):
+    """Integer-coded motor command: motor number on the HAT (1-4), an
+    Adafruit_MotorHAT run command or NO_RUN_ARG, and a speed (0-255) or
+    NO_SPEED. Holds no reference to HAT objects, so scheduled events can
+    be dumped and replayed (see PiBassAsyncMotors.dump_events).
+    """
+    __slots__ = ('motor', 'run_arg', 'speed')
+    NO_RUN_ARG = 0
+    NO_SPEED = -1
+
     def __init__(self, motor, run_arg=None, speed=None):
         self.motor = motor
-        self.run_arg = run_arg
-        self.speed = speed
-
+        self.run_arg = self.NO_RUN_ARG if run_arg is None else run_arg
+        self.speed = self.NO_SPEED if speed is None else speed
+
+
+def coalesce_motor_events(events):
+    """Merges in-order, integer-coded (motor, run_arg, speed) events into one
+    (motor, speed, run_arg) command per motor, where the last speed and the
+    last run_arg each win, and None means no command.
+    """
+    commands = collections.OrderedDict()
+    for motor, event_run_arg, event_speed in events:
+        speed, run_arg = commands.get(motor, (None, None))
+        if event_speed != MotorEvent.NO_SPEED:
+            speed = event_speed
+        if event_run_arg != MotorEvent.NO_RUN_ARG:
+            run_arg = event_run_arg
+        commands[motor] = (speed, run_arg)
+    return [(motor, speed, run_arg) for motor, (speed, run_arg) in commands.items()]
+
+
+def save_motor_events(path, events):
+    """ Writes (t, motor, run_arg, speed) events, e.g. from dump_events, as JSON. """
+    with open(path, 'w') as fh:
+        json.dump([list(event) for event in events], fh)
+
+
+def load_motor_events(path):
+    with open(path, 'r') as fh:
+        return [tuple(event) for event in json.load(fh)]
+
+
+# Adafruit_PWM.setPWM writes the 4 LEDn registers one byte at a time
+I2C_WRITES_PER_SET_PWM = 4
+
+
+def motor_command_i2c_writes(speed, run_arg):
+    """ Number of I2C writes Adafruit_DCMotor.setSpeed + run would issue. """
+    num_set_pwm = (1 if speed is not None else 0) + (2 if run_arg is not None else 0)
+    return I2C_WRITES_PER_SET_PWM * num_set_pwm
+
+
+class MotorHATBatchWriter(object):
+    """Writes several DC motor commands to the HAT's PCA9685 with as few
+    I2C block writes as possible, instead of one byte per register.
+
+    Uses Adafruit_MotorHAT internals: the PWM driver's I2C device and each
+    Adafruit_DCMotor's PWMpin/IN1pin/IN2pin channel numbers.
+    """
+    MODE1 = 0x00
+    MODE1_AI = 0x20  # register auto-increment
+    LED0_ON_L = 0x06
+    MAX_BLOCK_CHANNELS = 8  # SMBus block writes are limited to 32 bytes
+
+    # (ON, OFF) counts for a channel that is fully off / fully on, as in Adafruit_MotorHAT.setPin
+    PIN_LOW = (0, 4096)
+    PIN_HIGH = (4096, 0)
+
+    def __init__(self, hat):
+        self.i2c = hat._pwm.i2c
+        self.i2c.write8(self.MODE1, self.i2c.readU8(self.MODE1) | self.MODE1_AI)
+        self.run_pins = {
+            Adafruit_MotorHAT.FORWARD: (self.PIN_HIGH, self.PIN_LOW),
+            Adafruit_MotorHAT.BACKWARD: (self.PIN_LOW, self.PIN_HIGH),
+            Adafruit_MotorHAT.RELEASE: (self.PIN_LOW, self.PIN_LOW),
+        }
+
+    def write(self, commands):
+        """ Applies (motor, speed, run_arg) commands; returns number of I2C writes. """
+        channels = {}
+        for motor, speed, run_arg in commands:
+            if speed is not None:
+                channels[motor.PWMpin] = (0, max(0, min(speed, 255)) * 16)
+            if run_arg in self.run_pins:
+                channels[motor.IN1pin], channels[motor.IN2pin] = self.run_pins[run_arg]
+
+        # One block write per run of consecutive channels
+        num_writes = 0
+        pins = sorted(channels)
+        i = 0
+        while i < len(pins):
+            j = i + 1
+            while j < len(pins) and pins[j] == pins[j-1] + 1 and j - i < self.MAX_BLOCK_CHANNELS:
+                j += 1
+            data = []
+            for pin in pins[i:j]:
+                on, off = channels[pin]
+                data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+            self.i2c.writeList(self.LED0_ON_L + 4*pins[i], data)
+            num_writes += 1
+            i = j
+        return num_writes
+
+
+class MotorScheduler(object):
+    """Fires MotorEvents and MotorTimelines on a background thread, for one
+    or more PiBassAsyncMotors (e.g. one per fish) sharing that thread.
+
+    The event thread sleeps on a condition variable until the earliest
+    event is due, and is woken up when an earlier event is added. Single
+    events are kept in a heap, while each timeline is already sorted and is
+    read through its own cursor. All events due at once are coalesced per
+    motor and sent to each owner's HAT in a single batch. Event times are in
+    monotonic_time() seconds.
+
+    Each registered owner gets a motor_base, and its motor n is scheduled
+    under the id motor_base + n.
+    """
+    MOTORS_PER_HAT = 4
 
-class PiBassAsyncMotors(PiBassMotors):
     def __init__(self):
-        self.events = []
+        self.events = []  # heap of (t, seq, motor_id, run_arg, speed), coded as in MotorEvent
+        self.timelines = []  # [timeline, start_t, cursor, motor_base]
         self.events_mutex = threading.Lock()
-        self.event_loop_active = False
+        self.events_cv = threading.Condition(self.events_mutex)
+        self.event_seq = itertools.count()  # keeps push order among equal times
+        self.event_loop_active = True
+        self.lateness_log = None  # set to a list to record (fire - scheduled) times
+        self.owners = []
         self.event_thread = threading.Thread(target=self.event_loop)
-        super(PiBassAsyncMotors, self).__init__()
         self.event_thread.start()
 
+    def register(self, owner):
+        """ Adds a PiBassAsyncMotors; returns its motor_base. """
+        with self.events_mutex:
+            self.owners.append(owner)
+            return (len(self.owners) - 1) * self.MOTORS_PER_HAT
+
     def terminate(self):
-        self.event_loop_active = False
+        with self.events_cv:
+            self.event_loop_active = False
+            self.events_cv.notify()
         if self.event_thread is not None:
             self.event_thread.join()
             self.event_thread = None
-        super(PiBassAsyncMotors, self).terminate()
 
-    def clear_all_events(self):
+    def _owns(self, motor_id, motor_base):
+        return motor_base is None or motor_base < motor_id <= motor_base + self.MOTORS_PER_HAT
+
+    def clear(self, motor_base=None):
+        """ Drops pending events of one owner, or of all owners if motor_base is None. """
         with self.events_mutex:
-            del self.events[:]
+            self.events = [entry for entry in self.events if not self._owns(entry[2], motor_base)]
+            heapq.heapify(self.events)
+            self.timelines = [entry for entry in self.timelines
+                              if motor_base is not None and entry[3] != motor_base]
 
-    def add_event(self, event, t=time.time()):
+    def last_event_time(self, motor_base=None):
         with self.events_mutex:
-            heapq.heappush(self.events, (t, event))
+            times = [entry[0] for entry in self.events if self._owns(entry[2], motor_base)]
+            times.extend(start_t + timeline.t[-1] for timeline, start_t, cursor, base in self.timelines
+                         if motor_base is None or base == motor_base)
+            return max(times) if len(times) > 0 else None
+
+    def push(self, t, motor_id, run_arg, speed):
+        seq = next(self.event_seq)
+        with self.events_cv:
+            heapq.heappush(self.events, (t, seq, motor_id, run_arg, speed))
+            if self.events[0][1] == seq:  # new earliest deadline
+                self.events_cv.notify()
+
+    def add_timeline(self, timeline, start_t, motor_base=0):
+        with self.events_cv:
+            next_t = self._next_event_time()
+            self.timelines.append([timeline, start_t, 0, motor_base])
+            if next_t is None or start_t + timeline.t[0] < next_t:
+                self.events_cv.notify()
+
+    def dump(self, motor_base=0):
+        """ Pending events of one owner, as time-ordered (t, motor, run_arg, speed). """
+        with self.events_mutex:
+            events = [(t, motor_id - motor_base, run_arg, speed)
+                      for t, seq, motor_id, run_arg, speed in sorted(self.events)
+                      if self._owns(motor_id, motor_base)]
+            for timeline, start_t, cursor, base in self.timelines:
+                if base == motor_base:
+                    events.extend((start_t + timeline.t[i], timeline.motor[i],
+                                   timeline.run_arg[i], timeline.speed[i])
+                                  for i in range(cursor, len(timeline)))
+        events.sort(key=lambda event: event[0])
+        return events
+
+    def replay(self, events, start_t, motor_base=0):
+        if len(events) <= 0:
+            return
+        dt = start_t - events[0][0]
+        with self.events_cv:
+            for t, motor, run_arg, speed in events:
+                heapq.heappush(self.events, (t + dt, next(self.event_seq), motor_base + motor, run_arg, speed))
+            self.events_cv.notify()
+
+    def _next_event_time(self):
+        """ Earliest scheduled event time, or None; caller holds events_mutex. """
+        times = [entry[1] + entry[0].t[entry[2]] for entry in self.timelines]
+        if len(self.events) > 0:
+            times.append(self.events[0][0])
+        return min(times) if len(times) > 0 else None
+
+    def _wait_for_due_events(self):
+        """Blocks until events are due and pops all of them, as time-ordered
+        (t, motor_id, run_arg, speed) tuples coded as in MotorEvent; returns
+        None on terminate.
+        """
+        with self.events_cv:
+            while self.event_loop_active:
+                next_t = self._next_event_time()
+                if next_t is None:
+                    self.events_cv.wait()
+                    continue
+                now = monotonic_time()
+                timeout = next_t - now
+                if timeout > 0:
+                    self.events_cv.wait(timeout)
+                    continue
+                due = []
+                while len(self.events) > 0 and self.events[0][0] <= now:
+                    entry = heapq.heappop(self.events)
+                    due.append(entry[:1] + entry[2:])
+                num_sources = 1 if len(due) > 0 else 0
+                for entry in self.timelines:
+                    timeline, start_t, cursor, motor_base = entry
+                    if start_t + timeline.t[cursor] > now:
+                        continue
+                    num_sources += 1
+                    while cursor < len(timeline) and start_t + timeline.t[cursor] <= now:
+                        due.append((start_t + timeline.t[cursor], motor_base + timeline.motor[cursor],
+                                    timeline.run_arg[cursor], timeline.speed[cursor]))
+                        cursor += 1
+                    entry[2] = cursor
+                self.timelines = [entry for entry in self.timelines if entry[2] < len(entry[0])]
+                if num_sources > 1:  # merge by time; sort is stable
+                    due.sort(key=lambda event: event[0])
+                return due
+        return None
 
     def event_loop(self):
-        self.event_loop_active = True
-
-        while self.event_loop_active:
-            now = time.time()
-            # if has time-expired event
-            if len(self.events) > 0 and self.events[0][0] <= now:
-                with self.events_mutex:
-                    event_t, event = heapq.heappop(self.events)
-                with self.hat_mutex:
-                    if event.speed is not None:
-                        event.motor.setSpeed(event.speed)
-                    if event.run_arg is not None:
-                        event.motor.run(event.run_arg)
-                continue
-
-            else:  # did not process any events
-                time.sleep(0.001)
+        while True:
+            due = self._wait_for_due_events()
+            if due is None:
+                break
+
+            # Split by owner, with motor numbers local to its HAT
+            owner_due = collections.OrderedDict()
+            for event_t, motor_id, run_arg, speed in due:
+                index = (motor_id - 1) // self.MOTORS_PER_HAT
+                owner_due.setdefault(index, []).append(
+                    (event_t, motor_id - index * self.MOTORS_PER_HAT, run_arg, speed))
+            with metrics.span('motor_batch', events=len(due)):
+                for index, events in owner_due.items():
+                    self.owners[index].write_due_events(events, self.lateness_log)
 
         self.event_loop_active = False
 
+
+class PiBassAsyncMotors(PiBassMotors):
+    """Schedules MotorEvents and MotorTimelines, fired by a MotorScheduler.
+
+    By default each instance runs its own scheduler thread; pass the same
+    scheduler to several instances (one per HAT) to share one thread.
+    """
+
+    def __init__(self, hat=None, scheduler=None):
+        self.owns_scheduler = scheduler is None
+        self.scheduler = scheduler if scheduler is not None else MotorScheduler()
+        super(PiBassAsyncMotors, self).__init__(hat)
+        self.motors = {self.HEAD: self.head, self.MOUTH: self.mouth, self.TAIL: self.tail}
+
+        try:
+            self.hat_writer = MotorHATBatchWriter(self.hat)
+        except (AttributeError, IOError, OSError):
+            self.hat_writer = None  # apply commands through setSpeed/run
+        self.num_motor_events = 0
+        self.num_i2c_writes = 0
+        self.num_i2c_writes_saved = 0
+
+        self.motor_base = self.scheduler.register(self)
+
+    @property
+    def lateness_log(self):
+        return self.scheduler.lateness_log
+
+    @lateness_log.setter
+    def lateness_log(self, value):
+        self.scheduler.lateness_log = value
+
+    def terminate(self):
+        if self.owns_scheduler:
+            self.scheduler.terminate()
+        else:
+            self.clear_all_events()
+        super(PiBassAsyncMotors, self).terminate()
+
+    def clear_all_events(self):
+        self.scheduler.clear(self.motor_base)
+
+    def last_event_time(self):
+        """ Time of the latest scheduled event, or None if there are none. """
+        return self.scheduler.last_event_time(self.motor_base)
+
+    def release_motors(self, t=None):
+        """ Stops and releases head, mouth and tail at t (defaults to now). """
+        for motor in (self.HEAD, self.MOUTH, self.TAIL):
+            self.push_event(t, motor, Adafruit_MotorHAT.RELEASE, 0)
+
+    def add_event(self, event, t=None):
+        self.push_event(t, event.motor, event.run_arg, event.speed)
+
+    def push_event(self, t, motor, run_arg=MotorEvent.NO_RUN_ARG, speed=MotorEvent.NO_SPEED):
+        """ Schedules an integer-coded event, without allocating a MotorEvent. """
+        if t is None:
+            t = monotonic_time()
+        self.scheduler.push(t, self.motor_base + motor, run_arg, speed)
+
+    def add_timeline(self, timeline, start_t=None):
+        """ Schedules a MotorTimeline, whose times are relative to start_t. """
+        if len(timeline) <= 0:
+            return
+        if start_t is None:
+            start_t = monotonic_time()
+        self.scheduler.add_timeline(timeline, start_t, self.motor_base)
+
+    def dump_events(self):
+        """Returns all pending events, including those of timelines, as
+        time-ordered (t, motor, run_arg, speed) tuples coded as in MotorEvent.
+        """
+        return self.scheduler.dump(self.motor_base)
+
+    def replay_events(self, events, start_t=None):
+        """ Schedules dumped events, shifted so that the first is at start_t (defaults to now). """
+        if start_t is None:
+            start_t = monotonic_time()
+        self.scheduler.replay(events, start_t, self.motor_base)
+
+    def get_motor(self, motor):
+        """ HAT motor object for a motor number. """
+        if motor not in self.motors:
+            self.motors[motor] = self.hat.getMotor(motor)
+        return self.motors[motor]
+
+    def write_motor_commands(self, commands):
+        """ Sends coalesced (motor, speed, run_arg) commands; caller holds hat_mutex. """
+        if self.hat_writer is not None:
+            return self.hat_writer.write(commands)
+        for motor, speed, run_arg in commands:
+            if speed is not None:
+                motor.setSpeed(speed)
+            if run_arg is not None:
+                motor.run(run_arg)
+        return sum(motor_command_i2c_writes(speed, run_arg)
+                   for motor, speed, run_arg in commands)
+
+    def write_due_events(self, due, lateness_log=None):
+        """ Called on the scheduler thread with due (t, motor, run_arg, speed) events of this HAT. """
+        commands = [(self.get_motor(motor), speed, run_arg) for motor, speed, run_arg in
+                    coalesce_motor_events((motor, run_arg, speed)
+                                          for event_t, motor, run_arg, speed in due)]
+        with self.hat_mutex:
+            if lateness_log is not None or metrics.enabled:
+                now = monotonic_time()
+                lateness = [now - event_t for event_t, motor, run_arg, speed in due]
+                if lateness_log is not None:
+                    lateness_log.extend(lateness)
+                metrics.observe_many('pibass_motor_lateness_seconds', lateness)
+            num_writes = self.write_motor_commands(commands)
+        num_writes_saved = sum(
+            motor_command_i2c_writes(
+                None if speed == MotorEvent.NO_SPEED else speed,
+                None if run_arg == MotorEvent.NO_RUN_ARG else run_arg)
+            for event_t, motor, run_arg, speed in due) - num_writes
+        self.num_motor_events += len(due)
+        self.num_i2c_writes += num_writes
+        self.num_i2c_writes_saved += num_writes_saved
+        if metrics.enabled:
+            metrics.count('pibass_motor_events_total', len(due))
+            metrics.count('pibass_i2c_writes_total', num_writes)
+            metrics.count('pibass_i2c_writes_saved_total', num_writes_saved)
+
     def test_motor(self, motor, delay=0.3, speed=255, loop=3, reverse_first=False, t=None):
+        """ motor is a motor number, or one of head/mouth/tail. """
         if t is None:
-            t = time.time()
+            t = monotonic_time()
+        for motor_num, hat_motor in self.motors.items():
+            if motor is hat_motor:
+                motor = motor_num
 
         for i in range(loop):
             move_dir = Adafruit_MotorHAT.BACKWARD if reverse_first else Adafruit_MotorHAT.FORWARD
-            self.add_event(MotorEvent(motor, move_dir, speed), t)
+            self.push_event(t, motor, move_dir, speed)
             t += delay
-            self.add_event(MotorEvent(motor, None, 0), t)
+            self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
 
             t += delay
 
             move_dir = Adafruit_MotorHAT.FORWARD if reverse_first else Adafruit_MotorHAT.BACKWARD
-            self.add_event(MotorEvent(motor, move_dir, speed), t)
+            self.push_event(t, motor, move_dir, speed)
             t += delay
-            self.add_event(MotorEvent(motor, None, 0), t)
+            self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
 
             t += delay
 
-            self.add_event(MotorEvent(
-                motor, Adafruit_MotorHAT.RELEASE, None), t)
+            self.push_event(t, motor, Adafruit_MotorHAT.RELEASE, MotorEvent.NO_SPEED)
 
             return t
 
     def move_head(self, speed=255, delay_move=0.3, open=True, release=True, t=None):
         if t is None:
-            t = time.time()
-        motor = self.head
+            t = monotonic_time()
+        motor = self.HEAD
         direction = Adafruit_MotorHAT.BACKWARD if open else Adafruit_MotorHAT.FORWARD
-        self.add_event(MotorEvent(motor, direction, speed), t)
+        self.push_event(t, motor, direction, speed)
         t += delay_move
-        self.add_event(MotorEvent(motor, None, 0), t)
+        self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
         if release:
-            self.add_event(MotorEvent(
-                motor, Adafruit_MotorHAT.RELEASE, None), t)
+            self.push_event(t, motor, Adafruit_MotorHAT.RELEASE, MotorEvent.NO_SPEED)
         return t
 
     def move_mouth(self, speed=255, delay_move=0.12, delay_open=0.15, release=True, t=None):
         if t is None:
-            t = time.time()
-        motor = self.mouth
-        self.add_event(MotorEvent(motor, Adafruit_MotorHAT.FORWARD, speed), t)
+            t = monotonic_time()
+        motor = self.MOUTH
+        self.push_event(t, motor, Adafruit_MotorHAT.FORWARD, speed)
         t += delay_move
-        self.add_event(MotorEvent(motor, None, 0), t)
+        self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
         t += delay_open
-        self.add_event(MotorEvent(motor, Adafruit_MotorHAT.BACKWARD, speed), t)
+        self.push_event(t, motor, Adafruit_MotorHAT.BACKWARD, speed)
         t += delay_move
-        self.add_event(MotorEvent(motor, None, 0), t)
+        self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
         if release:
-            self.add_event(MotorEvent(
-                motor, Adafruit_MotorHAT.RELEASE, None), t)
+            self.push_event(t, motor, Adafruit_MotorHAT.RELEASE, MotorEvent.NO_SPEED)
         return t
 
     def move_tail(self, speed=255, delay_move=0.12, delay_open=0.1, release=True, t=None):
         if t is None:
-            t = time.time()
-        motor = self.tail
-        self.add_event(MotorEvent(motor, Adafruit_MotorHAT.FORWARD, speed), t)
+            t = monotonic_time()
+        motor = self.TAIL
+        self.push_event(t, motor, Adafruit_MotorHAT.FORWARD, speed)
         t += delay_move
-        self.add_event(MotorEvent(motor, None, 0), t)
+        self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
         t += delay_open
-        self.add_event(MotorEvent(motor, Adafruit_MotorHAT.BACKWARD, speed), t)
+        self.push_event(t, motor, Adafruit_MotorHAT.BACKWARD, speed)
         t += delay_move
-        self.add_event(MotorEvent(motor, None, 0), t)
+        self.push_event(t, motor, MotorEvent.NO_RUN_ARG, 0)
         if release:
-            self.add_event(MotorEvent(
-                motor, Adafruit_MotorHAT.RELEASE, None), t)
+            self.push_event(t, motor, Adafruit_MotorHAT.RELEASE, MotorEvent.NO_SPEED)
         return t
 
 
-def test_pibass_motors(async=True):
-    bass = PiBassAsyncMotors() if async else PiBassMotors()
+def test_pibass_motors(use_async=True):
+    bass = PiBassAsyncMotors() if use_async else PiBassMotors()
     test_head = True
     test_mouth = True
     test_tail = True
 
     if test_head:
         t = bass.move_head(open=True, release=False)
-        if async:
-            time.sleep(t-time.time())
+        if use_async:
+            time.sleep(t-monotonic_time())
         time.sleep(0.5)
         t = bass.move_head(open=False, release=False)
-        if async:
-            time.sleep(t-time.time())
+        if use_async:
+            time.sleep(t-monotonic_time())
         time.sleep(1)
 
     if test_mouth:
         for i in range(5):
             t = bass.move_mouth(delay_open=random.uniform(
                 0.05, 0.15), release=False)
-            if async:
-                time.sleep(t-time.time())
+            if use_async:
+                time.sleep(t-monotonic_time())
             time.sleep(random.uniform(0.025, 0.15))
         time.sleep(1)
 
@@ -248,8 +634,8 @@ def test_pibass_motors(async=True):
         for i in range(5):
             t = bass.move_tail(delay_open=random.uniform(
                 0.05, 0.2), release=False)
-            if async:
-                time.sleep(t-time.time())
+            if use_async:
+                time.sleep(t-monotonic_time())
             time.sleep(random.uniform(0.025, 0.15))
         time.sleep(1)
 
@@ -260,5 +646,67 @@ def test_pibass_motors(async=True):
     bass.terminate()
 
 
+def bench_event_loop():
+    """Reports idle CPU use of the event thread, and the lateness of events
+    fired against their scheduled times. Events target the unused motor 4.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark PiBassAsyncMotors event loop')
+    parser.add_argument('--idle_sec', help='Idle measurement duration [5]', type=float, default=5.)
+    parser.add_argument('--num_events', help='Number of scheduled events [2000]', type=int, default=2000)
+    parser.add_argument('--span_sec', help='Time span over which events are scheduled [10]', type=float, default=10.)
+    parser.add_argument('--simulate', help='Use SimulatedMotorHAT instead of the real HAT', action='store_true')
+    parser.add_argument('--i2c_latency_ms', help='Simulated I2C latency per call [0.]', type=float, default=0.)
+    parser.add_argument('--trace', help='Export simulated motor trace to .csv or .json', type=str, default='')
+    parser.add_argument('--dump', help='Save the scheduled events to this .json file', type=str, default='')
+    parser.add_argument('--replay', help='Schedule events from a --dump file instead of random ones',
+                        type=str, default='')
+    args = parser.parse_args()
+
+    hat = SimulatedMotorHAT(write_latency_sec=args.i2c_latency_ms/1000.) if args.simulate else None
+    bass = PiBassAsyncMotors(hat)
+    bass.lateness_log = []
+
+    # Idle CPU: process time spent while the heap is empty
+    cpu_start, wall_start = sum(os.times()[:2]), monotonic_time()
+    time.sleep(args.idle_sec)
+    cpu_idle = (sum(os.times()[:2]) - cpu_start) / (monotonic_time() - wall_start)
+    print('idle CPU: %.2f%%' % (100. * cpu_idle))
+
+    # Lateness: events at random times, pushed in random order
+    t0 = monotonic_time() + 0.1
+    push_start_t = monotonic_time()
+    if args.replay:
+        events = load_motor_events(args.replay)
+        bass.replay_events(events, t0)
+        num_events = len(events)
+        span_sec = events[-1][0] - events[0][0] if num_events > 0 else 0.
+    else:
+        for i in range(args.num_events):
+            bass.push_event(t0 + random.uniform(0, args.span_sec), 4, Adafruit_MotorHAT.RELEASE, 0)
+        num_events, span_sec = args.num_events, args.span_sec
+    push_sec = monotonic_time() - push_start_t
+    print('scheduled %d events in %.3f ms (%.2f us/event)' % (
+        num_events, 1000. * push_sec, 1e6 * push_sec / max(num_events, 1)))
+    if args.dump:
+        save_motor_events(args.dump, bass.dump_events())
+    time.sleep(span_sec + 0.6)
+    bass.terminate()
+
+    lateness_ms = [1000. * dt for dt in bass.lateness_log]
+    print('fired %d/%d events, lateness: p50=%.3f ms, p99=%.3f ms, max=%.3f ms' % (
+        len(lateness_ms), num_events,
+        percentile(lateness_ms, 50), percentile(lateness_ms, 99),
+        max(lateness_ms) if lateness_ms else float('nan')))
+    print('I2C writes: %d, saved by coalescing: %d' % (
+        bass.num_i2c_writes, bass.num_i2c_writes_saved))
+
+    if args.simulate and args.trace:
+        if args.trace.endswith('.json'):
+            hat.trace.export_json(args.trace)
+        else:
+            hat.trace.export_csv(args.trace)
+        print('wrote %d motor calls to %s' % (len(hat.trace), args.trace))
+
+
 if __name__ == '__main__':
     test_pibass_motors()
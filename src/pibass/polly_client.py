@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import json
+import threading
+import traceback
+
+try:
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+boto3 = LazyImport('boto3')
+botocore = LazyImport('botocore')
+
+
+class PollySynthesisClient(object):
+    """Long-lived Polly clients, one per region.
+
+    Creating a boto3 client is slow on a Pi, and each client keeps its own
+    pool of keep-alive HTTPS connections, so clients are created once and
+    shared across threads (boto3 clients are thread-safe once created).
+
+    endpoint_url and session let tests point the client at a local stub
+    (see polly_stub.py).
+    """
+
+    def __init__(self,
+                 connect_timeout_sec=5,
+                 read_timeout_sec=10,
+                 max_attempts=3,
+                 max_pool_connections=10,
+                 endpoint_url=None,
+                 session=None):
+        self.config = botocore.config.Config(
+            connect_timeout=connect_timeout_sec,
+            read_timeout=read_timeout_sec,
+            retries={'max_attempts': max_attempts},
+            max_pool_connections=max_pool_connections)
+        self.endpoint_url = endpoint_url
+        self.session = session or boto3.session.Session()
+        self.clients = {}
+        self.clients_mutex = threading.Lock()
+
+    def client(self, aws_region='us-east-1'):
+        with self.clients_mutex:
+            if aws_region not in self.clients:
+                self.clients[aws_region] = self.session.client(
+                    'polly', aws_region,
+                    config=self.config,
+                    endpoint_url=self.endpoint_url)
+            return self.clients[aws_region]
+
+    def warm_up(self, aws_regions=('us-east-1',), background=True):
+        """Creates clients and opens a connection to each region ahead of the
+        first synthesis request.
+        """
+        def _warm_up():
+            for aws_region in aws_regions:
+                try:
+                    self.client(aws_region).describe_voices(LanguageCode='en-US')
+                except Exception:
+                    traceback.print_exc()
+
+        if not background:
+            _warm_up()
+            return None
+        thread = threading.Thread(target=_warm_up)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def audio_chunks(self, text, aws_region='us-east-1', polly_voice_id='Kimberly',
+                     output_format='mp3', sample_rate=22050, chunk_size=4096):
+        """Generator yielding Polly audio bytes ('mp3' or 'pcm') as they are downloaded."""
+        response = self.client(aws_region).synthesize_speech(
+            Text=text,
+            OutputFormat=output_format,
+            SampleRate=str(sample_rate),
+            TextType='text',
+            VoiceId=polly_voice_id)
+        # For more voices, see: http://boto3.readthedocs.io/en/latest/reference/services/polly.html#Polly.Client.synthesize_speech
+        # or http://docs.aws.amazon.com/polly/latest/dg/API_Voice.html
+
+        stream = response["AudioStream"]
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+    def speech_marks(self, text, aws_region='us-east-1', polly_voice_id='Kimberly',
+                     speech_mark_types=('viseme', 'word')):
+        """ Returns list of Polly speech mark dicts, e.g. {'time': 125, 'type': 'viseme', 'value': 'a'}. """
+        response = self.client(aws_region).synthesize_speech(
+            Text=text,
+            OutputFormat='json',
+            SpeechMarkTypes=list(speech_mark_types),
+            TextType='text',
+            VoiceId=polly_voice_id)
+
+        stream = response["AudioStream"]
+        marks_bytes = stream.read()
+        stream.close()
+        return [json.loads(line) for line in marks_bytes.decode('utf-8').splitlines() if line.strip()]
+
+
+_default_client = None
+_default_client_mutex = threading.Lock()
+
+
+def get_default_polly_client():
+    """ Shared PollySynthesisClient for callers that do not own one. """
+    global _default_client
+    with _default_client_mutex:
+        if _default_client is None:
+            _default_client = PollySynthesisClient()
+        return _default_client
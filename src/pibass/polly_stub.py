@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import argparse
+import array
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from .polly_client import PollySynthesisClient
+    from .pibass_motors import monotonic_time, percentile
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from polly_client import PollySynthesisClient
+    from pibass_motors import monotonic_time, percentile
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+boto3 = LazyImport('boto3')
+
+
+STUB_MP3_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'this_is_a_test.mp3')
+STUB_SEC_PER_CHAR = 0.06
+VOWELS = 'aeiou'
+
+
+def stub_pcm(text, sample_rate):
+    """ 16-bit PCM with a tone burst per vowel and silence otherwise. """
+    samples_per_char = int(STUB_SEC_PER_CHAR * sample_rate)
+    pcm = array.array('h')
+    for c in text.lower():
+        if c in VOWELS:
+            pcm.extend(int(8000 * math.sin(2 * math.pi * 200 * i / sample_rate))
+                       for i in range(samples_per_char))
+        else:
+            pcm.extend([0] * samples_per_char)
+    return pcm.tobytes() if hasattr(pcm, 'tobytes') else pcm.tostring()
+
+
+def stub_speech_marks(text, speech_mark_types):
+    """ Word and viseme marks consistent with stub_pcm timing. """
+    marks = []
+    word_start = True
+    for i, c in enumerate(text):
+        t = int(1000 * i * STUB_SEC_PER_CHAR)
+        if c.isspace():
+            word_start = True
+            continue
+        if word_start and 'word' in speech_mark_types:
+            marks.append({'time': t, 'type': 'word', 'start': i, 'end': i + 1, 'value': c})
+        word_start = False
+        if 'viseme' in speech_mark_types:
+            marks.append({'time': t, 'type': 'viseme', 'value': 'a' if c.lower() in VOWELS else 'p'})
+    return b''.join(json.dumps(m).encode('utf-8') + b'\n' for m in marks)
+
+
+class PollyStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real endpoint
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):  # DescribeVoices
+        body = json.dumps({'Voices': [{
+            'Gender': 'Female', 'Id': 'Kimberly', 'LanguageCode': 'en-US',
+            'LanguageName': 'US English', 'Name': 'Kimberly'}]}).encode('utf-8')
+        self._respond(body, 'application/json', latency_sec=0.)
+
+    def do_POST(self):  # SynthesizeSpeech
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length).decode('utf-8'))
+        text = request.get('Text', '')
+        output_format = request.get('OutputFormat', 'mp3')
+        if output_format == 'json':
+            body = stub_speech_marks(text, request.get('SpeechMarkTypes', []))
+            content_type = 'application/x-json-stream'
+        elif output_format == 'pcm':
+            body = stub_pcm(text, int(request.get('SampleRate', 16000)))
+            content_type = 'audio/pcm'
+        else:
+            with open(STUB_MP3_PATH, 'rb') as fh:
+                body = fh.read()
+            content_type = 'audio/mpeg'
+        self._respond(body, content_type, self.server.latency_sec,
+                      {'x-amzn-RequestCharacters': str(len(text))})
+
+    def _respond(self, body, content_type, latency_sec, headers={}):
+        self.server.num_requests += 1
+        if latency_sec > 0:
+            time.sleep(latency_sec)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        # Trickle the body out at the configured rate
+        chunk_size = 4096
+        for i in range(0, len(body), chunk_size):
+            self.wfile.write(body[i:i+chunk_size])
+            if self.server.bytes_per_sec > 0:
+                time.sleep(float(chunk_size) / self.server.bytes_per_sec)
+
+
+class PollyStubServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP server speaking enough of Polly's REST API (SynthesizeSpeech
+    and DescribeVoices) to measure synthesis latency and throughput offline.
+
+    latency_sec delays each response, and bytes_per_sec limits its download rate.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_sec=0.05, bytes_per_sec=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), PollyStubHandler)
+        self.latency_sec = latency_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.num_requests = 0
+        self.thread = None
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def stub_session():
+    """ boto3 session with dummy credentials; the stub does not check signatures. """
+    return boto3.session.Session(
+        aws_access_key_id='stub', aws_secret_access_key='stub', region_name='us-east-1')
+
+
+def stub_polly_client(server, **kwargs):
+    return PollySynthesisClient(endpoint_url=server.endpoint_url, session=stub_session(), **kwargs)
+
+
+def bench_polly_client():
+    """ Compares a fresh boto3 client per request against a shared PollySynthesisClient. """
+    parser = argparse.ArgumentParser(description='Benchmark Polly client against a local stub')
+    parser.add_argument('--num_requests', help='Requests per run [50]', type=int, default=50)
+    parser.add_argument('--concurrency', help='Concurrent requesting threads [1]', type=int, default=1)
+    parser.add_argument('--latency_ms', help='Stub response latency [50]', type=float, default=50.)
+    parser.add_argument('--output_format', help='mp3 or pcm [mp3]', type=str, default='mp3')
+    args = parser.parse_args()
+
+    server = PollyStubServer(latency_sec=args.latency_ms / 1000.).start()
+    text = 'This is a test of the pibass speech synthesis client.'
+    sample_rate = 16000 if args.output_format == 'pcm' else 22050
+
+    def run(name, get_client):
+        latencies = []
+        mutex = threading.Lock()
+
+        def worker(num_requests):
+            for i in range(num_requests):
+                start_t = monotonic_time()
+                client = get_client()
+                b''.join(client.audio_chunks(text, output_format=args.output_format,
+                                             sample_rate=sample_rate))
+                with mutex:
+                    latencies.append(monotonic_time() - start_t)
+
+        start_t = monotonic_time()
+        threads = [threading.Thread(target=worker, args=(args.num_requests // args.concurrency,))
+                   for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total_sec = monotonic_time() - start_t
+        latencies_ms = [1000. * dt for dt in latencies]
+        print('%s: %.1f req/s, latency p50=%.1f ms, p99=%.1f ms' % (
+            name, len(latencies) / total_sec,
+            percentile(latencies_ms, 50), percentile(latencies_ms, 99)))
+
+    run('client per request', lambda: stub_polly_client(server))
+    shared_client = stub_polly_client(server)
+    shared_client.warm_up(background=False)
+    run('shared client', lambda: shared_client)
+    server.stop()
+
+
+if __name__ == '__main__':
+    bench_polly_client()
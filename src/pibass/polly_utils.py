@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import json
+
 # Inventory of Amazon polly voices
 # From: https://us-west-2.console.aws.amazon.com/polly/home/SynthesizeSpeech
 voice_db = [
@@ -57,6 +59,73 @@ voice_db = [
     ('Gwyneth', 'female', 'cy')]
 
 
+# Indexes over voice_db, rebuilt by set_voice_db:
+# - voice name (lowercase) -> entry
+# - (language code prefix, gender) -> first matching entry
+# - language code prefix -> first matching entry
+_voice_by_name = {}
+_voice_by_lang_gender = {}
+_voice_by_lang = {}
+
+# Memoized resolve_voice results
+_resolved_voices = {}
+_RESOLVED_VOICES_LIMIT = 1024
+
+
+def set_voice_db(voices):
+    """ Replaces the voice inventory with a list of (polly_name, gender, language_code). """
+    global _voice_by_name, _voice_by_lang_gender, _voice_by_lang
+    by_name, by_lang_gender, by_lang = {}, {}, {}
+    for entry in voices:
+        v, g, l = entry
+        by_name.setdefault(v.lower(), entry)
+        for i in range(len(l) + 1):
+            by_lang_gender.setdefault((l[:i], g), entry)
+            by_lang.setdefault(l[:i], entry)
+    voice_db[:] = list(voices)  # in place, for modules that imported voice_db
+    _voice_by_name, _voice_by_lang_gender, _voice_by_lang = by_name, by_lang_gender, by_lang
+    _resolved_voices.clear()
+
+
+def load_voice_db(path, replace=False):
+    """Loads voices from the JSON output of Polly describe_voices, e.g. saved by
+    `aws polly describe-voices > voices.json` or fetch_voice_db.
+
+    Unless replace is set, new voices are appended after the built-in ones,
+    so that the built-in per-language defaults are kept.
+    """
+    with open(path, 'r') as fh:
+        response = json.load(fh)
+    voices = [(v['Id'], v['Gender'].lower(), v['LanguageCode'].lower())
+              for v in response['Voices']]
+    if not replace:
+        known = set(v.lower() for v, g, l in voice_db)
+        voices = voice_db + [entry for entry in voices if entry[0].lower() not in known]
+    set_voice_db(voices)
+    return voice_db
+
+
+def fetch_voice_db(path, aws_region='us-east-1', client=None):
+    """ Saves Polly's current describe_voices output to path, then loads it. """
+    try:
+        from .polly_client import get_default_polly_client
+    except (ImportError, ValueError) as err:
+        from polly_client import get_default_polly_client
+    polly = (client or get_default_polly_client()).client(aws_region)
+
+    voices = []
+    kwargs = {}
+    while True:
+        response = polly.describe_voices(**kwargs)
+        voices.extend(response['Voices'])
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    with open(path, 'w') as fh:
+        json.dump({'Voices': voices}, fh, indent=2)
+    return load_voice_db(path)
+
+
 """
 Returns tuple: (polly_name, gender, language_code)
 
@@ -72,24 +141,18 @@ def get_voice(query):
         # Assume language code, gender
         if query.find(',') >= 0:
             query_lang, query_gender = query.split(',')
-            query_lang = query_lang.strip()
-            query_gender = query_gender.strip().lower()
-
-            for v, g, l in voice_db:
-                if g == query_gender and (l.find(query_lang) == 0):
-                    return v, g, l
+            entry = _voice_by_lang_gender.get(
+                (query_lang.strip(), query_gender.strip().lower()))
 
         else:  # Assume language code
-            query_lang = query.strip()
-            for v, g, l in voice_db:
-                if l.find(query_lang) == 0:
-                    return v, g, l
+            entry = _voice_by_lang.get(query.strip())
 
         # Assume voice name
-        query_voice = query.strip().lower()
-        for v, g, l in voice_db:
-            if v.lower() == query_voice:
-                return v, g, l
+        if entry is None:
+            entry = _voice_by_name.get(query.strip().lower())
+
+        if entry is not None:
+            return entry
 
     except ValueError:
         pass
@@ -97,6 +160,34 @@ def get_voice(query):
     return None, None, None
 
 
+def resolve_voice(query, default_query='en'):
+    """Memoized get_voice that also falls back from a regional language code
+    to its base language (e.g. pt-xx -> pt, zh-cn -> zh), and then to
+    default_query. Query is case-insensitive; None means default_query.
+    """
+    if query is None:
+        query = default_query
+    key = (query, default_query)
+    result = _resolved_voices.get(key)
+    if result is not None:
+        return result
+
+    lang = query.strip().lower()
+    for candidate in (lang, lang.split('-')[0], default_query):
+        if candidate:
+            result = get_voice(candidate)
+            if result[0] is not None:
+                break
+
+    if len(_resolved_voices) >= _RESOLVED_VOICES_LIMIT:
+        _resolved_voices.clear()
+    _resolved_voices[key] = result
+    return result
+
+
+set_voice_db(voice_db)
+
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Test get_voice')
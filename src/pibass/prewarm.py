@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import io
+import multiprocessing
+import multiprocessing.pool
+import traceback
+
+try:
+    from .audio_utils import OnsetDetector, speech_marks_to_onsets, audio_segment_to_float32, pcm16_to_float32
+    from .pibass_motors import monotonic_time
+    from .polly_client import PollySynthesisClient
+    from .polly_utils import resolve_voice
+    from .tts_cache import TTSCacheStore, tts_cache_key
+    from .lazy_import import LazyImport
+except (ImportError, ValueError) as err:
+    from audio_utils import OnsetDetector, speech_marks_to_onsets, audio_segment_to_float32, pcm16_to_float32
+    from pibass_motors import monotonic_time
+    from polly_client import PollySynthesisClient
+    from polly_utils import resolve_voice
+    from tts_cache import TTSCacheStore, tts_cache_key
+    from lazy_import import LazyImport
+
+# Imported on first use, see LazyImport
+pydub = LazyImport('pydub')
+
+
+def read_phrases(path, default_voice='Kimberly'):
+    """Returns [(text, polly_voice_id)] from a text file with one phrase per
+    line, or from a .csv file with text and, optionally, voice columns. The
+    voice may be a voice name or a language code (see resolve_voice).
+    """
+    phrases = []
+    with io.open(path, 'r', encoding='utf-8') as fh:
+        if path.lower().endswith('.csv'):
+            rows = csv.reader(fh)
+        else:
+            rows = ([line] for line in fh)
+        for row in rows:
+            if len(row) <= 0 or len(row[0].strip()) <= 0 or row[0].startswith('#'):
+                continue
+            text = row[0].strip()
+            voice = row[1].strip() if len(row) > 1 and row[1].strip() else default_voice
+            phrases.append((text, resolve_voice(voice)[0]))
+    return phrases
+
+
+def compute_onsets(job):
+    """Process pool worker: returns (onsets, sec) for a synthesized phrase,
+    computed the same way as PiBassAudio._tts.
+
+    job: (synthesis_mode, audio_stream, sample_rate, speech_marks)
+    """
+    synthesis_mode, audio_stream, sample_rate, speech_marks = job
+    start_t = monotonic_time()
+    onset_detector = OnsetDetector(audio_sample_rate=sample_rate)
+    if synthesis_mode == 'pcm':
+        onsets = speech_marks_to_onsets(speech_marks, len(audio_stream) / 2. / sample_rate)
+        if len(onsets) <= 1:
+            onsets = onset_detector.detect_samples(pcm16_to_float32(audio_stream), sample_rate)
+    else:
+        sound = pydub.AudioSegment.from_file(io.BytesIO(audio_stream), format='mp3')
+        onsets = onset_detector.detect_samples(audio_segment_to_float32(sound), sound.frame_rate)
+    return onsets, monotonic_time() - start_t
+
+
+class StageTimer(object):
+    """ Accumulates count and total seconds per pipeline stage. """
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, stage, sec):
+        count, total = self.totals.get(stage, (0, 0.))
+        self.totals[stage] = (count + 1, total + sec)
+
+    def report(self):
+        for stage in sorted(self.totals):
+            count, total = self.totals[stage]
+            print('  %-10s %6d x %8.1f ms avg, %8.2f sec total' % (
+                stage, count, 1000. * total / max(count, 1), total))
+
+
+def prewarm_cache(phrases,
+                  audio_cache,
+                  polly_client,
+                  synthesis_mode='mp3',
+                  sample_rate=22050,
+                  aws_region='us-east-1',
+                  num_synth_workers=4,
+                  num_onset_workers=None,
+                  progress_interval=10):
+    """Synthesizes phrases missing from audio_cache, with at most
+    num_synth_workers concurrent Polly requests, and computes their onsets
+    on a pool of num_onset_workers processes (one per CPU by default).
+    Entries are keyed by tts_cache_key, as PiBassAudio looks them up, so a
+    PiBassAudio with the same settings and cache path starts warm.
+
+    Returns (num_added, num_skipped, num_failed, StageTimer).
+    """
+    def cache_key(text, polly_voice_id):
+        return tts_cache_key(text, polly_voice_id, synthesis_mode, sample_rate)
+
+    timer = StageTimer()
+    todo = [(text, voice) for text, voice in phrases if cache_key(text, voice) not in audio_cache]
+    num_skipped = len(phrases) - len(todo)
+    num_added, num_failed = 0, 0
+
+    def synthesize(phrase):
+        text, polly_voice_id = phrase
+        start_t = monotonic_time()
+        try:
+            speech_marks = None
+            if synthesis_mode == 'pcm':
+                speech_marks = polly_client.speech_marks(text, aws_region, polly_voice_id)
+            audio_stream = b''.join(polly_client.audio_chunks(
+                text, aws_region, polly_voice_id,
+                output_format=synthesis_mode, sample_rate=sample_rate))
+        except Exception:
+            traceback.print_exc()
+            return phrase, None, monotonic_time() - start_t
+        return phrase, (synthesis_mode, audio_stream, sample_rate, speech_marks), monotonic_time() - start_t
+
+    start_t = monotonic_time()
+    synth_pool = multiprocessing.pool.ThreadPool(max(1, num_synth_workers))
+    onset_pool = multiprocessing.Pool(num_onset_workers)
+    try:
+        # Onsets are computed while later phrases are still being synthesized
+        pending = []
+        for phrase, job, synth_sec in synth_pool.imap_unordered(synthesize, todo):
+            timer.add('synthesize', synth_sec)
+            if job is None:
+                num_failed += 1
+                continue
+            pending.append((phrase, job[1], onset_pool.apply_async(compute_onsets, (job,))))
+
+            # Store finished phrases in order, to keep the cache writer single-threaded
+            while len(pending) > 0 and (pending[0][2].ready() or len(pending) > 2 * num_synth_workers):
+                num_added, num_failed = _store(pending.pop(0), audio_cache, cache_key, timer,
+                                               num_added, num_failed)
+                _report_progress(num_added + num_failed, len(todo), start_t, progress_interval)
+        for entry in pending:
+            num_added, num_failed = _store(entry, audio_cache, cache_key, timer, num_added, num_failed)
+            _report_progress(num_added + num_failed, len(todo), start_t, progress_interval)
+    finally:
+        synth_pool.terminate()
+        onset_pool.terminate()
+        audio_cache.flush(forced=True)
+    return num_added, num_skipped, num_failed, timer
+
+
+def _store(entry, audio_cache, cache_key, timer, num_added, num_failed):
+    (text, polly_voice_id), audio_stream, result = entry
+    try:
+        onsets, onset_sec = result.get()
+    except Exception:
+        traceback.print_exc()
+        return num_added, num_failed + 1
+    timer.add('onsets', onset_sec)
+    put_start_t = monotonic_time()
+    audio_cache.put(cache_key(text, polly_voice_id), (audio_stream, onsets))
+    timer.add('cache_put', monotonic_time() - put_start_t)
+    return num_added + 1, num_failed
+
+
+def _report_progress(num_done, num_total, start_t, progress_interval):
+    if num_done % progress_interval == 0 or num_done == num_total:
+        elapsed_sec = monotonic_time() - start_t
+        print('[%d/%d] %.1f phrases/s' % (num_done, num_total, num_done / max(elapsed_sec, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-warm the pibass TTS cache from a phrase list')
+    parser.add_argument('phrases', help='Text file with one phrase per line, or CSV of text,voice', type=str)
+    parser.add_argument('--audio_cache_path', help='TTS cache directory [/home/pi/pibass_cache]',
+                        type=str, default='/home/pi/pibass_cache')
+    parser.add_argument('--cache_size_limit', help='Max TTS cache entries [5000]', type=int, default=5000)
+    parser.add_argument('--cache_mb_limit', help='Max TTS cache size in MB [512]', type=int, default=512)
+    parser.add_argument('--aws_region', help='AWS Region [us-east-1]', type=str, default='us-east-1')
+    parser.add_argument('--polly_voice_id', help='Voice for phrases without one [Kimberly]',
+                        type=str, default='Kimberly')
+    parser.add_argument('--synthesis_mode', help='mp3 or pcm, as for PiBassAudio [mp3]',
+                        type=str, default='mp3', choices=('mp3', 'pcm'))
+    parser.add_argument('--mp3_sample_rate', help='MP3 Sample Rate [22050]', type=int, default=22050)
+    parser.add_argument('--pcm_sample_rate', help='PCM Sample Rate [16000]', type=int, default=16000)
+    parser.add_argument('--num_synth_workers', help='Concurrent Polly requests [4]', type=int, default=4)
+    parser.add_argument('--num_onset_workers', help='Onset detection processes [one per CPU]',
+                        type=int, default=None)
+    parser.add_argument('--endpoint_url', help='Polly endpoint, e.g. a local polly_stub', type=str, default=None)
+    args = parser.parse_args()
+
+    phrases = read_phrases(args.phrases, args.polly_voice_id)
+    sample_rate = args.pcm_sample_rate if args.synthesis_mode == 'pcm' else args.mp3_sample_rate
+    audio_cache = TTSCacheStore(args.audio_cache_path, size_limit=args.cache_size_limit,
+                                byte_limit=args.cache_mb_limit * 1024 * 1024)
+    polly_client = PollySynthesisClient(
+        max_pool_connections=max(10, args.num_synth_workers),
+        endpoint_url=args.endpoint_url)
+
+    start_t = monotonic_time()
+    num_added, num_skipped, num_failed, timer = prewarm_cache(
+        phrases, audio_cache, polly_client,
+        synthesis_mode=args.synthesis_mode,
+        sample_rate=sample_rate,
+        aws_region=args.aws_region,
+        num_synth_workers=args.num_synth_workers,
+        num_onset_workers=args.num_onset_workers)
+    total_sec = monotonic_time() - start_t
+
+    print('added %d, already cached %d, failed %d in %.1f sec (%.1f phrases/s)' % (
+        num_added, num_skipped, num_failed, total_sec, num_added / max(total_sec, 1e-6)))
+    timer.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from .audio_output import NullAudioDevice
+    from .language_detect import CachedLanguageDetector, NGramLanguageDetector
+    from .metrics import metrics
+    from .pibass_audio import PiBassAudio
+    from .pibass_motors import monotonic_time, percentile
+    from .polly_stub import PollyStubServer, stub_polly_client
+    from .polly_utils import resolve_voice
+    from .simulated_hat import SimulatedMotorHAT
+    from .speech_queue import SpeechQueue
+except (ImportError, ValueError) as err:
+    from audio_output import NullAudioDevice
+    from language_detect import CachedLanguageDetector, NGramLanguageDetector
+    from metrics import metrics
+    from pibass_audio import PiBassAudio
+    from pibass_motors import monotonic_time, percentile
+    from polly_stub import PollyStubServer, stub_polly_client
+    from polly_utils import resolve_voice
+    from simulated_hat import SimulatedMotorHAT
+    from speech_queue import SpeechQueue
+
+
+SYNTHETIC_PHRASES = (
+    'Build is green again.',
+    'Deploy finished, all hosts healthy.',
+    'Someone left the coffee machine on.',
+    'Standup in five minutes!',
+    'The fish would like everyone to know that lunch has arrived in the kitchen.',
+    'Reminder: the demo is at three, please test your slides before then.',
+    'Le build est cassé, quelqu\'un peut regarder?',
+    'Der Server ist wieder erreichbar.',
+)
+
+
+def append_trace(path, text, voice=None, priority=0, ts=None):
+    """ Appends a message to a JSON lines trace, as read by read_trace. """
+    entry = {'ts': time.time() if ts is None else ts, 'text': text, 'voice': voice, 'priority': priority}
+    with io.open(path, 'a', encoding='utf-8') as fh:
+        fh.write(u'%s\n' % json.dumps(entry, ensure_ascii=False))
+
+
+def read_trace(path):
+    """Returns [(t, text, voice, priority)] sorted by t, seconds after the
+    first message, from:
+
+    .jsonl: one {ts, text, voice, priority} object per line (see append_trace)
+    .json: a Slack channel export, i.e. a list of messages with ts and text
+    .csv: ts, text and, optionally, voice and priority columns
+
+    voice and priority may be missing; voice may be a voice name or a
+    language code (see resolve_voice), and is detected if missing.
+    """
+    with io.open(path, 'r', encoding='utf-8') as fh:
+        if path.lower().endswith('.csv'):
+            rows = [dict(zip(('ts', 'text', 'voice', 'priority'), row))
+                    for row in csv.reader(fh) if len(row) >= 2 and not row[0].startswith('#')]
+        elif path.lower().endswith('.jsonl'):
+            rows = [json.loads(line) for line in fh if line.strip()]
+        else:
+            rows = [row for row in json.load(fh) if row.get('type', 'message') == 'message']
+
+    trace = []
+    for row in rows:
+        text = (row.get('text') or '').strip()
+        if len(text) <= 0:
+            continue
+        trace.append((float(row['ts']), text, row.get('voice') or None, int(row.get('priority') or 0)))
+    trace.sort(key=lambda entry: entry[0])
+    if len(trace) > 0:
+        t0 = trace[0][0]
+        trace = [(ts - t0, text, voice, priority) for ts, text, voice, priority in trace]
+    return trace
+
+
+def synthetic_trace(num_messages=50, messages_per_min=6., repeat_fraction=0.5, seed=0):
+    """Poisson arrivals of SYNTHETIC_PHRASES; repeat_fraction of messages
+    repeat an earlier one, as channels repeat build and deploy notices.
+    """
+    rng = random.Random(seed)
+    trace = []
+    t = 0.
+    for i in range(num_messages):
+        if i > 0 and rng.random() < repeat_fraction:
+            text = rng.choice(trace)[1]
+        else:
+            text = '%s (%d)' % (rng.choice(SYNTHETIC_PHRASES), i)
+        trace.append((t, text, None, 0))
+        t += rng.expovariate(messages_per_min / 60.)
+    return trace
+
+
+class TimedPlayer(object):
+    """ Wraps a PiBassAudio for a SpeechQueue, noting when each item first sounded. """
+
+    def __init__(self, bass):
+        self.bass = bass
+        self.first_sound_t = {}  # item stop_event -> monotonic_time
+
+    def __getattr__(self, name):
+        return getattr(self.bass, name)
+
+    def play(self, speech, stop_event=None):
+        self.bass.first_sound_t = None
+        try:
+            return self.bass.play(speech, stop_event)
+        finally:
+            if self.bass.first_sound_t is not None:
+                self.first_sound_t[stop_event] = self.bass.first_sound_t
+
+
+def replay_trace(bass, trace, speed=1., queue_kwargs=None, detector=None):
+    """Submits trace messages to a SpeechQueue over bass at speed times their
+    recorded pace, and waits for them to be spoken.
+
+    Returns [(item, arrival_t, first_sound_t, merged)] per message; item is
+    None if it was merged into another item (merged is then True) or dropped
+    on arrival, first_sound_t None if never heard.
+    """
+    if detector is None:
+        detector = CachedLanguageDetector(NGramLanguageDetector())
+    player = TimedPlayer(bass)
+    queue = SpeechQueue(player, **(queue_kwargs or {}))
+    arrivals = []
+    try:
+        start_t = monotonic_time()
+        for t, text, voice, priority in trace:
+            arrival_t = start_t + t / speed
+            if arrival_t > monotonic_time():
+                time.sleep(arrival_t - monotonic_time())
+            # Language detection is part of the latency of untagged messages
+            if voice is None:
+                voice = detector.detect(text)[0]
+            num_merged = queue.num_merged
+            item = queue.submit(text, resolve_voice(voice)[0], priority=priority)
+            arrivals.append((item, arrival_t, queue.num_merged > num_merged))
+        queue.join()
+    finally:
+        queue.terminate()
+    return [(item, arrival_t, player.first_sound_t.get(item.stop_event) if item is not None else None, merged)
+            for item, arrival_t, merged in arrivals]
+
+
+def resource_usage():
+    """ (CPU seconds, max RSS in MB) of this process so far. """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss_scale = 1. if sys.platform == 'darwin' else 1024.
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * rss_scale / (1024 * 1024)
+
+
+def cache_hit_rates():
+    """ Hit rate per cache, from the pibass_cache_requests_total counters. """
+    hits, totals = {}, {}
+    for (name, labels), value in list(metrics.counters.items()):
+        if name != 'pibass_cache_requests_total':
+            continue
+        labels = dict(labels)
+        totals[labels['cache']] = totals.get(labels['cache'], 0) + value
+        if labels['result'] == 'hit':
+            hits[labels['cache']] = hits.get(labels['cache'], 0) + value
+    return dict((cache, float(hits.get(cache, 0)) / total) for cache, total in totals.items())
+
+
+def run_benchmark(trace,
+                  speed=1.,
+                  synthesis_mode='mp3',
+                  playback_mode='blocking',
+                  chunked=False,
+                  polly_latency_sec=0.1,
+                  polly_bytes_per_sec=0,
+                  audio_cache_path=None,
+                  queue_kwargs=None):
+    """Replays trace end to end against the Polly stub, a NullAudioDevice and
+    a SimulatedMotorHAT, and returns a JSON-serializable report.
+
+    Audio plays, and the pause after each message lasts, 1/speed of real
+    time. Uses a fresh cache in a temporary directory unless audio_cache_path
+    is given, e.g. to measure a warm cache.
+    """
+    tmp_path = None
+    if audio_cache_path is None:
+        tmp_path = audio_cache_path = tempfile.mkdtemp(prefix='pibass_bench_')
+    server = PollyStubServer(latency_sec=polly_latency_sec, bytes_per_sec=polly_bytes_per_sec).start()
+    hat = SimulatedMotorHAT()
+    metrics.reset()
+    metrics.enable()
+    bass = PiBassAudio(audio_cache_path=audio_cache_path,
+                       legacy_audio_cache_path=os.path.join(audio_cache_path, 'legacy.pkl'),
+                       synthesis_mode=synthesis_mode,
+                       playback_mode=playback_mode,
+                       chunked=chunked,
+                       hat=hat,
+                       polly_client=stub_polly_client(server),
+                       polly_warm_up=False,
+                       audio_dev=NullAudioDevice(speed),
+                       post_speech_pause_sec=0.5 / speed)
+    bass.lateness_log = []
+    try:
+        start_cpu_sec, start_rss_mb = resource_usage()
+        start_t = monotonic_time()
+        results = replay_trace(bass, trace, speed, queue_kwargs)
+        wall_sec = monotonic_time() - start_t
+        cpu_sec, max_rss_mb = resource_usage()
+    finally:
+        bass.terminate()
+        server.stop()
+        metrics.enable(False)
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    latencies_ms = [1000. * (first_sound_t - arrival_t)
+                    for item, arrival_t, first_sound_t, merged in results if first_sound_t is not None]
+    items = [item for item, arrival_t, first_sound_t, merged in results if item is not None]
+    num_played = sum(1 for item in items if item.played)
+    num_merged = sum(1 for item, arrival_t, first_sound_t, merged in results if merged)
+    lateness_ms = [1000. * dt for dt in bass.lateness_log]
+
+    def summary(values):
+        if len(values) <= 0:
+            return None
+        return {'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                'p99': percentile(values, 99), 'max': max(values)}
+
+    return {
+        'python': platform.python_version(),
+        'config': {
+            'num_messages': len(trace),
+            'trace_sec': trace[-1][0] if len(trace) > 0 else 0.,
+            'speed': speed,
+            'synthesis_mode': synthesis_mode,
+            'playback_mode': playback_mode,
+            'chunked': chunked,
+            'polly_latency_sec': polly_latency_sec,
+            'polly_bytes_per_sec': polly_bytes_per_sec,
+        },
+        'wall_sec': wall_sec,
+        'played': num_played,
+        'merged': num_merged,  # spoken as part of another message, or deduplicated
+        'dropped': len(results) - num_played - num_merged,
+        'throughput_msgs_per_sec': num_played / wall_sec,
+        'latency_ms': summary(latencies_ms),  # arrival to first sound
+        'motor_lateness_ms': summary(lateness_ms),
+        'cache_hit_rate': cache_hit_rates(),
+        'polly_requests': server.num_requests,
+        'cpu_sec': cpu_sec - start_cpu_sec,
+        'cpu_percent': 100. * (cpu_sec - start_cpu_sec) / wall_sec,
+        'max_rss_mb': max_rss_mb,
+    }
+
+
+def compare_reports(old, new):
+    """ Prints the relative change of each number in new against old. """
+    def flatten(report, prefix=''):
+        for key, value in sorted(report.items()):
+            if isinstance(value, dict):
+                for item in flatten(value, prefix + key + '.'):
+                    yield item
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix + key, value
+
+    old_values = dict(flatten(old))
+    for key, value in flatten(new):
+        if key.startswith('config.') or key not in old_values:
+            continue
+        old_value = old_values[key]
+        change = '%+.1f%%' % (100. * (value - old_value) / old_value) if old_value else 'n/a'
+        print('%-32s %12.3f -> %12.3f  %s' % (key, old_value, value, change))
+
+
+def bench_replay():
+    parser = argparse.ArgumentParser(description='Replay recorded Slack traffic through pibass, end to end')
+    parser.add_argument('--trace', help='Trace to replay (.jsonl, .csv or Slack export .json) [synthetic]',
+                        type=str, default=None)
+    parser.add_argument('--num_messages', help='Synthetic trace length [50]', type=int, default=50)
+    parser.add_argument('--messages_per_min', help='Synthetic trace rate [6]', type=float, default=6.)
+    parser.add_argument('--repeat_fraction', help='Synthetic trace repeated messages [0.5]',
+                        type=float, default=0.5)
+    parser.add_argument('--speed', help='Replay speed, e.g. 10 for 10x real time [1]', type=float, default=1.)
+    parser.add_argument('--synthesis_mode', help='Polly output: mp3 or pcm [mp3]',
+                        type=str, default='mp3', choices=('mp3', 'pcm'))
+    parser.add_argument('--playback_mode', help='blocking or callback [blocking]',
+                        type=str, default='blocking', choices=('blocking', 'callback'))
+    parser.add_argument('--chunked', help='Synthesize and cache per sentence', action='store_true')
+    parser.add_argument('--polly_latency_ms', help='Stub Polly response latency [100]', type=float, default=100.)
+    parser.add_argument('--polly_bytes_per_sec', help='Stub Polly download rate [unlimited]', type=int, default=0)
+    parser.add_argument('--audio_cache_path', help='TTS cache directory [fresh temporary one]',
+                        type=str, default=None)
+    parser.add_argument('--max_pending', help='Max queued utterances [10]', type=int, default=10)
+    parser.add_argument('--output', help='Write the JSON report here [stdout]', type=str, default=None)
+    parser.add_argument('--compare', help='Report of an earlier run to compare against', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = read_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.num_messages, args.messages_per_min, args.repeat_fraction)
+    report = run_benchmark(trace,
+                           speed=args.speed,
+                           synthesis_mode=args.synthesis_mode,
+                           playback_mode=args.playback_mode,
+                           chunked=args.chunked,
+                           polly_latency_sec=args.polly_latency_ms / 1000.,
+                           polly_bytes_per_sec=args.polly_bytes_per_sec,
+                           audio_cache_path=args.audio_cache_path,
+                           queue_kwargs={'max_pending': args.max_pending})
+    if args.trace:
+        report['config']['trace'] = os.path.basename(args.trace)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as fh:
+            compare_reports(json.load(fh), report)
+
+
+if __name__ == '__main__':
+    bench_replay()
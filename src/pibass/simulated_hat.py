@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import array
+import csv
+import json
+import threading
+import time
+
+try:
+    _clock = time.monotonic
+except AttributeError:  # Python 2
+    _clock = time.time
+
+
+class MotorTrace(object):
+    """Ring buffer of motor calls, preallocated so that recording a call
+    does not allocate. Once full, the oldest calls are overwritten.
+    """
+    CALL_NAMES = ('setSpeed', 'run')
+    SET_SPEED = 0
+    RUN = 1
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.t = array.array('d', [0.]) * capacity
+        self.motor_num = array.array('b', [0]) * capacity
+        self.call = array.array('b', [0]) * capacity
+        self.value = array.array('h', [0]) * capacity
+        self.count = 0  # total calls recorded, including overwritten ones
+        self.mutex = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        with self.mutex:
+            self.count = 0
+
+    def record(self, t, motor_num, call, value):
+        with self.mutex:
+            i = self.count % self.capacity
+            self.t[i] = t
+            self.motor_num[i] = motor_num
+            self.call[i] = call
+            self.value[i] = value
+            self.count += 1
+
+    def entries(self):
+        """ Returns list of (t, motor_num, call_name, value), oldest first. """
+        with self.mutex:
+            start = max(0, self.count - self.capacity)
+            return [(self.t[i % self.capacity], self.motor_num[i % self.capacity],
+                     self.CALL_NAMES[self.call[i % self.capacity]], self.value[i % self.capacity])
+                    for i in range(start, self.count)]
+
+    def export_csv(self, path):
+        with open(path, 'w') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(('t', 'motor', 'call', 'value'))
+            for t, motor_num, call, value in self.entries():
+                writer.writerow(('%.6f' % t, motor_num, call, value))
+
+    def export_json(self, path):
+        with open(path, 'w') as fh:
+            json.dump([{'t': t, 'motor': motor_num, 'call': call, 'value': value}
+                       for t, motor_num, call, value in self.entries()], fh)
+
+
+class SimulatedDCMotor(object):
+    def __init__(self, hat, num):
+        self.hat = hat
+        self.num = num
+        self.speed = 0
+        self.run_arg = SimulatedMotorHAT.RELEASE
+
+    def setSpeed(self, speed):
+        self.hat._write()
+        self.speed = max(0, min(speed, 255))
+        self.hat.trace.record(self.hat.clock(), self.num, MotorTrace.SET_SPEED, self.speed)
+
+    def run(self, command):
+        self.hat._write()
+        self.run_arg = command
+        self.hat.trace.record(self.hat.clock(), self.num, MotorTrace.RUN, command)
+
+
+class SimulatedMotorHAT(object):
+    """Drop-in for Adafruit_MotorHAT that records every setSpeed/run call
+    with a monotonic timestamp instead of driving motors, so that motor
+    scheduling and lip-sync can be profiled on any Linux machine.
+
+    write_latency_sec optionally models the I2C bus time of each call.
+    """
+    # Same values as Adafruit_MotorHAT
+    FORWARD = 1
+    BACKWARD = 2
+    BRAKE = 3
+    RELEASE = 4
+
+    def __init__(self, addr=0x60, trace_capacity=65536, write_latency_sec=0., clock=None):
+        self.addr = addr
+        self.trace = MotorTrace(trace_capacity)
+        self.write_latency_sec = write_latency_sec
+        self.clock = clock or _clock
+        self.motors = [SimulatedDCMotor(self, num) for num in range(1, 5)]
+
+    def getMotor(self, num):
+        if num < 1 or num > 4:
+            raise NameError('MotorHAT Motor must be between 1 and 4 inclusive')
+        return self.motors[num - 1]
+
+    def _write(self):
+        if self.write_latency_sec > 0:
+            time.sleep(self.write_latency_sec)
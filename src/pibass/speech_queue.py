@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+import collections
+import itertools
+import threading
+import traceback
+
+
+PRIORITY_LEVELS = collections.OrderedDict([('low', -10), ('normal', 0), ('high', 10), ('urgent', 20)])
+
+
+def priority_level(priority):
+    """ Returns an int priority from an int, or a name in PRIORITY_LEVELS. """
+    if isinstance(priority, int):
+        return priority
+    try:
+        return PRIORITY_LEVELS[priority.strip().lower()]
+    except (AttributeError, KeyError):
+        try:
+            return int(priority)
+        except (TypeError, ValueError):
+            raise ValueError('priority must be an int or one of %s' % list(PRIORITY_LEVELS))
+
+
+class SpeechItem(object):
+    """ Queued utterance; speech is set once synthesized, error if that failed. """
+    _ids = itertools.count(1)
+
+    def __init__(self, text, polly_voice_id=None, aws_region='us-east-1', priority=0):
+        self.id = next(self._ids)
+        self.text = text
+        self.polly_voice_id = polly_voice_id
+        self.aws_region = aws_region
+        self.priority = priority
+        self.synthesizing = False
+        self.speech = None
+        self.error = None
+        self.playing = False
+        self.played = False
+        self.cancelled = False
+        self.preempted = False  # stopped by a higher-priority item
+        self.stop_event = threading.Event()  # cuts playback short, see cancel
+        self.done = threading.Event()  # set after playback, or when dropped
+
+    @property
+    def synthesized(self):
+        return self.speech is not None or self.error is not None
+
+    @property
+    def state(self):
+        if self.done.is_set():
+            if self.cancelled:
+                return 'cancelled'
+            if self.error is not None:
+                return 'failed'
+            return 'played' if self.played else 'dropped'
+        if self.playing:
+            return 'playing'
+        if self.synthesized:
+            return 'ready'
+        return 'synthesizing' if self.synthesizing else 'queued'
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class SpeechQueue(object):
+    """Plays utterances back-to-back on a playback thread, while a pool of
+    workers synthesizes (fetches, onset-detects and decodes) the next ones.
+
+    Items play in order of priority (higher first, see PRIORITY_LEVELS), and
+    in submission order among equal priorities. An item of at least
+    preempt_priority stops a lower-priority one that is playing, within one
+    audio block; the stopped item and queued lower-priority ones are then
+    handled per preempt_policy. When the queue is full, lower-priority items
+    make room for higher-priority ones whatever the overflow_policy.
+
+    bass: PiBassAudio, or anything with synthesize(text, voice, region) and
+          play(speech, stop_event)
+    max_pending: max queued utterances including the one playing; None for no limit
+    num_synth_workers: max concurrent synthesis requests
+    prefetch: number of utterances after the playing one to synthesize ahead
+    overflow_policy: when full, 'drop_oldest' queued item, 'drop_newest' (reject), or 'block'
+    merge_policy: None, 'dedupe' (skip text+voice already queued), or
+                  'concat' (append to the last queued item with the same voice,
+                  if it is not being synthesized yet)
+    preempt_priority: min priority that interrupts playback; None to never interrupt
+    preempt_policy: 'defer' (replay the interrupted item from the start after
+                    the preempting one; keep queued items) or 'drop' (drop it,
+                    and all queued items of lower priority than the preempting one)
+    """
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+    MERGE_POLICIES = (None, 'dedupe', 'concat')
+    PREEMPT_POLICIES = ('defer', 'drop')
+
+    def __init__(self,
+                 bass,
+                 max_pending=10,
+                 num_synth_workers=2,
+                 prefetch=3,
+                 overflow_policy='drop_oldest',
+                 merge_policy=None,
+                 preempt_priority=PRIORITY_LEVELS['urgent'],
+                 preempt_policy='defer'):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow_policy must be one of %s' % (self.OVERFLOW_POLICIES,))
+        if merge_policy not in self.MERGE_POLICIES:
+            raise ValueError('merge_policy must be one of %s' % (self.MERGE_POLICIES,))
+        if preempt_policy not in self.PREEMPT_POLICIES:
+            raise ValueError('preempt_policy must be one of %s' % (self.PREEMPT_POLICIES,))
+        self.bass = bass
+        self.max_pending = max_pending
+        self.prefetch = prefetch
+        self.overflow_policy = overflow_policy
+        self.merge_policy = merge_policy
+        self.preempt_priority = priority_level(preempt_priority) if preempt_priority is not None else None
+        self.preempt_policy = preempt_policy
+
+        self.items = collections.deque()  # items[0] is playing or next to play
+        self.mutex = threading.Lock()
+        self.cv = threading.Condition(self.mutex)
+        self.active = True
+        self.num_dropped = 0
+        self.num_merged = 0
+        self.num_preempted = 0
+
+        self.threads = [threading.Thread(target=self.synth_loop)
+                        for i in range(num_synth_workers)]
+        self.threads.append(threading.Thread(target=self.playback_loop))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __len__(self):
+        with self.mutex:
+            return len(self.items)
+
+    def submit(self, text, polly_voice_id=None, aws_region='us-east-1', priority=0):
+        """Queues text at priority (an int, or a name in PRIORITY_LEVELS);
+        returns its SpeechItem, or None if dropped or merged.
+        """
+        priority = priority_level(priority)
+        with self.cv:
+            if self.merge_policy == 'dedupe':
+                for item in list(self.items)[1:]:
+                    if item.text == text and item.polly_voice_id == polly_voice_id:
+                        self.num_merged += 1
+                        return None
+            elif self.merge_policy == 'concat' and len(self.items) > 1:
+                item = self.items[-1]
+                if item.polly_voice_id == polly_voice_id and item.priority == priority and \
+                        not item.synthesizing and not item.synthesized:
+                    item.text = '%s %s' % (item.text, text)
+                    self.num_merged += 1
+                    return None
+
+            while self.max_pending is not None and len(self.items) >= self.max_pending:
+                lowest = self._lowest_queued()
+                if lowest is not None and lowest.priority < priority:
+                    self._drop(lowest)
+                elif self.overflow_policy == 'block':
+                    self.cv.wait()
+                    if not self.active:
+                        return None
+                elif self.overflow_policy == 'drop_newest' or len(self.items) <= 1:
+                    self.num_dropped += 1
+                    return None
+                else:  # drop oldest item that is not already playing
+                    self._drop(self.items[1])
+
+            item = SpeechItem(text, polly_voice_id, aws_region, priority)
+            self._insert(item)
+            self._preempt(item)
+            self.cv.notify_all()
+            return item
+
+    def _insert(self, item, ahead_of_equal=False):
+        """Queues item after those of higher priority, and after (or with
+        ahead_of_equal, before) those of equal priority; caller holds mutex.
+        """
+        i = len(self.items)
+        while i > 0 and not self.items[i - 1].playing and (
+                self.items[i - 1].priority < item.priority or
+                (ahead_of_equal and self.items[i - 1].priority == item.priority)):
+            i -= 1
+        self.items.insert(i, item)
+
+    def _lowest_queued(self):
+        """ Oldest of the lowest-priority items not playing, or None; caller holds mutex. """
+        lowest = None
+        for item in self.items:
+            if not item.playing and (lowest is None or item.priority < lowest.priority):
+                lowest = item
+        return lowest
+
+    def _drop(self, item):
+        """ Caller holds mutex. """
+        self.items.remove(item)
+        item.done.set()
+        self.num_dropped += 1
+
+    def _preempt(self, item):
+        """ Stops the playing item if item may interrupt it; caller holds mutex. """
+        if self.preempt_priority is None or item.priority < self.preempt_priority:
+            return
+        if len(self.items) <= 0 or not self.items[0].playing or self.items[0].priority >= item.priority:
+            return
+        playing = self.items[0]
+        playing.preempted = True
+        playing.stop_event.set()
+        self.num_preempted += 1
+        if self.preempt_policy == 'drop':
+            for queued in list(self.items)[1:]:
+                if queued.priority < item.priority:
+                    self._drop(queued)
+
+    def cancel(self, item):
+        """Removes item from the queue, or stops it if it is playing;
+        returns False if it was already done.
+        """
+        with self.cv:
+            if item.done.is_set():
+                return False
+            item.cancelled = True
+            item.stop_event.set()
+            if not item.playing:
+                try:
+                    self.items.remove(item)
+                except ValueError:
+                    pass
+                item.done.set()
+            self.cv.notify_all()
+            return True
+
+    def find(self, item_id):
+        """ Returns the queued SpeechItem with id item_id, or None. """
+        with self.mutex:
+            for item in self.items:
+                if item.id == item_id:
+                    return item
+        return None
+
+    def clear(self):
+        """ Drops all queued items except the one playing, if any. """
+        with self.cv:
+            for item in list(self.items):
+                if not item.playing:
+                    self.items.remove(item)
+                    item.done.set()
+            self.cv.notify_all()
+
+    def join(self):
+        """ Blocks until everything queued has been played. """
+        with self.cv:
+            while self.active and len(self.items) > 0:
+                self.cv.wait()
+
+    def terminate(self):
+        with self.cv:
+            self.active = False
+            for item in self.items:
+                item.done.set()
+            self.items.clear()
+            self.cv.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def _next_to_synthesize(self):
+        for i, item in enumerate(self.items):
+            if i > self.prefetch:
+                break
+            if not item.synthesizing and not item.synthesized:
+                return item
+        return None
+
+    def synth_loop(self):
+        while True:
+            with self.cv:
+                item = self._next_to_synthesize()
+                while self.active and item is None:
+                    self.cv.wait()
+                    item = self._next_to_synthesize()
+                if not self.active:
+                    break
+                item.synthesizing = True
+
+            try:
+                speech = self.bass.synthesize(item.text, item.polly_voice_id, item.aws_region)
+                error = None
+            except Exception as err:
+                traceback.print_exc()
+                speech, error = None, err
+
+            with self.cv:
+                item.speech, item.error = speech, error
+                item.synthesizing = False
+                self.cv.notify_all()
+
+    def playback_loop(self):
+        while True:
+            with self.cv:
+                while self.active and (len(self.items) <= 0 or not self.items[0].synthesized):
+                    self.cv.wait()
+                if not self.active:
+                    break
+                item = self.items[0]
+                item.playing = True
+
+            if item.speech is not None:
+                try:
+                    self.bass.play(item.speech, item.stop_event)
+                except Exception:
+                    traceback.print_exc()
+
+            with self.cv:
+                if len(self.items) > 0 and self.items[0] is item:
+                    self.items.popleft()
+                item.playing = False
+                if item.preempted and not item.cancelled and self.preempt_policy == 'defer':
+                    # Replay from the start once the preempting item is done
+                    item.preempted = False
+                    item.stop_event = threading.Event()
+                    self._insert(item, ahead_of_equal=True)
+                    self.cv.notify_all()
+                    continue
+                item.played = item.speech is not None and not item.cancelled and not item.preempted
+                item.done.set()
+                self.cv.notify_all()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import json
+import multiprocessing.pool
+import threading
+import traceback
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+try:
+    from .pibass_audio import PiBassAudio
+    from .polly_utils import resolve_voice
+    from .speech_queue import SpeechQueue, priority_level
+except (ImportError, ValueError) as err:
+    from pibass_audio import PiBassAudio
+    from polly_utils import resolve_voice
+    from speech_queue import SpeechQueue, priority_level
+
+
+DEFAULT_PORT = 8765
+
+
+class SpeechRequestHandler(BaseHTTPRequestHandler):
+    """JSON over HTTP:
+
+    POST /speak     {text, voice, aws_region, priority, wait} -> {id, state}
+    POST /prefetch  {text, voice, aws_region} -> {queued}
+    POST /cancel    {id}, or {} to cancel everything -> {cancelled}
+    GET  /status    -> queue and prefetch counters
+    GET  /items/<id> -> {id, state}
+
+    voice may be a Polly voice id or a language code (see resolve_voice), and
+    priority an int or a name in PRIORITY_LEVELS.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/status':
+            return self._respond(200, self.server.status())
+        if self.path.startswith('/items/'):
+            try:
+                item = self.server.get_item(int(self.path[len('/items/'):]))
+            except ValueError:
+                item = None
+            if item is None:
+                return self._respond(404, {'error': 'no such item'})
+            return self._respond(200, {'id': item.id, 'state': item.state})
+        self._respond(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+        except ValueError as err:
+            return self._respond(400, {'error': 'bad request: %s' % err})
+
+        if self.path == '/speak':
+            if not request.get('text'):
+                return self._respond(400, {'error': 'text is required'})
+            try:
+                priority = priority_level(request.get('priority', 0))
+            except ValueError as err:
+                return self._respond(400, {'error': str(err)})
+            item = self.server.speak(request['text'], request.get('voice'),
+                                     request.get('aws_region', 'us-east-1'), priority)
+            if item is None:
+                return self._respond(200, {'id': None, 'state': 'dropped'})
+            if request.get('wait'):
+                item.wait()
+            return self._respond(200, {'id': item.id, 'state': item.state})
+        if self.path == '/prefetch':
+            if not request.get('text'):
+                return self._respond(400, {'error': 'text is required'})
+            queued = self.server.prefetch(request['text'], request.get('voice'),
+                                          request.get('aws_region', 'us-east-1'))
+            return self._respond(200, {'queued': queued})
+        if self.path == '/cancel':
+            return self._respond(200, {'cancelled': self.server.cancel(request.get('id'))})
+        self._respond(404, {'error': 'unknown path %s' % self.path})
+
+    def _respond(self, code, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SpeechServer(ThreadingMixIn, HTTPServer):
+    """Local daemon owning the one PiBassAudio (HAT, audio device, Polly
+    client and cache) of a machine, so that any number of producers, e.g.
+    several bots, share its warm cache and never start the hardware twice.
+
+    Utterances play through a SpeechQueue in priority order; prefetch
+    requests are synthesized into the cache on their own pool of
+    num_prefetch_workers threads, without playing.
+
+    queue: SpeechQueue wrapping the PiBassAudio
+    """
+    daemon_threads = True
+    max_items = 1000  # finished items remembered for /items/<id>
+
+    def __init__(self, queue, host='127.0.0.1', port=DEFAULT_PORT, num_prefetch_workers=2):
+        HTTPServer.__init__(self, (host, port), SpeechRequestHandler)
+        self.queue = queue
+        self.bass = queue.bass
+        self.mutex = threading.Lock()
+        self.items = collections.OrderedDict()  # id -> SpeechItem
+        self.prefetch_pool = multiprocessing.pool.ThreadPool(max(1, num_prefetch_workers))
+        self.prefetching = set()  # (text, voice, region) being synthesized
+        self.num_prefetched = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def _voice(self, voice):
+        return resolve_voice(voice)[0] if voice else None
+
+    def speak(self, text, voice=None, aws_region='us-east-1', priority=0):
+        item = self.queue.submit(text, self._voice(voice), aws_region, priority)
+        if item is not None:
+            with self.mutex:
+                self.items[item.id] = item
+                while len(self.items) > self.max_items:
+                    self.items.popitem(last=False)
+        return item
+
+    def get_item(self, item_id):
+        with self.mutex:
+            return self.items.get(item_id)
+
+    def cancel(self, item_id=None):
+        """ Cancels one item, or every pending one if item_id is None; returns the number cancelled. """
+        if item_id is None:
+            with self.mutex:
+                items = list(self.items.values())
+        else:
+            item = self.get_item(item_id)
+            items = [item] if item is not None else []
+        return sum(1 for item in items if self.queue.cancel(item))
+
+    def prefetch(self, text, voice=None, aws_region='us-east-1'):
+        """ Synthesizes text into the cache in the background; False if already underway. """
+        key = (text, self._voice(voice), aws_region)
+        with self.mutex:
+            if key in self.prefetching:
+                return False
+            self.prefetching.add(key)
+        self.prefetch_pool.apply_async(self._prefetch, (key,))
+        return True
+
+    def _prefetch(self, key):
+        try:
+            self.bass.synthesize(*key)
+            with self.mutex:
+                self.num_prefetched += 1
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.mutex:
+                self.prefetching.discard(key)
+
+    def status(self):
+        with self.mutex:
+            num_prefetching = len(self.prefetching)
+            num_prefetched = self.num_prefetched
+        return {
+            'pending': len(self.queue),
+            'dropped': self.queue.num_dropped,
+            'merged': self.queue.num_merged,
+            'preempted': self.queue.num_preempted,
+            'prefetching': num_prefetching,
+            'prefetched': num_prefetched,
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.prefetch_pool.terminate()
+
+
+class SpeechClient(object):
+    """ Thin client for a SpeechServer; methods raise IOError if it is unreachable. """
+
+    def __init__(self, url='http://127.0.0.1:%d' % DEFAULT_PORT, timeout_sec=5.):
+        self.url = url.rstrip('/')
+        self.timeout_sec = timeout_sec
+
+    def _request(self, path, body=None, blocking=False):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        response = urlopen(request, timeout=None if blocking else self.timeout_sec)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    def speak(self, text, voice=None, aws_region='us-east-1', priority=0, wait=False):
+        """Queues text; returns its item id, or None if it was dropped or
+        merged. With wait, returns once it has played (no timeout).
+        """
+        result = self._request('/speak', {
+            'text': text, 'voice': voice, 'aws_region': aws_region,
+            'priority': priority, 'wait': wait}, blocking=wait)
+        return result['id']
+
+    def prefetch(self, text, voice=None, aws_region='us-east-1'):
+        return self._request('/prefetch', {'text': text, 'voice': voice, 'aws_region': aws_region})['queued']
+
+    def cancel(self, item_id=None):
+        """ Cancels an item, or everything pending if item_id is None. """
+        return self._request('/cancel', {'id': item_id})['cancelled']
+
+    def state(self, item_id):
+        return self._request('/items/%d' % item_id)['state']
+
+    def status(self):
+        return self._request('/status')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve pibass speech to local clients over HTTP')
+    parser.add_argument('--host', help='Address to listen on [127.0.0.1]', type=str, default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on [%d]' % DEFAULT_PORT, type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        '--aws_region', help='AWS Region [us-east-1]', type=str, default='us-east-1')
+    parser.add_argument(
+        '--polly_voice_id', help='Voice when a request has none [Kimberly]', type=str, default='Kimberly')
+    parser.add_argument('--audio_cache_path', help='TTS cache directory [/home/pi/pibass_cache]',
+                        type=str, default='/home/pi/pibass_cache')
+    parser.add_argument('--mp3_sample_rate', help='MP3 Sample Rate [22050]', type=int, default=22050)
+    parser.add_argument('--synthesis_mode', help='Polly output: mp3 or pcm [mp3]',
+                        type=str, default='mp3', choices=('mp3', 'pcm'))
+    parser.add_argument('--pcm_sample_rate', help='PCM Sample Rate [16000]', type=int, default=16000)
+    parser.add_argument('--playback_mode', help='blocking or callback [blocking]',
+                        type=str, default='blocking', choices=('blocking', 'callback'))
+    parser.add_argument('--max_pending', help='Max queued utterances [10]', type=int, default=10)
+    parser.add_argument('--num_synth_workers', help='Concurrent synthesis for the queue [2]', type=int, default=2)
+    parser.add_argument('--num_prefetch_workers', help='Concurrent prefetch synthesis [2]', type=int, default=2)
+    parser.add_argument('--overflow_policy', help='drop_oldest, drop_newest or block [drop_oldest]',
+                        type=str, default='drop_oldest')
+    parser.add_argument('--preempt_priority', help='Min priority that interrupts playback [urgent]',
+                        type=str, default='urgent')
+    parser.add_argument('--preempt_policy', help='defer or drop interrupted items [defer]',
+                        type=str, default='defer', choices=('defer', 'drop'))
+    parser.add_argument('--local_tts', help='Local engine to use when Polly is slow: espeak-ng, espeak or pico',
+                        type=str, default=None)
+    parser.add_argument('--hedge_deadline_sec',
+                        help='Seconds to wait for Polly before using --local_tts', type=float, default=None)
+    args = parser.parse_args()
+
+    bass = PiBassAudio(args, audio_cache_path=args.audio_cache_path)
+    queue = SpeechQueue(bass,
+                        max_pending=args.max_pending,
+                        num_synth_workers=args.num_synth_workers,
+                        overflow_policy=args.overflow_policy,
+                        preempt_priority=args.preempt_priority,
+                        preempt_policy=args.preempt_policy)
+    server = SpeechServer(queue, args.host, args.port, args.num_prefetch_workers)
+    print('serving on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.prefetch_pool.terminate()
+        queue.terminate()
+        bass.terminate()
+
+
+if __name__ == '__main__':
+    main()
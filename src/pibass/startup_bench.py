@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+try:
+    from .pibass_motors import percentile
+except (ImportError, ValueError) as err:
+    from pibass_motors import percentile
+
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PLUGIN_PATH = os.path.join(PACKAGE_PARENT, 'rtmbot')
+HEAVY_MODULES = ('boto3', 'botocore', 'numpy', 'aubio', 'pyaudio', 'pydub', 'Adafruit_MotorHAT', 'googletrans')
+
+# Run in a fresh interpreter per sample, so nothing is already imported
+STARTUP_SCRIPT = '''
+import json, sys, time
+clock = getattr(time, 'monotonic', time.time)
+result = {}
+start_t = clock()
+import pibass
+result['import_sec'] = clock() - start_t
+result['heavy_modules'] = [name for name in %(heavy_modules)r if name in sys.modules]
+if %(plugin_path)r:
+    sys.path.insert(0, %(plugin_path)r)
+    from plugins.pibassbot import TTSPlugin
+    start_t = clock()
+    plugin = TTSPlugin(plugin_config=%(plugin_config)r)
+    result['plugin_init_sec'] = clock() - start_t
+    plugin.ready.wait()
+    result['plugin_ready_sec'] = clock() - start_t
+print(json.dumps(result))
+'''
+
+
+def measure_startup(plugin_path=None, plugin_config=None, importtime=False):
+    """Runs STARTUP_SCRIPT in a new interpreter; returns its result, and the
+    -X importtime report (Python 3.7+) as its stderr if importtime.
+    """
+    script = STARTUP_SCRIPT % {
+        'heavy_modules': HEAVY_MODULES,
+        'plugin_path': plugin_path,
+        'plugin_config': plugin_config or {},
+    }
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, (PACKAGE_PARENT, env.get('PYTHONPATH'))))
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', script]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('startup script failed:\n%s' % stderr.decode('utf-8', 'replace'))
+    result = json.loads(stdout.decode('utf-8').strip().splitlines()[-1])
+    return result, stderr.decode('utf-8', 'replace')
+
+
+def slowest_imports(importtime_report, n=15):
+    """ [(cumulative sec, module)] of the n slowest imports in an -X importtime report. """
+    imports = []
+    for line in importtime_report.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]) / 1e6, fields[2].strip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def bench_startup():
+    parser = argparse.ArgumentParser(description='Time import pibass and TTSPlugin construction')
+    parser.add_argument('--num_runs', help='Fresh interpreters to time [5]', type=int, default=5)
+    parser.add_argument('--plugin_path', help='Directory containing plugins/pibassbot.py [%s]' % DEFAULT_PLUGIN_PATH,
+                        type=str, default=DEFAULT_PLUGIN_PATH)
+    parser.add_argument('--no_plugin', help='Only time import pibass (e.g. without rtmbot)', action='store_true')
+    parser.add_argument('--use_googletrans', help='Have the plugin start googletrans', action='store_true')
+    parser.add_argument('--importtime', help='Also list the slowest imports', action='store_true')
+    parser.add_argument('--output', help='Write the JSON report here [stdout]', type=str, default=None)
+    args = parser.parse_args()
+
+    plugin_path = None if args.no_plugin else args.plugin_path
+    plugin_config = {'use_googletrans': args.use_googletrans}
+    results = [measure_startup(plugin_path, plugin_config)[0] for i in range(args.num_runs)]
+
+    report = {
+        'python': sys.version.split()[0],
+        'num_runs': args.num_runs,
+        'heavy_modules_on_import': results[-1]['heavy_modules'],
+    }
+    for key in ('import_sec', 'plugin_init_sec', 'plugin_ready_sec'):
+        values = [result[key] for result in results if key in result]
+        if len(values) > 0:
+            report[key] = {'min': min(values), 'p50': percentile(values, 50), 'max': max(values)}
+    if args.importtime:
+        report['slowest_imports_sec'] = [
+            [module, sec] for sec, module in slowest_imports(measure_startup(plugin_path, plugin_config, True)[1])]
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    bench_startup()
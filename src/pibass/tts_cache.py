@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+import collections
+import hashlib
+import json
+import os
+import pickle as pkl
+import tempfile
+import threading
+import time
+import traceback
+
+
+class _LegacyCacheUnpickler(pkl.Unpickler):
+    """Resolves LimitedSizeDict whether the old cache was pickled from the
+    pibass package or from running audio_utils.py / pibass_audio.py directly.
+    """
+
+    def find_class(self, module, name):
+        if module in ('audio_utils', 'pibass_audio') or module.endswith('.audio_utils'):
+            try:
+                from . import audio_utils
+            except (ImportError, ValueError):
+                import audio_utils
+            return getattr(audio_utils, name)
+        return pkl.Unpickler.find_class(self, module, name)
+
+
+def _legacy_text(text):
+    """ Text from a Python 2 pickle: UTF-8 encoded str was unpickled as latin-1. """
+    try:
+        return text.encode('latin1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):  # was unicode already
+        return text
+
+
+def tts_cache_key(text, polly_voice_id, synthesis_mode, sample_rate):
+    """TTSCacheStore key of the Polly audio and onsets of text, as PiBassAudio
+    looks them up and prewarm stores them.
+    """
+    if synthesis_mode == 'pcm':
+        return (text, polly_voice_id, sample_rate, 'pcm')
+    return (text, polly_voice_id, sample_rate)
+
+
+def cache_key_digest(key):
+    """ Returns hex digest identifying a cache key tuple, e.g. (text, voice, sample_rate). """
+    return hashlib.sha1(json.dumps(list(key)).encode('ascii')).hexdigest()
+
+
+class TTSCacheStore(object):
+    """Content-addressed on-disk cache of synthesized speech.
+
+    Each entry is stored in its own file under <root>/<digest[:2]>/<digest>,
+    and written atomically via rename. The index file is an append-only log
+    of '+<digest> <size>' / '-<digest>' lines replayed in LRU order, which is
+    loaded on first access and compacted by flush().
+
+    Disk errors never propagate to callers: if the cache directory cannot
+    be used at all, the store logs why and stays empty, so speech is just
+    synthesized uncached; a failed put only loses that entry.
+    """
+
+    INDEX_FILENAME = 'index'
+
+    def __init__(self,
+                 root_path,
+                 size_limit=5000,
+                 byte_limit=None,
+                 flush_interval_sec=120,
+                 legacy_path=None,
+                 legacy_sample_rate=22050):
+        self.root_path = root_path
+        self.index_path = os.path.join(root_path, self.INDEX_FILENAME)
+        self.size_limit = size_limit
+        self.byte_limit = byte_limit
+        self.flush_interval_sec = flush_interval_sec
+        self.legacy_path = legacy_path
+        self.legacy_sample_rate = legacy_sample_rate
+
+        self.mutex = threading.RLock()
+        self.index = None  # digest -> size, oldest first; loaded lazily
+        self.total_bytes = 0
+        self.index_dirty = False
+        self.flush_time = time.time()
+        self.disabled = False  # set if the cache directory is unusable
+
+    def __contains__(self, key):
+        return cache_key_digest(key) in self._get_index()
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def entry_path(self, digest):
+        return os.path.join(self.root_path, digest[:2], digest)
+
+    def get(self, key, default=None):
+        digest = cache_key_digest(key)
+        index = self._get_index()
+        with self.mutex:
+            if digest not in index:
+                return default
+        try:
+            with open(self.entry_path(digest), 'rb') as fh:
+                stored_key, value = pkl.load(fh)
+        except (IOError, OSError, EOFError, pkl.UnpicklingError):
+            with self.mutex:
+                self._discard(digest)
+            return default
+        if tuple(stored_key) != tuple(key):
+            return default
+        with self.mutex:
+            if digest in index:  # mark as most recently used
+                index[digest] = index.pop(digest)
+                self.index_dirty = True
+        return value
+
+    def put(self, key, value):
+        digest = cache_key_digest(key)
+        self._get_index()
+        if self.disabled:
+            return
+        path = self.entry_path(digest)
+        shard_dir = os.path.dirname(path)
+        if not os.path.isdir(shard_dir):
+            try:
+                os.makedirs(shard_dir)
+            except OSError:  # created concurrently, or mkstemp fails below
+                pass
+
+        # Write to a temp file in the same shard, then atomically replace
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=shard_dir, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as fh:
+                pkl.dump((tuple(key), value), fh, protocol=2)
+                fh.flush()
+                os.fsync(fh.fileno())
+            size = os.path.getsize(tmp_path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):  # e.g. disk full; leave the entry uncached
+            traceback.print_exc()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return
+
+        with self.mutex:
+            self.total_bytes -= self.index.pop(digest, 0)
+            self.index[digest] = size
+            self.total_bytes += size
+            self._append_index('+%s %d\n' % (digest, size))
+            self._evict()
+
+    def flush(self, forced=False):
+        """ Rewrites the index in current LRU order (throttled unless forced). """
+        with self.mutex:
+            if self.index is None or not self.index_dirty:
+                return
+            now = time.time()
+            if not forced and now - self.flush_time < self.flush_interval_sec:
+                return
+            self.flush_time = now
+            try:
+                self._write_index()
+            except (IOError, OSError):
+                traceback.print_exc()
+
+    def _get_index(self):
+        if self.index is None:
+            with self.mutex:
+                if self.index is None:
+                    try:
+                        self._load_index()
+                    except (IOError, OSError):
+                        traceback.print_exc()
+                        print('TTS cache %s is unusable; speech will not be cached' % self.root_path)
+                        self.index = collections.OrderedDict()
+                        self.total_bytes = 0
+                        self.disabled = True
+        return self.index
+
+    def _load_index(self):
+        index = collections.OrderedDict()
+        if not os.path.isdir(self.root_path):
+            os.makedirs(self.root_path)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as fh:
+                for line in fh:
+                    line = line.strip()
+                    if line.startswith('+'):
+                        digest, size = line[1:].split(' ')
+                        index.pop(digest, None)
+                        index[digest] = int(size)
+                    elif line.startswith('-'):
+                        index.pop(line[1:], None)
+        else:
+            # Rebuild from entry files (e.g. index deleted), oldest first
+            entries = []
+            for shard in os.listdir(self.root_path):
+                shard_dir = os.path.join(self.root_path, shard)
+                if len(shard) != 2 or not os.path.isdir(shard_dir):
+                    continue
+                for digest in os.listdir(shard_dir):
+                    if digest.startswith('.tmp-'):
+                        continue
+                    st = os.stat(os.path.join(shard_dir, digest))
+                    entries.append((st.st_mtime, digest, st.st_size))
+            for _, digest, size in sorted(entries):
+                index[digest] = size
+
+        self.index = index
+        self.total_bytes = sum(index.values())
+        self._write_index()
+
+        if self.legacy_path is not None and os.path.exists(self.legacy_path):
+            self.migrate_pickle(self.legacy_path, self.legacy_sample_rate)
+
+    def migrate_pickle(self, legacy_path, sample_rate):
+        """One-shot import of the old LimitedSizeDict pickle, keyed by (text, voice).
+
+        The old cache was written by Python 2, whose str values (the MP3
+        bytes, and non-unicode text) unpickle as latin-1 text here.
+        """
+        try:
+            with open(legacy_path, 'rb') as fh:
+                legacy_cache = _LegacyCacheUnpickler(fh, encoding='latin1').load()
+            for (text, polly_voice_id), (audio_stream, onsets) in legacy_cache.items():
+                if not isinstance(audio_stream, bytes):
+                    audio_stream = audio_stream.encode('latin1')
+                self.put(tts_cache_key(_legacy_text(text), _legacy_text(polly_voice_id), 'mp3', sample_rate),
+                         (audio_stream, onsets))
+            self.flush(forced=True)
+            os.rename(legacy_path, legacy_path + '.migrated')
+            print('Migrated %d entries from %s' % (len(legacy_cache), legacy_path))
+        except (IOError, OSError, pkl.UnpicklingError, UnicodeDecodeError, AttributeError):
+            traceback.print_exc()
+
+    def _discard(self, digest):
+        if digest not in self.index:
+            return
+        self.total_bytes -= self.index.pop(digest)
+        self._append_index('-%s\n' % digest)
+        try:
+            os.remove(self.entry_path(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while len(self.index) > 0 and (
+                (self.size_limit is not None and len(self.index) > self.size_limit) or
+                (self.byte_limit is not None and self.total_bytes > self.byte_limit)):
+            self._discard(next(iter(self.index)))
+
+    def _append_index(self, line):
+        try:
+            with open(self.index_path, 'a') as fh:
+                fh.write(line)
+        except (IOError, OSError):
+            traceback.print_exc()
+
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_path, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fh:
+            for digest, size in self.index.items():
+                fh.write('+%s %d\n' % (digest, size))
+        os.rename(tmp_path, self.index_path)
+        self.index_dirty = False
+
+
+class DecodedAudioCache(object):
+    """In-memory LRU of playback-ready values (e.g. PreparedSpeech), bounded
+    by their total size in bytes, so that hits need no decoding or copying.
+    """
+
+    def __init__(self, byte_limit=32*1024*1024):
+        self.byte_limit = byte_limit
+        self.entries = collections.OrderedDict()  # key -> (value, num_bytes)
+        self.total_bytes = 0
+        self.mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.mutex:
+            if key not in self.entries:
+                return default
+            entry = self.entries.pop(key)
+            self.entries[key] = entry  # mark as most recently used
+            return entry[0]
+
+    def put(self, key, value, num_bytes):
+        with self.mutex:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if num_bytes > self.byte_limit:
+                return
+            self.entries[key] = (value, num_bytes)
+            self.total_bytes += num_bytes
+            while self.total_bytes > self.byte_limit:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+
+
+class DecodedAudioPolicy(object):
+    """Decides when decoded PCM should also be persisted in the TTSCacheStore,
+    trading disk space (PCM is ~10x larger than MP3) for ffmpeg time.
+
+    Decoded PCM is persisted once an entry has been decoded at least
+    min_decodes times, and only if it costs at most max_bytes_per_decode_sec
+    of disk per second of decoding saved on each later hit. Short clips,
+    where ffmpeg start-up dominates, are favoured.
+    """
+
+    def __init__(self, min_decodes=2, max_bytes_per_decode_sec=16*1024*1024, max_tracked=5000):
+        self.min_decodes = min_decodes
+        self.max_bytes_per_decode_sec = max_bytes_per_decode_sec
+        self.max_tracked = max_tracked
+        self.decode_stats = collections.OrderedDict()  # key -> (num_decodes, total_decode_sec)
+        self.mutex = threading.Lock()
+
+    def record_decode(self, key, decode_sec, num_bytes):
+        """ Returns True if the decoded PCM for key should be persisted. """
+        with self.mutex:
+            num_decodes, total_sec = self.decode_stats.pop(key, (0, 0.))
+            num_decodes, total_sec = num_decodes + 1, total_sec + decode_sec
+            self.decode_stats[key] = (num_decodes, total_sec)
+            while len(self.decode_stats) > self.max_tracked:
+                self.decode_stats.popitem(last=False)
+        if self.min_decodes is None or num_decodes < self.min_decodes:
+            return False
+        return num_bytes <= self.max_bytes_per_decode_sec * (total_sec / num_decodes)
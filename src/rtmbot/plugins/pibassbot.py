@@ -3,7 +3,8 @@ from __future__ import unicode_literals
 
 from rtmbot.core import Plugin
 import re
-import googletrans
+import threading
+import traceback
 
 import pibass
 
@@ -20,42 +21,147 @@ def filter_text(msg):
 class TTSPlugin(Plugin):
     def __init__(self, *kargs, **kwargs):
         super(TTSPlugin, self).__init__(*kargs, **kwargs)
-        self.trans = googletrans.Translator()
-        self.bass = pibass.PiBassAudio(args=None)
+
+        config = getattr(self, 'plugin_config', None) or {}
+
+        # Per-stage timings and cache counters, off unless exported
+        self.metrics_path = config.get('metrics_path', None)
+        if config.get('metrics_port') or self.metrics_path:
+            pibass.metrics.enable()
+        if config.get('metrics_port'):
+            pibass.metrics.serve_prometheus(config['metrics_port'])
+
+        # Messages as spoken, for replay by pibass.replay_bench
+        self.trace_path = config.get('trace_path', None)
+
+        # Voices from cached Polly describe_voices output, if configured
+        if config.get('voice_db_path'):
+            pibass.load_voice_db(config['voice_db_path'])
+
+        self.priority = pibass.priority_level(config.get('speech_priority', 'normal'))
+        self.urgent_prefix = config.get('urgent_prefix', None)
+
+        # The motor HAT, audio device, Polly client and googletrans start up
+        # in the background, so that the bot connects to Slack right away;
+        # messages arriving before then wait for them
+        self.language_detector = None
+        self.bass = None
+        self.speech_client = None
+        self.speech_queue = None
+        self.ready = threading.Event()
+        thread = threading.Thread(target=self._start_up, args=(config,))
+        thread.daemon = True
+        thread.start()
+
+    def _start_up(self, config):
+        try:
+            with pibass.metrics.span('start_up'):
+                self._start_language_detector(config)
+                self._start_speech(config)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.ready.set()
+
+    def _start_language_detector(self, config):
+        # Detect languages offline, asking Google Translate only when unsure
+        fallback = None
+        if config.get('use_googletrans', True):
+            try:
+                fallback = pibass.GoogleTransDetector()
+            except ImportError:
+                print('googletrans not installed; detecting languages offline only')
+        if config.get('language_profiles_path'):
+            detector = pibass.NGramLanguageDetector.from_file(config['language_profiles_path'])
+        else:
+            detector = pibass.NGramLanguageDetector()
+        self.language_detector = pibass.CachedLanguageDetector(
+            detector,
+            fallback=fallback,
+            min_confidence=config.get('language_min_confidence', 0.5),
+            cache_size=config.get('language_cache_size', 1024),
+            default_language=config.get('default_language', 'en'),
+            default_min_confidence=config.get('default_language_min_confidence', 0.3))
+
+    def _start_speech(self, config):
+        # Speak through a shared speech server if configured; otherwise own
+        # the fish, and synthesize upcoming messages while the current one plays
+        if config.get('speech_server_url'):
+            self.speech_client = pibass.SpeechClient(config['speech_server_url'])
+            return
+        self.bass = pibass.PiBassAudio(
+            args=None,
+            local_tts=config.get('local_tts', None),
+            hedge_deadline_sec=config.get('hedge_deadline_sec', None))
+        self.bass.warm_up()
+        self.speech_queue = pibass.SpeechQueue(
+            self.bass,
+            max_pending=config.get('max_pending', 10),
+            num_synth_workers=config.get('num_synth_workers', 2),
+            prefetch=config.get('prefetch', 3),
+            overflow_policy=config.get('overflow_policy', 'drop_oldest'),
+            merge_policy=config.get('merge_policy', None),
+            preempt_priority=config.get('preempt_priority', 'urgent'),
+            preempt_policy=config.get('preempt_policy', 'defer'))
 
     """
   Returns language_code, confidence
 
-  Implementation uses unofficial Google Translate API.
+  Implementation uses local n-gram profiles, falling back to the unofficial
+  Google Translate API for low-confidence results.
   """
 
     def detect_language(self, text):
-        result = self.trans.detect(text)
-        return result.lang, result.confidence
+        return self.language_detector.detect(text)
 
     def process_message(self, data):
         if 'text' in data:
-            # Extract message
-            msg = filter_text(data['text'])
-
-            # Identify voice
-            match = re.search("^\[.*\]", msg)
-            if match is not None:  # Scan for manual language/gender/voice
-                query = msg[1:match.end()-1]
-                msg = msg[match.end():].strip()
-                voice, gender, lang_code = pibass.get_voice(query)
-            else:  # Detect language
-                lang, lang_conf = self.detect_language(msg)
-                lang = lang.lower()
-                voice, gender, lang_code = pibass.get_voice(lang)
-                if voice is None and len(lang) > 2:
-                    lang = lang[:2]
-                    voice, gender, lang_code = pibass.get_voice(lang)
-            if voice is None:  # Default to English
-                voice, gender, lang_code = pibass.get_voice('en')
-
-            # Synthesize voice
-            print('- msg: %s\n- voice: %s\n-lang: %s\n\n' %
-                  (msg, voice, lang_code))
-            self.bass.speak(msg, voice)
+            with pibass.metrics.span('process_message'):
+                self._process_text(data['text'])
+            if self.metrics_path:
+                pibass.metrics.write_prometheus(self.metrics_path)
         #  self.outputs.append([data['channel'], 'from repeat1 "{}" in channel {}'.format(data['text'], data['channel'])])
+
+    def _process_text(self, text):
+        self.ready.wait()
+        if self.language_detector is None or (self.speech_client is None and self.speech_queue is None):
+            print('pibass failed to start; dropping message')
+            return
+
+        # Extract message
+        with pibass.metrics.span('filter_text'):
+            msg = filter_text(text)
+
+        # Urgent messages interrupt whatever is being said
+        priority = self.priority
+        if self.urgent_prefix and msg.startswith(self.urgent_prefix):
+            msg = msg[len(self.urgent_prefix):].strip()
+            priority = pibass.PRIORITY_LEVELS['urgent']
+
+        # Identify voice
+        match = re.search("^\[.*\]", msg)
+        if match is not None:  # Scan for manual language/gender/voice
+            query = msg[1:match.end()-1]
+            msg = msg[match.end():].strip()
+        else:  # Detect language
+            with pibass.metrics.span('detect_language'):
+                query, lang_conf = self.detect_language(msg)
+            query = query or self.language_detector.default_language  # e.g. only emoji or digits
+        # Falls back to base language, then to English
+        with pibass.metrics.span('resolve_voice'):
+            voice, gender, lang_code = pibass.resolve_voice(query)
+
+        # Synthesize voice
+        print('- msg: %s\n- voice: %s\n-lang: %s\n\n' %
+              (msg, voice, lang_code))
+        if self.trace_path:
+            pibass.append_trace(self.trace_path, msg, voice, priority)
+
+        with pibass.metrics.span('submit'):
+            if self.speech_client is not None:
+                try:
+                    self.speech_client.speak(msg, voice, priority=priority)
+                except IOError as err:
+                    print('speech server unreachable: %s' % err)
+            else:
+                self.speech_queue.submit(msg, voice, priority=priority)
@@ -0,0 +1,52 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# pibass is not installed; import it from the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+PCM_RATE = 16000
+
+
+class FakeTTS(object):
+    """Stands in for PiBassAudio._tts: sec of silence per text, with no Polly.
+    Texts containing 'slow' wait until release is set.
+    """
+
+    def __init__(self, bass, sec=0.3):
+        self.bass = bass
+        self.sec = sec
+        self.release = threading.Event()
+
+    def __call__(self, text, polly_voice_id, aws_region):
+        if 'slow' in text:
+            self.release.wait(10.)
+        onsets = [0.1, self.sec]
+        return b'\0\0' * int(PCM_RATE * self.sec), onsets, self.bass.onset_timeline(onsets), None
+
+
+@pytest.fixture
+def make_bass(tmp_path):
+    """ Returns PiBassAudio(**kwargs) on a SimulatedMotorHAT and NullAudioDevice, with FakeTTS. """
+    from pibass.audio_output import NullAudioDevice
+    from pibass.pibass_audio import PiBassAudio
+    from pibass.simulated_hat import SimulatedMotorHAT
+
+    basses = []
+
+    def make_bass(tts_sec=0.3, **kwargs):
+        kwargs.setdefault('post_speech_pause_sec', 0.)
+        bass = PiBassAudio(audio_cache_path=str(tmp_path / ('cache%d' % len(basses))),
+                           legacy_audio_cache_path=None, synthesis_mode='pcm', pcm_sample_rate=PCM_RATE,
+                           hat=SimulatedMotorHAT(), polly_client=object(), polly_warm_up=False,
+                           audio_dev=NullAudioDevice(), **kwargs)
+        bass._tts = FakeTTS(bass, tts_sec)
+        basses.append(bass)
+        return bass
+
+    yield make_bass
+    for bass in basses:
+        bass._tts.release.set()
+        bass.terminate()
@@ -0,0 +1,26 @@
+import asyncio
+import time
+
+from pibass.async_audio import AsyncPiBassAudio
+
+
+def test_speak_and_cancel(make_bass):
+    bass = make_bass(tts_sec=2.)
+
+    async def main():
+        async with AsyncPiBassAudio(bass) as async_bass:
+            speech = await async_bass.synthesize('Hello there.', 'Joanna')
+            assert speech.duration_sec == 2.
+
+            start_t = time.time()
+            task = asyncio.ensure_future(async_bass.play(speech))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return time.time() - start_t
+
+    # Cancelled within an audio block, not after the whole 2 sec utterance
+    assert asyncio.run(main()) < 1.
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+from pibass.audio_utils import split_text_chunks
+from pibass.pibass_audio import ChunkedSpeech
+
+
+def test_split_text_chunks_by_sentence():
+    assert split_text_chunks('First sentence is here. Second one is here too! And here is a third?') == [
+        'First sentence is here.', 'Second one is here too!', 'And here is a third?']
+
+
+def test_split_text_chunks_joins_short_sentences():
+    assert split_text_chunks('Hi. Ok. This is the real sentence.') == ['Hi. Ok. This is the real sentence.']
+    assert split_text_chunks('A sentence long enough. Bye.') == ['A sentence long enough. Bye.']
+
+
+def test_split_text_chunks_splits_long_sentences_into_clauses():
+    text = 'one, two, three; ' * 10 + 'end.'
+    chunks = split_text_chunks(text, max_chunk_chars=40)
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    assert ' '.join(chunks) == text.strip()
+
+
+def test_split_text_chunks_cjk():
+    assert split_text_chunks(u'你好世界。今天天气很好。',
+                             min_chunk_chars=1) == [u'你好世界。', u'今天天气很好。']
+
+
+@pytest.fixture(params=['blocking', 'callback'])
+def bass(request, make_bass):
+    return make_bass(playback_mode=request.param, chunked=True)
+
+
+def test_chunks_play_back_to_back(bass):
+    speech = bass.synthesize('This is the first sentence. And this is the second one.', 'Joanna')
+    assert isinstance(speech, ChunkedSpeech) and len(speech) == 2
+    bass.play(speech)
+    assert bass.num_chunk_gaps == 0
+
+
+def test_stop_while_waiting_for_next_chunk(bass):
+    # Chunk 0 plays out while chunk 1 is still being synthesized
+    speech = bass.synthesize('This is the first sentence. Then a slow second sentence.', 'Joanna')
+    thread = threading.Thread(target=bass.play, args=(speech,))
+    thread.start()
+    time.sleep(0.5)
+    stop_t = time.time()
+    bass.stop()
+    thread.join(2.)
+    assert not thread.is_alive()
+    assert time.time() - stop_t < 0.25
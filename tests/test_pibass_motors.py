@@ -0,0 +1,156 @@
+import importlib
+import time
+
+import pytest
+
+from pibass import pibass_motors
+from pibass.motor_timeline import MotorTimeline
+from pibass.pibass_motors import (PiBassMotors, PiBassAsyncMotors, MotorScheduler, MotorEvent,
+                                  MotorHATBatchWriter, coalesce_motor_events, monotonic_time)
+from pibass.simulated_hat import SimulatedMotorHAT
+
+FORWARD, BACKWARD, RELEASE = SimulatedMotorHAT.FORWARD, SimulatedMotorHAT.BACKWARD, SimulatedMotorHAT.RELEASE
+NO_RUN_ARG, NO_SPEED = MotorEvent.NO_RUN_ARG, MotorEvent.NO_SPEED
+
+
+def adafruit_missing():
+    try:
+        importlib.import_module('Adafruit_MotorHAT')
+        return False
+    except ImportError:
+        return True
+
+
+@pytest.mark.skipif(not adafruit_missing(), reason='Adafruit_MotorHAT is installed')
+def test_warns_when_falling_back_to_simulated_hat(capsys):
+    motors = PiBassMotors()
+    try:
+        assert isinstance(motors.hat, SimulatedMotorHAT)
+        assert 'WARNING' in capsys.readouterr().out
+    finally:
+        motors.terminate()
+
+
+def test_no_warning_for_a_requested_simulated_hat(capsys):
+    motors = PiBassMotors(SimulatedMotorHAT())
+    motors.move_mouth(delay_move=0., delay_open=0.)
+    motors.terminate()
+    assert pibass_motors.Adafruit_MotorHAT.RELEASE == SimulatedMotorHAT.RELEASE
+    assert 'WARNING' not in capsys.readouterr().out
+
+
+@pytest.fixture
+def motors():
+    motors = PiBassAsyncMotors(SimulatedMotorHAT())
+    motors.lateness_log = []
+    yield motors
+    motors.terminate()
+
+
+def wait_for_events(motors, num_events, timeout=2.):
+    end_t = time.time() + timeout
+    while motors.num_motor_events < num_events:
+        assert time.time() < end_t, 'timed out'
+        time.sleep(0.005)
+
+
+def test_events_fire_in_time_order_on_time(motors):
+    start_t = monotonic_time() + 0.05
+    # Pushed out of order, the earliest last, so that it must wake up the event thread
+    for dt, speed in ((0.1, 30), (0.05, 20), (0., 10)):
+        motors.push_event(start_t + dt, 1, NO_RUN_ARG, speed)
+    wait_for_events(motors, 3)
+    calls = motors.hat.trace.entries()
+    assert [value for t, motor_num, call, value in calls] == [10, 20, 30]
+    assert [round(t - start_t, 2) for t, motor_num, call, value in calls] == [0., 0.05, 0.1]
+    assert max(motors.lateness_log) < 0.02
+
+
+def test_clear_drops_pending_events(motors):
+    timeline = MotorTimeline.from_onsets([0.2, 0.5])
+    start_t = monotonic_time() + 0.2
+    motors.push_event(start_t, 1, FORWARD, 255)
+    motors.add_timeline(timeline, start_t)
+    assert motors.last_event_time() is not None
+    motors.clear_all_events()
+    assert motors.last_event_time() is None and motors.dump_events() == []
+    time.sleep(0.3)
+    assert motors.num_motor_events == 0
+
+
+def test_event_thread_idles_without_events():
+    scheduler = MotorScheduler()
+    start_cpu_sec = time.process_time()
+    time.sleep(0.3)
+    cpu_sec = time.process_time() - start_cpu_sec
+    scheduler.terminate()
+    assert not scheduler.event_loop_active
+    assert cpu_sec < 0.05
+
+
+def test_coalesce_motor_events():
+    assert coalesce_motor_events([
+        (2, FORWARD, 255), (1, NO_RUN_ARG, 0), (2, NO_RUN_ARG, 0), (2, RELEASE, NO_SPEED),
+    ]) == [(2, 0, RELEASE), (1, 0, None)]
+    assert coalesce_motor_events([(3, BACKWARD, NO_SPEED)]) == [(3, None, BACKWARD)]
+
+
+def test_same_deadline_events_are_one_write_per_motor(motors):
+    t = monotonic_time() + 0.05
+    motors.push_event(t, 2, FORWARD, 255)
+    motors.push_event(t, 2, NO_RUN_ARG, 100)
+    motors.push_event(t, 2, BACKWARD, NO_SPEED)
+    motors.push_event(t, 1, RELEASE, 0)
+    wait_for_events(motors, 4)
+    calls = [(motor_num, call, value) for t, motor_num, call, value in motors.hat.trace.entries()]
+    assert calls == [(2, 'setSpeed', 100), (2, 'run', BACKWARD), (1, 'setSpeed', 0), (1, 'run', RELEASE)]
+    assert motors.num_i2c_writes_saved == 36 - 24  # 4 bytes per setSpeed and 8 per run, 9 calls down to 4
+
+
+class FakeI2C(object):
+    def __init__(self):
+        self.registers = {}
+        self.block_writes = []
+
+    def readU8(self, register):
+        return self.registers.get(register, 0)
+
+    def write8(self, register, value):
+        self.registers[register] = value
+
+    def writeList(self, register, data):
+        self.block_writes.append((register, list(data)))
+
+
+class FakeDCMotor(object):
+    def __init__(self, pwm_pin, in2_pin, in1_pin):
+        self.PWMpin, self.IN2pin, self.IN1pin = pwm_pin, in2_pin, in1_pin
+
+
+class FakeAdafruitHAT(object):
+    """ Adafruit_MotorHAT's PWM channel layout, over a FakeI2C. """
+
+    def __init__(self):
+        self._pwm = type('PWM', (object,), {})()
+        self._pwm.i2c = FakeI2C()
+        self.motors = [FakeDCMotor(8, 9, 10), FakeDCMotor(13, 12, 11),
+                       FakeDCMotor(2, 3, 4), FakeDCMotor(7, 6, 5)]
+
+
+def test_batch_writer_writes_runs_of_channels_in_one_block():
+    hat = FakeAdafruitHAT()
+    writer = MotorHATBatchWriter(hat)
+    assert hat._pwm.i2c.registers[MotorHATBatchWriter.MODE1] & MotorHATBatchWriter.MODE1_AI
+
+    # Motor 2: PWM 13, IN1 11, IN2 12 are consecutive channels 11-13
+    assert writer.write([(hat.motors[1], 255, FORWARD)]) == 1
+    register, data = hat._pwm.i2c.block_writes[0]
+    assert register == MotorHATBatchWriter.LED0_ON_L + 4 * 11
+    assert data == [0, 16, 0, 0,  # IN1 high
+                    0, 0, 0, 16,  # IN2 low
+                    0, 0, 240, 15]  # PWM 255 * 16
+
+    # Motors 1 and 2 together cover channels 8-13, two blocks of at most 8 channels
+    hat._pwm.i2c.block_writes = []
+    assert writer.write([(hat.motors[0], 0, RELEASE), (hat.motors[1], 0, RELEASE)]) == 1
+    assert len(hat._pwm.i2c.block_writes[0][1]) == 6 * 4
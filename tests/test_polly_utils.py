@@ -0,0 +1,39 @@
+import pytest
+
+from pibass import polly_utils
+from pibass.polly_utils import get_voice, resolve_voice
+
+
+def test_get_voice_by_language_gender_and_name():
+    assert get_voice('de') == ('Vicki', 'female', 'de')
+    assert get_voice('de, male') == ('Hans', 'male', 'de')
+    assert get_voice('Kimberly') == ('Kimberly', 'female', 'en-us')
+    assert get_voice('klingon') == (None, None, None)
+
+
+@pytest.mark.parametrize('query,voice', [
+    ('pt-xx', 'Ines'),  # regional code -> base language
+    ('it', 'Carla'),
+    ('HANS', 'Hans'),
+    (None, 'Joanna'),
+    ('zh-cn', 'Joanna'),  # unknown -> default
+])
+def test_resolve_voice_falls_back(query, voice):
+    assert resolve_voice(query)[0] == voice
+
+
+@pytest.mark.parametrize('tag', ['Nobody', 'devops', 'item', 'Isabel'])
+def test_resolve_voice_does_not_match_words_by_prefix(tag):
+    # Manual [tag]s that are not voices or language codes are spoken in English
+    assert resolve_voice(tag) == resolve_voice('en')
+
+
+def test_resolve_voice_is_memoized_per_voice_db():
+    assert resolve_voice('it')[0] == 'Carla'
+    voices = list(polly_utils.voice_db)
+    try:
+        polly_utils.set_voice_db([('Bianca', 'female', 'it')] + voices)
+        assert resolve_voice('it')[0] == 'Bianca'
+    finally:
+        polly_utils.set_voice_db(voices)
+    assert resolve_voice('it')[0] == 'Carla'
@@ -0,0 +1,167 @@
+import threading
+import time
+
+import pytest
+
+from pibass.speech_queue import SpeechQueue, PRIORITY_LEVELS, priority_level
+
+
+class FakeBass(object):
+    """ Synthesizes text as itself; plays each for play_sec unless stopped. """
+
+    def __init__(self, play_sec=0.2):
+        self.play_sec = play_sec
+        self.release = threading.Event()  # synthesis of texts containing 'slow' waits for it
+        self.played = []
+        self.started = []
+
+    def synthesize(self, text, polly_voice_id=None, aws_region='us-east-1'):
+        if 'slow' in text:
+            self.release.wait(5.)
+        return text
+
+    def play(self, speech, stop_event):
+        self.started.append(speech)
+        if not stop_event.wait(self.play_sec):
+            self.played.append(speech)
+
+
+@pytest.fixture
+def fake_queue():
+    queues = []
+
+    def fake_queue(play_sec=0.2, **kwargs):
+        queue = SpeechQueue(FakeBass(play_sec), **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield fake_queue
+    for queue in queues:
+        queue.bass.release.set()
+        queue.terminate()
+
+
+def wait_for(condition, timeout=2.):
+    end_t = time.time() + timeout
+    while not condition():
+        assert time.time() < end_t, 'timed out'
+        time.sleep(0.005)
+
+
+def test_priority_level():
+    assert priority_level('Urgent') == PRIORITY_LEVELS['urgent']
+    assert priority_level('5') == 5
+    with pytest.raises(ValueError):
+        priority_level('soon')
+
+
+def test_plays_by_priority_then_in_order(fake_queue):
+    queue = fake_queue()
+    first = queue.submit('first')
+    wait_for(lambda: first.playing)
+    queue.submit('low', priority='low')
+    queue.submit('normal 1')
+    queue.submit('high', priority='high')
+    queue.submit('normal 2')
+    queue.join()
+    assert queue.bass.played == ['first', 'high', 'normal 1', 'normal 2', 'low']
+
+
+def test_clear_keeps_only_the_playing_item(fake_queue):
+    queue = fake_queue()
+    items = [queue.submit(text) for text in ('one', 'two', 'three')]
+    wait_for(lambda: items[0].playing)
+    queue.clear()
+    queue.join()
+    assert queue.bass.played == ['one']
+    assert items[1].state == 'dropped' and items[2].state == 'dropped'
+
+
+def test_clear_drops_an_item_still_synthesizing(fake_queue):
+    queue = fake_queue()
+    item = queue.submit('slow to synthesize')
+    wait_for(lambda: item.synthesizing)
+    queue.clear()
+    assert len(queue) == 0 and item.state == 'dropped'
+    queue.bass.release.set()
+    time.sleep(0.1)
+    assert queue.bass.started == []
+
+
+@pytest.mark.parametrize('overflow_policy,played', [
+    ('drop_oldest', ['playing', 'c', 'd']),
+    ('drop_newest', ['playing', 'b', 'c']),
+])
+def test_overflow(fake_queue, overflow_policy, played):
+    queue = fake_queue(max_pending=3, overflow_policy=overflow_policy)
+    first = queue.submit('playing')
+    wait_for(lambda: first.playing)
+    for text in ('b', 'c', 'd'):
+        queue.submit(text)
+    queue.join()
+    assert queue.bass.played == played
+    assert queue.num_dropped == 1
+
+
+def test_full_queue_makes_room_for_higher_priority(fake_queue):
+    queue = fake_queue(max_pending=2, overflow_policy='drop_newest')
+    first = queue.submit('playing')
+    wait_for(lambda: first.playing)
+    queue.submit('normal')
+    assert queue.submit('high', priority='high') is not None
+    queue.join()
+    assert queue.bass.played == ['playing', 'high']
+
+
+def test_dedupe_and_concat(fake_queue):
+    queue = fake_queue(merge_policy='dedupe')
+    first = queue.submit('playing')
+    wait_for(lambda: first.playing)
+    assert queue.submit('again') is not None
+    assert queue.submit('again') is None
+    queue.join()
+    assert queue.bass.played == ['playing', 'again'] and queue.num_merged == 1
+
+    queue = fake_queue(merge_policy='concat', num_synth_workers=1, prefetch=0)
+    first = queue.submit('slow playing')
+    wait_for(lambda: first.synthesizing)
+    queue.submit('a')
+    queue.submit('b')
+    queue.bass.release.set()
+    queue.join()
+    assert queue.bass.played == ['slow playing', 'a b']
+
+
+@pytest.mark.parametrize('preempt_policy,played', [
+    ('defer', ['urgent', 'long', 'normal']),
+    ('drop', ['urgent']),
+])
+def test_preempt(fake_queue, preempt_policy, played):
+    queue = fake_queue(play_sec=0.3, preempt_policy=preempt_policy)
+    long_item = queue.submit('long')
+    wait_for(lambda: long_item.playing)
+    queue.submit('normal')
+    queue.submit('urgent', priority='urgent')
+    queue.join()
+    assert queue.bass.played == played
+    assert queue.num_preempted == 1
+
+
+@pytest.mark.parametrize('playback_mode', ['blocking', 'callback'])
+def test_preempt_stops_playback_within_a_buffer(make_bass, playback_mode):
+    bass = make_bass(tts_sec=3., playback_mode=playback_mode)
+    queue = SpeechQueue(bass, preempt_policy='drop')
+    try:
+        long_item = queue.submit('A long message.', 'Joanna')
+        wait_for(lambda: long_item.playing and bass.first_sound_t is not None, timeout=5.)
+        time.sleep(0.3)  # into the audio
+
+        preempt_t = time.time()
+        queue.submit('Urgent!', 'Joanna', priority='urgent')
+        assert long_item.wait(2.)
+        stop_sec = time.time() - preempt_t
+        assert long_item.state == 'dropped'
+        # One 4096-byte block (blocking mode) is 128 ms of 16 kHz audio
+        assert stop_sec < 0.25
+    finally:
+        queue.terminate()
@@ -0,0 +1,134 @@
+import os
+import struct
+
+import pytest
+
+from pibass.tts_cache import TTSCacheStore, DecodedAudioCache, cache_key_digest, tts_cache_key
+
+MP3 = b'\xff\xfb\x90\x00' + bytes(bytearray(range(256))) * 2  # not valid UTF-8 or ASCII
+
+
+def _py2_str(data):
+    """ Python 2 str (bytes) at pickle protocol 2. """
+    if len(data) < 256:
+        return b'U' + struct.pack('<B', len(data)) + data
+    return b'T' + struct.pack('<i', len(data)) + data
+
+
+def _py2_unicode(text):
+    data = text.encode('utf-8')
+    return b'X' + struct.pack('<I', len(data)) + data
+
+
+def py2_limited_size_dict_pickle(entries, size_limit=5000):
+    """Bytes of pickle.dump(LimitedSizeDict, fh, 2) under Python 2, as the
+    baseline pibass_audio wrote pibass_cache.pkl: an OrderedDict reduces to
+    (cls, ([[key, value], ...],), {'size_limit': n}).
+    """
+    out = [b'\x80\x02c' + b'audio_utils\nLimitedSizeDict\n', b']']
+    out.append(b'(')
+    for (text, voice), (mp3, onsets) in entries:
+        out.append(b'](')
+        out.append(_py2_unicode(text) if isinstance(text, type(u'')) else _py2_str(text))
+        out.append(_py2_str(voice) + b'\x86')
+        out.append(_py2_str(mp3) + b']('
+                   + b''.join(b'G' + struct.pack('>d', t) for t in onsets) + b'e\x86')
+        out.append(b'e')
+    out.append(b'e\x85R}' + _py2_str(b'size_limit') + b'M' + struct.pack('<H', size_limit) + b'sb.')
+    return b''.join(out)
+
+
+def test_put_get_and_reload(tmp_path):
+    store = TTSCacheStore(str(tmp_path))
+    store.put(('hello', 'Joanna', 22050), (MP3, [0.1, 0.5]))
+    assert store.get(('hello', 'Joanna', 22050)) == (MP3, [0.1, 0.5])
+    assert store.get(('hello', 'Hans', 22050)) is None
+    store.flush(forced=True)
+
+    reloaded = TTSCacheStore(str(tmp_path))
+    assert ('hello', 'Joanna', 22050) in reloaded
+    assert reloaded.get(('hello', 'Joanna', 22050)) == (MP3, [0.1, 0.5])
+
+
+def test_rebuilds_index_from_entry_files(tmp_path):
+    store = TTSCacheStore(str(tmp_path))
+    store.put(('a', 'v', 1), b'x')
+    os.remove(store.index_path)
+    assert TTSCacheStore(str(tmp_path)).get(('a', 'v', 1)) == b'x'
+
+
+def test_evicts_least_recently_used_by_count_and_bytes(tmp_path):
+    store = TTSCacheStore(str(tmp_path), size_limit=2)
+    for text in ('a', 'b'):
+        store.put((text, 'v', 1), text)
+    store.get(('a', 'v', 1))  # b is now the oldest
+    store.put(('c', 'v', 1), 'c')
+    assert ('a', 'v', 1) in store and ('c', 'v', 1) in store
+    assert ('b', 'v', 1) not in store
+    assert not os.path.exists(store.entry_path(cache_key_digest(('b', 'v', 1))))
+
+    store = TTSCacheStore(str(tmp_path / 'bytes'), size_limit=None, byte_limit=3000)
+    for i in range(5):
+        store.put((str(i), 'v', 1), b'\0' * 1000)
+    assert store.total_bytes <= 3000
+    assert ('4', 'v', 1) in store and ('0', 'v', 1) not in store
+
+
+def test_unusable_directory_leaves_store_empty(tmp_path):
+    blocker = tmp_path / 'file'
+    blocker.write_bytes(b'')
+    store = TTSCacheStore(str(blocker / 'cache'))
+    store.put(('a', 'v', 1), b'x')
+    assert store.disabled
+    assert store.get(('a', 'v', 1)) is None
+
+
+def test_migrates_python2_pickle(tmp_path):
+    legacy_path = str(tmp_path / 'pibass_cache.pkl')
+    with open(legacy_path, 'wb') as fh:
+        fh.write(py2_limited_size_dict_pickle([
+            ((u'Caf\xe9 is open', b'Celine'), (MP3, [0.25, 1.5])),
+            ((u'Bonjour'.encode('utf-8'), b'Mathieu'), (MP3 * 2, [0.5])),
+            ((u'Gr\xfc\xdfe'.encode('utf-8'), b'Hans'), (b'\xff', [])),  # UTF-8 in a py2 str
+        ]))
+
+    store = TTSCacheStore(str(tmp_path / 'cache'), legacy_path=legacy_path, legacy_sample_rate=22050)
+    assert len(store) == 3
+    assert store.get((u'Caf\xe9 is open', 'Celine', 22050)) == (MP3, [0.25, 1.5])
+    assert store.get(('Bonjour', 'Mathieu', 22050)) == (MP3 * 2, [0.5])
+    assert store.get((u'Gr\xfc\xdfe', 'Hans', 22050)) == (b'\xff', [])
+    assert not os.path.exists(legacy_path)
+    assert os.path.exists(legacy_path + '.migrated')
+
+
+def test_unreadable_legacy_pickle_is_skipped(tmp_path):
+    legacy_path = str(tmp_path / 'pibass_cache.pkl')
+    with open(legacy_path, 'wb') as fh:
+        fh.write(b'not a pickle')
+    store = TTSCacheStore(str(tmp_path / 'cache'), legacy_path=legacy_path)
+    assert len(store) == 0
+
+
+def test_decoded_audio_cache_is_bounded_by_bytes():
+    cache = DecodedAudioCache(byte_limit=100)
+    cache.put('a', 'A', 60)
+    cache.put('b', 'B', 30)
+    assert cache.get('a') == 'A'  # b is now the oldest
+    cache.put('c', 'C', 30)
+    assert 'b' not in cache and cache.get('a') == 'A' and cache.get('c') == 'C'
+    cache.put('d', 'D', 101)  # larger than the whole cache
+    assert 'd' not in cache
+
+
+@pytest.mark.parametrize('synthesis_mode', ['mp3', 'pcm'])
+def test_player_looks_up_the_keys_prewarm_stores(tmp_path, synthesis_mode):
+    from pibass.pibass_audio import PiBassAudio
+    from pibass.simulated_hat import SimulatedMotorHAT
+    bass = PiBassAudio(audio_cache_path=str(tmp_path), legacy_audio_cache_path=None,
+                       synthesis_mode=synthesis_mode, hat=SimulatedMotorHAT(),
+                       polly_client=object(), polly_warm_up=False, audio_dev=object())
+    try:
+        sample_rate = bass.pcm_sample_rate if synthesis_mode == 'pcm' else bass.audio_sample_rate
+        assert bass._cache_key('hello', 'Joanna') == tts_cache_key('hello', 'Joanna', synthesis_mode, sample_rate)
+    finally:
+        bass.terminate()